@@ -0,0 +1,105 @@
+import argparse
+import sys
+from pathlib import Path
+
+import torch
+
+from src import benchmark
+from src.utils import load_yaml
+
+SUITES = ["objectives", "models", "flows", "loaders", "fusion"]
+
+
+def run(args):
+    device = torch.device(args.device)
+    timing = {"n_steps": args.n_steps, "n_warmup": args.n_warmup}
+
+    results = []
+    for config in args.configs:
+        hparams = load_yaml(config)
+        name = Path(config).stem if args.short_names else config
+
+        if "objectives" in args.suites:
+            results += benchmark.bench_objectives(
+                name, hparams, args.batch_size, device, **timing
+            )
+        if "models" in args.suites:
+            results += benchmark.bench_model(
+                name, hparams, args.batch_size, device, **timing
+            )
+        if "loaders" in args.suites:
+            results += benchmark.bench_loader(
+                name, hparams, args.batch_size, real_data=args.real_data
+            )
+
+    if "models" in args.suites:
+        results += benchmark.bench_vdvae(args.batch_size, device, **timing)
+    if "flows" in args.suites:
+        results += benchmark.bench_flows(args.batch_size, device, **timing)
+    if "fusion" in args.suites:
+        results += benchmark.bench_fusion(args.batch_size, device, **timing)
+
+    settings = {key: value for key, value in vars(args).items() if key != "func"}
+    benchmark.save_results(args.output, results, settings)
+    print(f"Saved results to {args.output}")
+
+
+def compare(args):
+    regressions = benchmark.compare_results(
+        args.baseline, args.current, threshold=args.threshold
+    )
+
+    if regressions:
+        print(f"{len(regressions)} regression(s)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run benchmarks")
+    run_parser.add_argument(
+        "--configs",
+        "-c",
+        nargs="+",
+        default=benchmark.DEFAULT_CONFIGS,
+        help="paths to the config files",
+    )
+    run_parser.add_argument(
+        "--suites", nargs="+", choices=SUITES, default=SUITES, help="what to run"
+    )
+    run_parser.add_argument("--device", default="cpu")
+    run_parser.add_argument("--batch_size", type=int, default=32)
+    run_parser.add_argument("--n_steps", type=int, default=20)
+    run_parser.add_argument("--n_warmup", type=int, default=3)
+    run_parser.add_argument(
+        "--real_data",
+        action="store_true",
+        help="whether to benchmark the loaders of the real datamodules",
+    )
+    run_parser.add_argument(
+        "--short_names",
+        action="store_true",
+        help="whether to name results by config file stem",
+    )
+    run_parser.add_argument(
+        "--output", "-o", default="benchmark.json", help="results file"
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare two results files"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative slowdown in samples/sec reported as a regression",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,163 @@
+import argparse
+import itertools
+import json
+
+import torch
+from torch.utils.data import DataLoader
+
+import src.experiments as experiments
+from src import evaluation
+from src.datamodules.prefetch import move_to_device
+from src.utils import load_yaml
+
+SPLITS = ["train", "val", "test"]
+
+
+def load_experiment(hparams, checkpoint_path, device):
+    # Linear probes are attached by callbacks, so aren't created in `__init__`
+    expt = getattr(experiments, hparams["experiment"]).load_from_checkpoint(
+        checkpoint_path, map_location="cpu", strict=False
+    )
+
+    return expt.to(device).eval()
+
+
+def encode(args):
+    hparams = load_yaml(args.config)
+    device = torch.device(args.device)
+    expt = load_experiment(hparams, args.checkpoint, device)
+    datamodule = expt.datamodule
+
+    def prepare_batch(batch):
+        # As Lightning would
+        batch = move_to_device(batch, device)
+        if hasattr(datamodule, "apply_batch_transforms"):
+            batch = datamodule.apply_batch_transforms(batch)
+
+        return batch
+
+    for split in args.splits:
+        path = evaluation.LatentStore.path_for(args.root, args.checkpoint, split)
+        if evaluation.LatentStore.exists(path) and not args.overwrite:
+            print(f"{split}: already encoded in {path}")
+            continue
+
+        # Every item of the split once, in order; the train loader resumes,
+        # shuffles, drops and repeats items
+        loader = DataLoader(
+            getattr(datamodule, f"{split}_set"),
+            batch_size=datamodule.batch_size,
+            shuffle=False,
+            drop_last=False,
+            **datamodule.loader_kwargs(),
+        )
+        store = evaluation.encode_to_store(
+            expt.model,
+            loader,
+            path,
+            prepare_batch,
+            n_mean_samples=args.n_mean_samples,
+            meta={"checkpoint": args.checkpoint, "config": args.config},
+        )
+        print(f"{split}: encoded {store.n_items} items to {path}")
+
+
+def train(args):
+    train_store = evaluation.LatentStore(
+        evaluation.LatentStore.path_for(args.root, args.checkpoint, args.train_split)
+    )
+    val_store = evaluation.LatentStore(
+        evaluation.LatentStore.path_for(args.root, args.checkpoint, args.val_split)
+    )
+
+    # Every combination of probe hyperparameters
+    configs = [
+        {"hidden": hidden, "lr": lr, "weight_decay": weight_decay}
+        for hidden, lr, weight_decay in itertools.product(
+            args.hidden, args.lr, args.weight_decay
+        )
+    ]
+
+    results = []
+    for subset in train_store.subsets:
+        subset_results = evaluation.train_probes(
+            train_store,
+            val_store,
+            subset,
+            configs,
+            field=args.field,
+            epochs=args.epochs,
+            batch_size=args.batch_size,
+            device=args.device,
+            seed=args.seed,
+        )
+
+        for result in subset_results:
+            result = {"subset": list(subset), "field": args.field, **result}
+            print(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latent stores of a checkpoint, and probes trained on them"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    encode_parser = subparsers.add_parser(
+        "encode", help="encode dataset splits into a latent store"
+    )
+    encode_parser.add_argument(
+        "--config", "-c", help="path to the config file", required=True
+    )
+    encode_parser.add_argument(
+        "--checkpoint", help="path to checkpoint to load", required=True
+    )
+    encode_parser.add_argument(
+        "--splits", nargs="+", choices=SPLITS, default=["train", "val"]
+    )
+    encode_parser.add_argument("--n_mean_samples", type=int, default=16)
+    encode_parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="whether to re-encode splits that are already stored",
+    )
+    encode_parser.set_defaults(func=encode)
+
+    train_parser = subparsers.add_parser(
+        "train", help="train probes on a latent store"
+    )
+    train_parser.add_argument(
+        "--checkpoint", help="checkpoint the store was made with", required=True
+    )
+    train_parser.add_argument("--train_split", choices=SPLITS, default="train")
+    train_parser.add_argument("--val_split", choices=SPLITS, default="val")
+    train_parser.add_argument("--field", choices=["mean", "sample"], default="mean")
+    train_parser.add_argument(
+        "--hidden",
+        type=int,
+        nargs="+",
+        default=[0],
+        help="hidden units of each probe, 0 for linear probes",
+    )
+    train_parser.add_argument("--lr", type=float, nargs="+", default=[1e-3])
+    train_parser.add_argument("--weight_decay", type=float, nargs="+", default=[0.0])
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--batch_size", type=int, default=1024)
+    train_parser.add_argument("--seed", type=int, default=0)
+    train_parser.add_argument("--output", "-o", help="results file")
+    train_parser.set_defaults(func=train)
+
+    for subparser in [encode_parser, train_parser]:
+        subparser.add_argument(
+            "--root", default="latent_store", help="directory of latent stores"
+        )
+        subparser.add_argument("--device", default="cpu")
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,496 @@
+"""Throughput / memory benchmarks for objectives, models, flows, loaders, and
+fused (inference-only) CelebA modules.
+
+Models and objectives are built from experiment configs, with the datamodule
+swapped for `SyntheticMultimodalDataModule`, so everything runs without
+datasets (and on CPU). Results are written as JSON, and two result files (e.g.
+from different commits) can be compared with `compare_results`.
+
+Run with:
+    python benchmark.py run -c configs/mnist_svhn/pmvae.yaml -o results.json
+    python benchmark.py compare baseline.json results.json
+"""
+import copy
+import json
+import platform
+import resource
+import socket
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+import src.experiments as experiments
+import src.objectives as objectives
+import torch
+from src.datamodules.autotune import measure_loader
+from src.datamodules.prefetch import move_to_device
+from src.models import celeba, dists
+from src.utils import ConfigManager
+
+OBJECTIVES = ["mvae_elbo", "vaevae_elbo", "all_elbo", "jmvae_elbo"]
+STOCHASTIC_ELBO_KS = [1, 10, 100]
+
+DEFAULT_CONFIGS = [
+    "configs/mnist_svhn/jmvae.yaml",
+    "configs/mnist_svhn/poe_vaevae.yaml",
+    "configs/mnist_svhn/pmvae.yaml",
+    "configs/mnist_svhn/hier_pmvae_v1.yaml",
+    "configs/mnist_svhn/hier_pmvae_v2.yaml",
+    "configs/celeba/mvae.yaml",
+]
+
+# Datamodule class -> `SyntheticMultimodalDataModule` preset
+SYNTHETIC_PRESETS = {
+    "MNIST_SVHN_DataModule": "mnist_svhn",
+    "CelebaDataModule": "celeba",
+    "MultimodalMNISTDataModule": "multimodal_mnist",
+}
+
+# (name, constructor, whether conditioned on a [B, 2 * n_dim] context)
+FLOWS = [
+    ("standard_flow_affine", lambda n: dists.standard_flow(n, "affine_coupling"), 0),
+    ("standard_flow_rq", lambda n: dists.standard_flow(n, "rq_coupling"), 0),
+    ("cond_flow_affine", lambda n: dists.cond_flow(n, "affine_coupling"), 1),
+    ("cond_flow_rq", lambda n: dists.cond_flow(n, "rq_coupling"), 1),
+    (
+        "cond_standard_flow_affine",
+        lambda n: dists.cond_standard_flow(n, n * 2, "affine_coupling"),
+        1,
+    ),
+]
+
+
+# (name, constructor, input shape) of CelebA modules with residual blocks
+CELEBA_MODULES = [
+    ("CelebaImgEncoder", celeba.CelebaImgEncoder, (3, 64, 64)),
+    ("CelebaImgClassifier", celeba.CelebaImgClassifier, (3, 64, 64)),
+    ("CelebaTextEncoder", celeba.CelebaTextEncoder, (256, 71)),
+    ("CelebaTextClassifier", celeba.CelebaTextClassifier, (256, 71)),
+]
+
+
+# MEASUREMENT ##################################################################
+
+
+def _current_rss() -> int:
+    """Resident set size in bytes (Linux), else the peak so far"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # KB on Linux, bytes on macOS; only a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _PeakRSS:
+    """Samples the RSS in a background thread, to get the peak of a region"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_steps(
+    step: Callable[[], Any],
+    batch_size: int,
+    device: torch.device,
+    n_steps: int = 20,
+    n_warmup: int = 3,
+) -> Dict[str, float]:
+    """Times `n_steps` calls of `step`, after `n_warmup` untimed ones
+
+    Returns
+    -------
+    Dict[str, float]
+        steps_per_sec, samples_per_sec, peak_rss_mb, and (CUDA only)
+        peak_allocated_mb
+    """
+    for _ in range(n_warmup):
+        step()
+    _synchronize(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    with _PeakRSS() as rss:
+        start_time = time.perf_counter()
+        for _ in range(n_steps):
+            step()
+        _synchronize(device)
+        total_time = time.perf_counter() - start_time
+
+    result = {
+        "steps_per_sec": n_steps / total_time,
+        "samples_per_sec": n_steps * batch_size / total_time,
+        "peak_rss_mb": rss.peak / 2 ** 20,
+    }
+    if device.type == "cuda":
+        result["peak_allocated_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+    return result
+
+
+# EXPERIMENTS ##################################################################
+
+
+def synthetic_hparams(hparams: Dict, batch_size: int, n_batches: int) -> Dict:
+    """Config with the datamodule swapped for a (small) synthetic one"""
+    hparams = copy.deepcopy(hparams)
+    datamodule_name = hparams["datamodule"].rsplit(".", 1)[-1]
+    if datamodule_name not in SYNTHETIC_PRESETS:
+        raise ValueError(f"No synthetic preset for {datamodule_name}")
+
+    hparams["datamodule"] = "datamodules.SyntheticMultimodalDataModule"
+    hparams["datamodule_args"] = {
+        **(hparams.get("datamodule_args") or {}),
+        "preset": SYNTHETIC_PRESETS[datamodule_name],
+        "batch_size": batch_size,
+        "num_workers": 0,
+        "n_train": batch_size * n_batches,
+        "n_val": batch_size,
+        "n_test": batch_size,
+    }
+
+    return hparams
+
+
+def init_experiment(hparams: Dict, batch_size: int, device: torch.device):
+    hparams = synthetic_hparams(hparams, batch_size, n_batches=1)
+    expt = getattr(experiments, hparams["experiment"])(hparams)
+    expt.to(device)
+
+    batch = next(iter(expt.datamodule.train_dataloader()))
+    batch = expt.datamodule.apply_batch_transforms(move_to_device(batch, device))
+
+    return expt, batch
+
+
+def _train_step(expt, batch, objective, optimizer=None):
+    def step():
+        elbo = objective(
+            expt.model, batch, expt.likelihood_weights, kl_multiplier=1.0
+        ).mean()
+        (-elbo).backward()
+
+        if optimizer is not None:
+            optimizer.step()
+        expt.model.zero_grad(set_to_none=True)
+
+    return step
+
+
+def bench_objectives(
+    name: str, hparams: Dict, batch_size: int, device: torch.device, **kwargs
+) -> List[Dict]:
+    """Forward + backward of every objective (and `stochastic_elbo` forward at
+    several K) on the model of a config
+    """
+    expt, batch = init_experiment(hparams, batch_size, device)
+    expt.train()
+
+    results = []
+    for objective_name in OBJECTIVES:
+        step = _train_step(expt, batch, getattr(objectives, objective_name))
+        results.append(
+            _run(
+                "objectives",
+                f"{name}/{objective_name}",
+                lambda step=step: time_steps(step, batch_size, device, **kwargs),
+            )
+        )
+
+    expt.eval()
+    for K in STOCHASTIC_ELBO_KS:
+
+        def eval_step(K=K):
+            with torch.no_grad():
+                objectives.stochastic_elbo(
+                    expt.model, batch["data"], num_samples=K, keepdim=True
+                )
+
+        results.append(
+            _run(
+                "objectives",
+                f"{name}/stochastic_elbo_K{K}",
+                lambda step=eval_step: time_steps(step, batch_size, device, **kwargs),
+            )
+        )
+
+    return results
+
+
+def bench_model(
+    name: str, hparams: Dict, batch_size: int, device: torch.device, **kwargs
+) -> List[Dict]:
+    """Full training step (config objective + optimizer) of a config's model"""
+
+    def run():
+        expt, batch = init_experiment(hparams, batch_size, device)
+        expt.train()
+        optimizer = expt.configure_optimizers()
+        step = _train_step(expt, batch, expt.obj, optimizer)
+
+        return {
+            "n_parameters": sum(p.numel() for p in expt.model.parameters()),
+            **time_steps(step, batch_size, device, **kwargs),
+        }
+
+    return [_run("models", name, run)]
+
+
+def bench_loader(
+    name: str, hparams: Dict, batch_size: int, real_data=False, n_batches=50
+) -> List[Dict]:
+    """Train loader throughput of a config's datamodule (synthetic by default)"""
+
+    def run():
+        if real_data:
+            config_hparams = copy.deepcopy(hparams)
+            config_hparams["datamodule_args"] = {
+                **(config_hparams.get("datamodule_args") or {}),
+                "batch_size": batch_size,
+            }
+        else:
+            config_hparams = synthetic_hparams(hparams, batch_size, n_batches)
+            # Use the tuned worker settings, as for real data
+            config_hparams["datamodule_args"].pop("num_workers")
+
+        datamodule = ConfigManager(config_hparams).init_object("datamodule")
+        datamodule.prepare_data()
+        datamodule.setup("fit")
+
+        return measure_loader(
+            datamodule.train_dataloader(), n_batches=n_batches, n_epochs=1
+        )
+
+    suffix = "" if real_data else "/synthetic"
+
+    return [_run("loaders", f"{name}{suffix}", run)]
+
+
+# MODELS WITHOUT CONFIGS #######################################################
+
+
+def bench_flows(
+    batch_size: int, device: torch.device, n_dim: int = 16, **kwargs
+) -> List[Dict]:
+    """`log_prob` (+ backward) and `sample` of the flows in `src.models.dists`"""
+    results = []
+    for name, create_flow, conditional in FLOWS:
+        flow = create_flow(n_dim).to(device)
+        z = torch.randn(batch_size, n_dim, device=device)
+        context = (
+            torch.randn(batch_size, n_dim * 2, device=device) if conditional else None
+        )
+
+        def log_prob():
+            flow.log_prob(z, context=context).mean().backward()
+            flow.zero_grad(set_to_none=True)
+
+        def sample():
+            with torch.no_grad():
+                if conditional:
+                    flow.sample(1, context=context)
+                else:
+                    flow.sample(batch_size)
+
+        for op, step in [("log_prob", log_prob), ("sample", sample)]:
+            results.append(
+                _run(
+                    "flows",
+                    f"{name}/{op}",
+                    lambda: time_steps(step, batch_size, device, **kwargs),
+                )
+            )
+
+    return results
+
+
+def bench_fusion(batch_size: int, device: torch.device, **kwargs) -> List[Dict]:
+    """Eval-mode forward passes of the CelebA encoders / classifiers, as is and
+    after `celeba.fuse_for_inference`
+    """
+    results = []
+    for name, create_module, input_shape in CELEBA_MODULES:
+        module = create_module().to(device).eval()
+        x = torch.rand(batch_size, *input_shape, device=device)
+        fused = celeba.fuse_for_inference(module, x)
+
+        for variant, model in [("eager", module), ("fused", fused)]:
+
+            def step():
+                with torch.no_grad():
+                    model(x)
+
+            results.append(
+                _run(
+                    "fusion",
+                    f"{name}/{variant}",
+                    lambda: time_steps(step, batch_size, device, **kwargs),
+                )
+            )
+
+    return results
+
+
+def bench_vdvae(
+    batch_size: int, device: torch.device, image_size: int = 32, **kwargs
+) -> List[Dict]:
+    """Training step of the (default) vdvae `VAE`"""
+    from src.models.vdvae.vae import VAE
+
+    def run():
+        model = VAE(image_size=image_size).to(device)
+        optimizer = torch.optim.Adam(model.parameters())
+        # Preprocessed inputs and targets, [B, H, W, C] in [-1, 1]
+        x = torch.rand(batch_size, image_size, image_size, 3, device=device) * 2 - 1
+
+        def step():
+            model(x, x)["elbo"].backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        return {
+            "n_parameters": sum(p.numel() for p in model.parameters()),
+            **time_steps(step, batch_size, device, **kwargs),
+        }
+
+    return [_run("models", "vdvae/VAE", run)]
+
+
+# RESULTS ######################################################################
+
+
+def _run(suite: str, name: str, fn: Callable[[], Dict]) -> Dict:
+    """Runs a benchmark, recording (instead of raising) errors, e.g. objectives
+    not supported by a model
+    """
+    try:
+        metrics = fn()
+        error = None
+    except Exception as e:
+        metrics = {}
+        error = f"{type(e).__name__}: {e}"
+
+    result = {"suite": suite, "name": name, **metrics}
+    if error:
+        result["error"] = error
+    print(_format_result(result))
+
+    return result
+
+
+def _format_result(result: Dict) -> str:
+    key = f"{result['suite']}/{result['name']}"
+    if "error" in result:
+        return f"{key:60s} ERROR {result['error']}"
+    elif "steps_per_sec" in result:
+        return (
+            f"{key:60s} {result['steps_per_sec']:9.2f} steps/s "
+            f"{result['samples_per_sec']:11.1f} samples/s "
+            f"{result['peak_rss_mb']:9.1f} MB RSS"
+        )
+    else:
+        return f"{key:60s} {result['samples_per_sec']:11.1f} samples/s"
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "hostname": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def save_results(path: str, results: List[Dict], settings: Dict[str, Any]):
+    with open(path, "w") as results_file:
+        json.dump(
+            {"environment": environment(), "settings": settings, "results": results},
+            results_file,
+            indent=2,
+        )
+
+
+def load_results(path: str) -> Dict[str, Dict]:
+    with open(path) as results_file:
+        results = json.load(results_file)["results"]
+
+    return {f"{result['suite']}/{result['name']}": result for result in results}
+
+
+def compare_results(
+    baseline_path: str, current_path: str, threshold: float = 0.1
+) -> List[str]:
+    """Prints the relative change in samples/sec of every benchmark
+
+    Returns
+    -------
+    List[str]
+        Benchmarks that are slower by more than `threshold` (relative), or that
+        now fail
+    """
+    baseline = load_results(baseline_path)
+    current = load_results(current_path)
+
+    regressions = []
+    for key in sorted(baseline.keys() | current.keys()):
+        old, new = baseline.get(key), current.get(key)
+        if old is None or new is None:
+            print(f"{key:60s} {'added' if old is None else 'removed'}")
+            continue
+        if "error" in new and "error" not in old:
+            print(f"{key:60s} now fails: {new['error']}")
+            regressions.append(key)
+            continue
+        if "error" in old or "error" in new:
+            continue
+
+        change = new["samples_per_sec"] / old["samples_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+
+        memory = ""
+        if "peak_rss_mb" in old and "peak_rss_mb" in new:
+            memory = f"{new['peak_rss_mb'] - old['peak_rss_mb']:+9.1f} MB RSS"
+
+        print(f"{key:60s} {change:+8.1%} samples/s {memory} {flag}")
+
+    return regressions
@@ -11,3 +11,8 @@ from .online_linear_probe import OnlineLinearProbe
 from .coherence_evaluator import CoherenceEvaluator
 from .celeba_evaluator import CelebaEvaluator
 from .celeba_linear_probe import CelebaLinearProbe
+from .region_profiler import RegionProfiler
+from .throughput_monitor import ThroughputMonitor
+from .evaluation_scheduler import EvaluationScheduler
+from .latent_space_viz import LatentSpaceViz
+from .hooks import wrap_callback_hooks
@@ -1,67 +1,48 @@
-from pathlib import Path
-
 import pytorch_lightning as pl
 import torch
-from pytorch_lightning.metrics.classification import AveragePrecision
-from src.models.celeba import CelebaTextClassifier, CelebaImgClassifier
+from src.evaluation import ClassifierManager, MultilabelAveragePrecision, batch_cache
 from src.utils import CELEBA_CLASSES
 
 
 class CelebaEvaluator(pl.Callback):
-    def __init__(self):
+    def __init__(self, ap_mode="histogram"):
         super().__init__()
 
-        # Compute average precision for each class
-        self.aps = [(AveragePrecision(), AveragePrecision()) for _ in CELEBA_CLASSES]
+        # Compute average precision for each class, for img and text
+        self.aps = [
+            MultilabelAveragePrecision(len(CELEBA_CLASSES), mode=ap_mode)
+            for _ in range(2)
+        ]
 
     def on_pretrain_routine_start(self, trainer, pl_module):
-        # FIXME Or `on_test_start`
-
-        # Init classifiers
-        # Load pretrained weights
-        img_weights_path = Path("saved") / "celeba" / "clf_m1"
-        text_weights_path = Path("saved") / "celeba" / "clf_m2"
-
-        # FIXME Takes up too much memory?
-        self.img_clf = CelebaImgClassifier().to(pl_module.device)
-        self.text_clf = CelebaTextClassifier().to(pl_module.device)
-
-        self.img_clf.load_state_dict(torch.load(img_weights_path))
-        self.text_clf.load_state_dict(torch.load(text_weights_path))
-
-        self.img_clf.eval()
-        self.text_clf.eval()
+        # Pretrained classifiers, shared and loaded at first use,
+        # in half precision, and offloaded between evaluations
+        self.classifiers = ClassifierManager.get()
+        self.img_clf = self.classifiers.predictor("celeba_img")
+        self.text_clf = self.classifiers.predictor("celeba_text")
 
     def _cross_coherence(self, pl_module, batch):
         # Compute Cross Coherence
-        model = pl_module.model
         device = pl_module.device
 
         # Get data
-        img, text = [x.to(device) for x in batch["data"]]
         labels = batch["label"].to(device).long()  # [B, n_classes], {0, 1}
 
         with torch.no_grad():
-            # Get cross reconstructions
+            # Get cross reconstructions, reusing encodings of other callbacks
             # img_recons: [B, 3, 64, 64]
             # text_recons: [B, len_sequence, len(alphabet)], probability vectors
-            img_recons, text_recons = model.cross_reconstruct([img, text], mean=True)
+            img_recons, text_recons = batch_cache(
+                pl_module, batch
+            ).cross_reconstructions()
 
             # Get predictions: [B, n_classes], sigmoid output
             img_preds = self.img_clf(img_recons)
             text_preds = self.text_clf(text_recons)
 
-        # Compute AP for each class
-        for idx, (img_ap, text_ap) in enumerate(self.aps):
-            # Extract pred and target for specified class
-            img_pred = img_preds[:, idx]
-            text_pred = text_preds[:, idx]
-
-            target = labels[:, idx]
-
-            # Update average precision
-            img_ap(img_pred, target)
-            text_ap(text_pred, target)
+        # Update average precision of all classes
+        for ap, preds in zip(self.aps, [img_preds, text_preds]):
+            ap.update(preds, labels)
 
     def on_validation_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
@@ -71,25 +52,20 @@ class CelebaEvaluator(pl.Callback):
 
     def on_validation_epoch_end(self, trainer, pl_module):
         metrics = {}
-        img_ap_sum = 0
-        text_ap_sum = 0
-
-        for class_, (img_ap, text_ap) in zip(CELEBA_CLASSES, self.aps):
-            img_metric = img_ap.compute()
-            text_metric = text_ap.compute()
 
-            # To calculate mean AP
-            img_ap_sum += img_metric
-            text_ap_sum += text_metric
+        for type, ap in zip(["img", "text"], self.aps):
+            class_aps, mean_ap = ap.compute()
+            ap.reset()
 
-            metrics[f"val_img_{class_}_coh_AP"] = img_metric
-            metrics[f"val_text_{class_}_coh_AP"] = text_metric
-
-        metrics["val_img_coh_mAP"] = img_ap_sum / len(CELEBA_CLASSES)
-        metrics["val_text_coh_mAP"] = text_ap_sum / len(CELEBA_CLASSES)
+            for class_, class_ap in zip(CELEBA_CLASSES, class_aps):
+                metrics[f"val_{type}_{class_}_coh_AP"] = class_ap
+            metrics[f"val_{type}_coh_mAP"] = mean_ap
 
         # FIXME Could be wrong
         pl_module.log_dict(metrics)
 
+        # Free device memory until the next evaluation
+        self.classifiers.offload()
+
         # logger = pl_module.logger.experiment
         # logger.log(metrics, commit=False)
@@ -1,86 +1,71 @@
-from collections import defaultdict
-
 import pytorch_lightning as pl
 import torch
-import torch.nn as nn
-from pytorch_lightning.metrics.classification import AveragePrecision
-from src.models.base import MLP
+from src.evaluation import MultilabelAveragePrecision, OnlineProbeTrainer, batch_cache
 from src.utils import CELEBA_CLASSES
-from torch import optim
-from torch.nn import functional as F
 
 
 class CelebaLinearProbe(pl.Callback):
-    def __init__(self, partitioned=False):
+    def __init__(
+        self,
+        partitioned=False,
+        update_every_n_steps=1,
+        buffer_size=None,
+        ap_mode="histogram",
+    ):
         """
-        Attaches a MLP for finetuning as per the standard self-supervised protocol,
-        for MVAE
+        Attaches linear probes (see `GroupedLinearProbe`) for finetuning as per the
+        standard self-supervised protocol, for MVAE
 
         pl_module should have:
             pl_module.hparams['latent_dim']
             pl_module.datamodule.n_classes
+
+        Parameters
+        ----------
+        partitioned : bool, optional
+            If latent space is partitioned, by default False
+        update_every_n_steps : int, optional
+            If > 1, detached latents are kept in a ring buffer, and the probes
+            take one step on the whole buffer every `update_every_n_steps` steps,
+            by default 1
+        buffer_size : int, optional
+            Rows of the ring buffer,
+            by default `update_every_n_steps` training batches
+        ap_mode : str, optional
+            See `MultilabelAveragePrecision`, by default "histogram"
         """
         super().__init__()
         self.partitioned = partitioned  # If latent space is partitioned
+        self.update_every_n_steps = update_every_n_steps
+        self.buffer_size = buffer_size
         # To be set
-        self.optimizer = None
+        self.probe_trainer = None
         self.n_classes = None  # Number of classes for each modality
 
         # Compute average precision for each class, for each type (img, text, joint)
         self.aps = [
-            (AveragePrecision(), AveragePrecision(), AveragePrecision())
-            for _ in CELEBA_CLASSES
+            MultilabelAveragePrecision(len(CELEBA_CLASSES), mode=ap_mode, logits=True)
+            for _ in range(3)
         ]
 
-    def _concat_latents(self, latents):
-        # For partitioned latents
-        m_latents = latents["m"]
-        s_latent = latents["s"]
-
-        return torch.cat([l for l in m_latents if l is not None] + [s_latent], dim=-1)
-
     def on_pretrain_routine_start(self, trainer, pl_module):
         # FIXME Attach to different (earlier) callback hook?
         self.n_classes = len(CELEBA_CLASSES)
-        n_modalities = len(pl_module.datamodule.dims)
-
-        if not self.partitioned:
-            self.latent_dim = pl_module.hparams["latent_dim"]
-            # Create linear probes for each modality, and joint modalities
-            linear_probes = [
-                MLP(self.latent_dim, self.n_classes) for _ in range(n_modalities + 1)
-            ]
-
-        else:
-            self.m_latent_dim = pl_module.hparams["m_latent_dim"]
-            self.s_latent_dim = pl_module.hparams["s_latent_dim"]
-
-            # Create linear probes for each modality, and joint modalities
-            # FIXME To include modality-specific latent?
-            linear_probes = [
-                MLP(self.m_latent_dim + self.s_latent_dim, self.n_classes),
-                MLP(self.m_latent_dim + self.s_latent_dim, self.n_classes),
-                MLP(self.m_latent_dim * 2 + self.s_latent_dim, self.n_classes),
-            ]
 
-        # FIXME Shouldn't attach to `pl_module`?
-        pl_module.linear_probes = nn.ModuleList(linear_probes).to(pl_module.device)
-
-        # Init optimizer
-        self.optimizer = optim.Adam(pl_module.linear_probes.parameters(), lr=1e-3)
-
-    def get_representations(self, pl_module, x1, x2):
-        model = pl_module.model
+        self.probe_trainer = OnlineProbeTrainer(
+            self.n_classes,
+            multilabel=True,
+            partitioned=self.partitioned,
+            update_every_n_steps=self.update_every_n_steps,
+            buffer_size=self.buffer_size,
+        )
+        self.probe_trainer.setup(pl_module)
 
+    def get_representations(self, pl_module, batch):
         # Get latent representations from MVAE,
         # conditioned on all combination of modalities
-        if not self.partitioned:
-            return [model.encode(data) for data in [[x1, None], [None, x2], [x1, x2]]]
-        else:
-            return [
-                self._concat_latents(model.encode(data))
-                for data in [[x1, None], [None, x2], [x1, x2]]
-            ]
+        # Shared with other callbacks evaluating the same batch
+        return batch_cache(pl_module, batch).representations()
 
     def on_train_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
@@ -88,24 +73,12 @@ class CelebaLinearProbe(pl.Callback):
         device = pl_module.device
 
         # Get data
-        x1, x2 = [x.to(device) for x in batch["data"]]
         labels = batch["label"].to(device)
 
         with torch.no_grad():
-            representations = self.get_representations(pl_module, x1, x2)
-
-        # Forward pass through all respective linear probes
-        preds = [probe(z) for z, probe in zip(representations, pl_module.linear_probes)]
-
-        # FIXME Any way to vectorize this?
-        losses = [F.binary_cross_entropy_with_logits(p, labels) for p in preds]
-        # FIXME Is simply summing correct here?
-        loss = torch.stack(losses).sum()
+            representations = self.get_representations(pl_module, batch)
 
-        # Update weights
-        loss.backward()
-        self.optimizer.step()
-        self.optimizer.zero_grad()
+        self.probe_trainer.update(pl_module.global_step, representations, labels)
 
     def on_validation_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
@@ -113,44 +86,31 @@ class CelebaLinearProbe(pl.Callback):
         device = pl_module.device
 
         # Get data
-        x1, x2 = [x.to(device) for x in batch["data"]]
         labels = batch["label"].to(device)
 
         with torch.no_grad():
-            representations = self.get_representations(pl_module, x1, x2)
+            representations = self.get_representations(pl_module, batch)
 
-            # Forward pass through all respective linear probes
-            preds = [
-                probe(z) for z, probe in zip(representations, pl_module.linear_probes)
-            ]
+            # Forward pass through all respective linear probes, [H, B, C]
+            preds = pl_module.linear_probes(representations)
 
-        # Compute AP for each class
-        for idx, aps in enumerate(self.aps):
-            # Get targets for specified class
-            target = labels[:, idx]
-
-            # For each prediction, i.e. img, text, joint
-            for ap, pred in zip(aps, preds):
-                class_pred = pred[:, idx]
-
-                # Update average precision
-                ap(class_pred, target)
+        # Update average precision of all classes,
+        # for each prediction, i.e. img, text, joint
+        for ap, pred in zip(self.aps, preds):
+            ap.update(pred, labels)
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        metrics = defaultdict(int)
+        metrics = {}
         types = ["img", "text", "joint"]
 
-        # For each class
-        for class_, aps in zip(CELEBA_CLASSES, self.aps):
-            # For each type
-            for ap, type in zip(aps, types):
-                # Get AP computed from entire epoch
-                metric = ap.compute()
-
-                metrics[f"val_{type}_latent_mAP"] += metric
-                metrics[f"val_{type}_{class_}_latent_AP"] = metric
+        # For each type
+        for ap, type in zip(self.aps, types):
+            # Get APs computed from entire epoch
+            class_aps, mean_ap = ap.compute()
+            ap.reset()
 
-        for type in types:
-            metrics[f"val_{type}_latent_mAP"] /= len(CELEBA_CLASSES)
+            for class_, class_ap in zip(CELEBA_CLASSES, class_aps):
+                metrics[f"val_{type}_{class_}_latent_AP"] = class_ap
+            metrics[f"val_{type}_latent_mAP"] = mean_ap
 
         pl_module.log_dict(metrics)
@@ -1,27 +1,40 @@
-from pathlib import Path
-
 import pytorch_lightning as pl
 import torch
 from pytorch_lightning.metrics.functional import accuracy
-from src.models.classifiers import MNIST_Classifier, SVHN_Classifier
+from src.evaluation import ClassifierManager, batch_cache, joint_coherence
 
 
 class CoherenceEvaluator(pl.Callback):
-    def __init__(self):
+    def __init__(
+        self, val_joint_samples=1_000, test_joint_samples=10_000, chunk_size=1_000
+    ):
+        """Cross coherence on every validation / test batch, and joint coherence
+        (see `src.evaluation.joint_coherence`) at the end of every epoch
+
+        Parameters
+        ----------
+        val_joint_samples : int, optional
+            Joint samples per validation epoch, by default 1_000
+        test_joint_samples : int, optional
+            Joint samples at test time, by default 10_000
+        chunk_size : int, optional
+            Joint samples generated and classified at once, by default 1_000
+        """
         super().__init__()
+        self.val_joint_samples = val_joint_samples
+        self.test_joint_samples = test_joint_samples
+        self.chunk_size = chunk_size
 
     def _cross_coherence(self, pl_module, batch):
         # Compute Cross Coherence
-        model = pl_module.model
         device = pl_module.device
 
         # Get data
-        mnist, svhn = [x.to(device) for x in batch["data"]]
         targets = batch["label"].to(device)
 
         with torch.no_grad():
-            # Get cross reconstructions
-            m_recons, s_recons = model.cross_reconstruct([mnist, svhn], mean=True)
+            # Get cross reconstructions, reusing encodings of other callbacks
+            m_recons, s_recons = batch_cache(pl_module, batch).cross_reconstructions()
 
             # FIXME Resize back mnist
             # m_recons = F.interpolate(m_recons, size=28, mode="bilinear")
@@ -35,43 +48,20 @@ class CoherenceEvaluator(pl.Callback):
 
         return corr_m, corr_s
 
-    def _joint_coherence(self, pl_module):
-        # Compute Joint Coherence
-        n_samples = 10_000
-        corr = 0
-
-        model = pl_module.model
-        model.eval()
-
-        with torch.no_grad():
-            mnist, svhn = model.sample(n_samples, mean=True)
-
-            # Get predictions
-            m_preds = self.mnist_net(mnist).argmax(dim=1)
-            s_preds = self.svhn_net(svhn).argmax(dim=1)
-
-        # Evaluate correct samples
-        corr += (m_preds == s_preds).sum().item()
-        acc = corr / n_samples
-
-        return acc
+    def _joint_coherence(self, pl_module, n_samples):
+        # Compute Joint Coherence, with the same seed every epoch
+        return joint_coherence(
+            pl_module.model,
+            [self.mnist_net, self.svhn_net],
+            n_samples=n_samples,
+            chunk_size=self.chunk_size,
+        )
 
     def on_pretrain_routine_start(self, trainer, pl_module):
-        # FIXME Or `on_test_start`
-
-        # Init classifiers
-        # Load pretrained weights
-        mnist_weights_path = Path("saved") / "mnist_svhn" / "mnist_model.pt"
-        svhn_weights_path = Path("saved") / "mnist_svhn" / "svhn_model.pt"
-
-        self.mnist_net = MNIST_Classifier().to(pl_module.device)
-        self.svhn_net = SVHN_Classifier().to(pl_module.device)
-
-        self.mnist_net.load_state_dict(torch.load(mnist_weights_path))
-        self.svhn_net.load_state_dict(torch.load(svhn_weights_path))
-
-        self.mnist_net.eval()
-        self.svhn_net.eval()
+        # Pretrained classifiers, shared and loaded at first use
+        self.classifiers = ClassifierManager.get()
+        self.mnist_net = self.classifiers.predictor("mnist")
+        self.svhn_net = self.classifiers.predictor("svhn")
 
     def on_validation_batch_end(
         self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
@@ -96,17 +86,22 @@ class CoherenceEvaluator(pl.Callback):
         pl_module.log_dict(metrics, on_step=False, on_epoch=True)
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        acc = self._joint_coherence(pl_module)
+        results = self._joint_coherence(pl_module, self.val_joint_samples)
 
-        metrics = {"val_joint_coherence": acc}
+        metrics = {f"val_{key}": value for key, value in results.items()}
 
         logger = pl_module.logger.experiment
         logger.log(metrics, commit=False)
 
+        # Free device memory until the next evaluation
+        self.classifiers.offload()
+
     def on_test_epoch_end(self, trainer, pl_module):
-        acc = self._joint_coherence(pl_module)
+        results = self._joint_coherence(pl_module, self.test_joint_samples)
 
-        metrics = {"test_joint_coherence": acc}
+        metrics = {f"test_{key}": value for key, value in results.items()}
 
         logger = pl_module.logger.experiment
         logger.log(metrics, commit=False)
+
+        self.classifiers.offload()
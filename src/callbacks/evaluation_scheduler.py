@@ -0,0 +1,148 @@
+import math
+import time
+from functools import partial
+from typing import Dict
+
+from pytorch_lightning import Callback
+from src.callbacks.hooks import wrap_callback_hooks
+from src.evaluation import EvalSchedule
+
+# Hooks gated by `EvalSchedule.every_n_steps`
+TRAIN_BATCH_HOOKS = ["on_train_batch_start", "on_train_batch_end"]
+# Hooks gated by `EvalSchedule.data_fraction` and the time budget
+VAL_BATCH_HOOKS = ["on_validation_batch_start", "on_validation_batch_end"]
+# Hooks gated by `EvalSchedule.every_n_epochs`, and for callbacks with validation
+# batch hooks, by whether any of these ran this epoch (see `VAL_END_HOOKS`)
+EPOCH_HOOKS = [
+    "on_validation_start",
+    "on_validation_epoch_start",
+    "on_validation_epoch_end",
+    "on_validation_end",
+    "on_epoch_start",
+    "on_epoch_end",
+]
+VAL_END_HOOKS = ["on_validation_epoch_end", "on_validation_end"]
+
+
+class EvaluationScheduler(Callback):
+    def __init__(self, schedules: Dict[str, EvalSchedule]) -> None:
+        """Runs the hooks of other callbacks according to their `EvalSchedule`,
+        keyed by callback class name; other callbacks (e.g. checkpointing) are
+        left alone
+
+        Validation batches skipped by a callback are still seen by the others,
+        and by `validation_step`; test hooks always run on all data. The first
+        selected batch of an epoch always runs, whatever the time budget, and
+        the validation end hooks of a callback are skipped if none of its batch
+        hooks ran (so that they don't compute metrics of no data).
+
+        Parameters
+        ----------
+        schedules : Dict[str, EvalSchedule]
+        """
+        super().__init__()
+        self.schedules = schedules
+
+        # Seconds spent in validation batch hooks this epoch, per callback
+        self._elapsed = {}
+        self._budgets = {}
+        # Whether any validation batch hook ran this epoch, per callback
+        self._ran = {}
+        # End of the last validation epoch each callback ran in
+        self._last_window_end = {}
+        self._wrapped = False
+
+    def _scheduled_callbacks(self, trainer):
+        for callback in trainer.callbacks:
+            schedule = self.schedules.get(type(callback).__name__)
+
+            if callback is not self and schedule is not None:
+                yield callback, schedule
+
+    def _wrap_hook(self, trainer, callback, hook_name, hook):
+        schedule = self.schedules.get(type(callback).__name__)
+        if schedule is None:
+            return None
+
+        key = id(callback)
+        has_val_batch_hooks = any(
+            getattr(type(callback), name) is not getattr(Callback, name)
+            for name in VAL_BATCH_HOOKS
+        )
+
+        if hook_name in TRAIN_BATCH_HOOKS:
+
+            def scheduled_hook(*args, **kwargs):
+                if schedule.step_active(trainer.global_step):
+                    return hook(*args, **kwargs)
+
+        elif hook_name in VAL_BATCH_HOOKS:
+
+            def scheduled_hook(trainer_, pl_module, *args, **kwargs):
+                # batch_idx comes after (outputs,) batch
+                batch_idx = args[-2]
+                active = schedule.epoch_active(trainer.current_epoch)
+                if not active or not schedule.batch_selected(batch_idx):
+                    return
+
+                budget = self._budgets.get(key, math.inf)
+                # Out of budget, once there is something to report
+                if self._ran.get(key, False) and self._elapsed.get(key, 0.0) >= budget:
+                    return
+
+                self._ran[key] = True
+                start_time = time.perf_counter()
+                try:
+                    return hook(trainer_, pl_module, *args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start_time
+                    self._elapsed[key] = self._elapsed.get(key, 0.0) + elapsed
+
+        elif hook_name in VAL_END_HOOKS and has_val_batch_hooks:
+
+            def scheduled_hook(*args, **kwargs):
+                ran = self._ran.get(key, False)
+                if ran and schedule.epoch_active(trainer.current_epoch):
+                    return hook(*args, **kwargs)
+
+        else:
+
+            def scheduled_hook(*args, **kwargs):
+                if schedule.epoch_active(trainer.current_epoch):
+                    return hook(*args, **kwargs)
+
+        return scheduled_hook
+
+    def on_pretrain_routine_end(self, trainer, pl_module):
+        # Before the sanity check, after all callbacks are set up
+        if not self._wrapped:
+            wrap_callback_hooks(
+                trainer,
+                partial(self._wrap_hook, trainer),
+                hooks=TRAIN_BATCH_HOOKS + VAL_BATCH_HOOKS + EPOCH_HOOKS,
+                skip=self,
+            )
+            self._wrapped = True
+
+        now = time.perf_counter()
+        for callback, _ in self._scheduled_callbacks(trainer):
+            self._last_window_end[id(callback)] = now
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        now = time.perf_counter()
+
+        # Reset budgets of the new validation epoch
+        for callback, schedule in self._scheduled_callbacks(trainer):
+            key = id(callback)
+            since_last_window = now - self._last_window_end.get(key, now)
+
+            self._elapsed[key] = 0.0
+            self._ran[key] = False
+            self._budgets[key] = schedule.budget(since_last_window)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        now = time.perf_counter()
+
+        for callback, schedule in self._scheduled_callbacks(trainer):
+            if schedule.epoch_active(trainer.current_epoch):
+                self._last_window_end[id(callback)] = now
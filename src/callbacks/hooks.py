@@ -0,0 +1,44 @@
+from typing import Callable, List, Optional
+
+from pytorch_lightning import Callback
+
+# All hooks of a callback
+CALLBACK_HOOKS = [name for name in dir(Callback) if name.startswith("on_")]
+
+
+def wrap_callback_hooks(
+    trainer,
+    wrapper: Callable[[Callback, str, Callable], Optional[Callable]],
+    hooks: Optional[List[str]] = None,
+    skip: Optional[Callback] = None,
+):
+    """Replaces the hooks of the callbacks of `trainer` with
+    `wrapper(callback, hook_name, hook)`, on the instances
+
+    Only hooks a callback implements are wrapped, so that wrappers don't add
+    work to hooks that do nothing.
+
+    Parameters
+    ----------
+    trainer : pl.Trainer
+    wrapper : Callable[[Callback, str, Callable], Optional[Callable]]
+        Returns the wrapped hook, or None to leave the hook alone
+    hooks : List[str], optional
+        Names of the hooks to wrap, by default None (all hooks)
+    skip : Callback, optional
+        Callback to leave alone, usually the one wrapping, by default None
+    """
+    hooks = CALLBACK_HOOKS if hooks is None else hooks
+
+    for callback in trainer.callbacks:
+        if callback is skip:
+            continue
+
+        for hook_name in hooks:
+            # Only hooks the callback implements
+            if getattr(type(callback), hook_name) is getattr(Callback, hook_name):
+                continue
+
+            wrapped = wrapper(callback, hook_name, getattr(callback, hook_name))
+            if wrapped is not None:
+                setattr(callback, hook_name, wrapped)
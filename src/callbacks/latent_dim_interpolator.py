@@ -1,75 +1,143 @@
+from typing import List, Optional, Tuple, Union
+
 import torch
-import torchvision
-import wandb
 from pytorch_lightning.callbacks import Callback
+from src.media import media_logger
+from src.models import PartitionedMultimodalVAE
 
 
 class LatentDimInterpolator(Callback):
     def __init__(
-        self, interpolate_epoch_interval=20, range_start=-5, range_end=5
+        self,
+        interpolate_epoch_interval=20,
+        range_start=-5,
+        range_end=5,
+        steps=11,
+        dims: Tuple[int, int] = (0, 1),
+        latent: Union[str, int] = "s",
+        include_modality: Optional[List[bool]] = None,
     ) -> None:
         """Interpolates the latent space for a model by setting all dims to zero
-        and steping through the first two dims increasing one unit at a time,
-        and logs to wandb
+        and stepping through two dims over a grid, and logs it in the
+        background (see `src.media`)
 
+        The whole [steps * steps, Z] grid of latents is decoded in one batch.
         Default interpolates between [-5, 5] (-5, -4, -3, ..., 3, 4, 5)
 
+        Supports `VAE` (with `pl_module.img_dim`), `MultimodalVAE` and
+        `PartitionedMultimodalVAE`, logging the interpolation of every decoded
+        modality that is an image.
+
         Requirements:
-            `pl_module` should have `img_dim` attribute
+            `pl_module.hparams` should have `latent_dim`, or `m_latent_dim` and
+                `s_latent_dim` for partitioned models
 
         Parameters
         ----------
         interpolate_epoch_interval : int, optional
-            [description], by default 20
+            , by default 20
         range_start : int, optional
-            [description], by default -5
+            , by default -5
         range_end : int, optional
-            [description], by default 5
+            Included, by default 5
+        steps : int, optional
+            Values per dim, by default 11
+        dims : Tuple[int, int], optional
+            Latent dims to interpolate (rows, columns), by default (0, 1)
+        latent : Union[str, int], optional
+            For partitioned models, the latent to interpolate: "s" for the
+            modality-invariant latent, or the index of a modality for its
+            modality-specific latent, by default "s"
+        include_modality : List[bool], optional
+            To indicate which modalities to log, by default None (all images)
         """
         super().__init__()
 
         self.interpolate_epoch_interval = interpolate_epoch_interval
         self.range_start = range_start
         self.range_end = range_end
+        self.steps = steps
+        self.dims = dims
+        self.latent = latent
+        self.include_modality = include_modality
 
     def on_epoch_end(self, trainer, pl_module):
         if (trainer.current_epoch + 1) % self.interpolate_epoch_interval == 0:
-            images = self.interpolate_latent_space(pl_module)
-            images = torch.cat(images, dim=0)
-
-            # Create grid
-            range_len = self.range_end - self.range_start
-            grid = torchvision.utils.make_grid(images, nrow=range_len)
-            grid = grid.permute(1, 2, 0).cpu().numpy()
-
-            # Log samples
-            trainer.logger.experiment.log(
-                {"latent_interpolation": wandb.Image(grid)}, commit=False
-            )
-
-    def interpolate_latent_space(self, pl_module):
-        images = []
-
+            samples = self.interpolate_latent_space(pl_module)
+            multimodal = isinstance(samples, list)
+            if not multimodal:
+                samples = [samples]
+
+            for i, images in enumerate(samples):
+                if self.include_modality is not None:
+                    if not self.include_modality[i]:
+                        continue
+                # Not an image
+                elif images.dim() != 4:
+                    continue
+
+                # Log samples, as a grid
+                key = "latent_interpolation" + (f"_{i}" if multimodal else "")
+                media_logger(trainer).log_images(
+                    key, images, trainer.global_step, nrow=self.steps
+                )
+
+    def latent_grid(self, latent_dim: int, device: torch.device) -> torch.Tensor:
+        """[steps * steps, Z] latents, zero except for `dims`, which step through
+        the range row-wise and column-wise respectively
+        """
+        values = torch.linspace(
+            self.range_start, self.range_end, self.steps, device=device
+        )
+
+        z = torch.zeros(self.steps * self.steps, latent_dim, device=device)
+        z[:, self.dims[0]] = values.repeat_interleave(self.steps)
+        z[:, self.dims[1]] = values.repeat(self.steps)
+
+        return z
+
+    def interpolate_latent_space(
+        self, pl_module
+    ) -> Union[torch.Tensor, List[torch.Tensor]]:
+        """Decoder means of the latent grid
+
+        Returns
+        -------
+        Union[torch.Tensor, List[torch.Tensor]]
+            [steps * steps, *img_dim] for `VAE`, or
+            List[steps * steps, D] of length n_modalities for multimodal models
+        """
         model = pl_module.model
-        latent_dim = pl_module.hparams['latent_dim']
-
-        with torch.no_grad():
-            pl_module.eval()
-
-            for z1 in range(self.range_start, self.range_end, 1):
-                for z2 in range(self.range_start, self.range_end, 1):
-                    # Set all dims to zero
-                    z = torch.zeros(1, latent_dim, device=pl_module.device)
+        hparams = pl_module.hparams
+        device = pl_module.device
 
-                    # Set the first 2 dims to the value
-                    z[:, 0] = torch.tensor(z1)
-                    z[:, 1] = torch.tensor(z2)
+        was_training = pl_module.training
+        pl_module.eval()
 
-                    # Generate samples
-                    img = model.decode(z, mean=True)
-                    img = img.view(1, *pl_module.img_dim)
-
-                    images.append(img)
-
-        pl_module.train()
-        return images
+        with torch.no_grad():
+            if isinstance(model, PartitionedMultimodalVAE):
+                n = self.steps * self.steps
+                m_latents = [
+                    torch.zeros(n, hparams["m_latent_dim"], device=device)
+                    for _ in model.likelihoods
+                ]
+                s_latent = torch.zeros(n, hparams["s_latent_dim"], device=device)
+
+                if self.latent == "s":
+                    s_latent = self.latent_grid(hparams["s_latent_dim"], device)
+                else:
+                    m_latents[self.latent] = self.latent_grid(
+                        hparams["m_latent_dim"], device
+                    )
+
+                samples = model.decode({"m": m_latents, "s": s_latent}, mean=True)
+            else:
+                z = self.latent_grid(hparams["latent_dim"], device)
+                samples = model.decode(z, mean=True)
+
+                if not isinstance(samples, list):
+                    samples = samples.view(z.shape[0], *pl_module.img_dim)
+
+        pl_module.train(was_training)
+
+        return samples
@@ -1,2 +1,193 @@
 """http://pyro.ai/examples/vae.html
-"""
\ No newline at end of file
+"""
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from pytorch_lightning import Callback
+from src.evaluation import BIMODAL_SUBSETS, Reservoir, batch_cache
+from src.media import media_logger
+
+
+def pca_2d(z: torch.Tensor, seed=0) -> torch.Tensor:
+    """[N, Z] -> [N, 2], projected onto the first two principal components with
+    randomised PCA (`torch.pca_lowrank`), on the device of `z`
+    """
+    z = z.float()
+    mean = z.mean(0, keepdim=True)
+
+    devices = [z.device] if z.is_cuda else []
+    with torch.random.fork_rng(devices=devices):
+        torch.manual_seed(seed)
+        _, _, v = torch.pca_lowrank(z, q=min(2, z.shape[1]), center=True)
+
+    return (z - mean) @ v
+
+
+def tsne_2d(z: np.ndarray, seed=0) -> np.ndarray:
+    """[N, Z] -> [N, 2], with `sklearn.manifold.TSNE`"""
+    # Optional dependency, only needed if t-SNE is enabled
+    from sklearn.manifold import TSNE
+
+    return TSNE(n_components=2, random_state=seed).fit_transform(z)
+
+
+def plot_embeddings(
+    embeddings: List[np.ndarray], labels: np.ndarray, titles: Sequence[str]
+) -> torch.Tensor:
+    """Scatter plots of 2D embeddings side by side, coloured by label, rendered
+    without pyplot (so from any thread)
+
+    Returns
+    -------
+    torch.Tensor
+        [1, 3, H, W] image, in [0, 1]
+    """
+    fig = Figure(figsize=(5 * len(embeddings), 5))
+    canvas = FigureCanvasAgg(fig)
+
+    for i, (embedding, title) in enumerate(zip(embeddings, titles)):
+        ax = fig.add_subplot(1, len(embeddings), i + 1)
+        ax.scatter(embedding[:, 0], embedding[:, 1], s=5, c=labels, cmap="tab10")
+        ax.set_title(title)
+
+    canvas.draw()
+    image = np.asarray(canvas.buffer_rgba())[..., :3]
+
+    return torch.from_numpy(image.copy()).permute(2, 0, 1).unsqueeze(0) / 255.0
+
+
+class LatentSpaceViz(Callback):
+    def __init__(
+        self,
+        n_points=2_000,
+        subsets: Sequence[Tuple[int, ...]] = BIMODAL_SUBSETS,
+        tsne=False,
+        attribute=0,
+        every_n_epochs=1,
+        seed=0,
+    ) -> None:
+        """Visualises latents of the validation set, conditioned on each subset of
+        modalities, in 2D
+
+        A fixed-size uniform sample of (latent, label) pairs is kept during
+        validation with reservoir sampling, reusing the latents of the other
+        evaluation callbacks (see `src.evaluation.batch_cache`), so there is no
+        extra pass and the cost doesn't grow with the dataset. The sample is
+        projected with randomised PCA on device, and optionally with t-SNE in a
+        background worker. Plots are logged with `src.media`.
+
+        Requirements:
+            batches should have "data" and "label"
+
+        Parameters
+        ----------
+        n_points : int, optional
+            Size of the sample, by default 2_000
+        subsets : Sequence[Tuple[int, ...]], optional
+            Subsets of modalities to condition on, by default BIMODAL_SUBSETS
+        tsne : bool, optional
+            Whether to also plot t-SNE embeddings (requires sklearn), skipped if
+            the previous ones are still running (in their own worker),
+            by default False
+        attribute : int, optional
+            For multi-label data, the attribute to colour by, by default 0
+        every_n_epochs : int, optional
+            , by default 1
+        seed : int, optional
+            , by default 0
+        """
+        super().__init__()
+        self.n_points = n_points
+        self.subsets = subsets
+        self.tsne = tsne
+        self.attribute = attribute
+        self.every_n_epochs = every_n_epochs
+
+        self.reservoir = Reservoir(n_points, seed=seed)
+        self.seed = seed
+
+        # Separate workers, so that PCA plots don't wait for t-SNE
+        self._pca_executor: Optional[ThreadPoolExecutor] = None
+        self._tsne_executor: Optional[ThreadPoolExecutor] = None
+        self._tsne_future: Optional[Future] = None
+
+    def _active(self, trainer) -> bool:
+        return (trainer.current_epoch + 1) % self.every_n_epochs == 0
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self.reservoir.clear()
+
+    def on_validation_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        if not self._active(trainer):
+            return
+
+        labels = batch["label"].to(pl_module.device)
+        if labels.dim() > 1:
+            labels = labels[:, self.attribute]
+
+        # Shared with other callbacks evaluating the same batch
+        representations = batch_cache(pl_module, batch).representations(
+            self.subsets
+        )
+
+        self.reservoir.push(labels, *representations)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if not self._active(trainer) or len(self.reservoir) == 0:
+            return
+
+        labels, *representations = self.reservoir.get()
+        titles = [f"z ~ q(z|x_{subset})" for subset in self.subsets]
+        logger = media_logger(trainer)
+        step = trainer.global_step
+
+        # Only the (projected) sample is moved to CPU, and plotted in the worker
+        embeddings = [pca_2d(z, self.seed).cpu().numpy() for z in representations]
+        labels = labels.cpu().numpy()
+        if self._pca_executor is None:
+            self._pca_executor = ThreadPoolExecutor(max_workers=1)
+        self._pca_executor.submit(
+            self._log_plot, logger, "latent_pca", None, embeddings, labels, titles, step
+        )
+
+        # Don't queue up t-SNE runs if they take longer than an epoch
+        if self.tsne and (self._tsne_future is None or self._tsne_future.done()):
+            latents = [z.cpu().numpy() for z in representations]
+            if self._tsne_executor is None:
+                self._tsne_executor = ThreadPoolExecutor(max_workers=1)
+            self._tsne_future = self._tsne_executor.submit(
+                self._log_plot,
+                logger,
+                "latent_tsne",
+                tsne_2d,
+                latents,
+                labels,
+                titles,
+                step,
+            )
+
+    def _log_plot(self, logger, key, embed, points, labels, titles, step):
+        try:
+            if embed is not None:
+                points = [embed(z, self.seed) for z in points]
+
+            image = plot_embeddings(points, labels, titles)
+            logger.log_images(key, image, step, nrow=1)
+        except Exception as e:
+            warnings.warn(f"Failed to plot {key}: {type(e).__name__}: {e}")
+
+    def on_fit_end(self, trainer, pl_module):
+        for executor in [self._pca_executor, self._tsne_executor]:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        self._pca_executor = None
+        self._tsne_executor = None
+        self._tsne_future = None
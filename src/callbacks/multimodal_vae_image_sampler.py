@@ -1,14 +1,13 @@
 from typing import List
 
 import torch
-import torchvision
-import wandb
 from pytorch_lightning import Callback
+from src.media import media_logger
 
 
 class MultimodalVAE_ImageSampler(Callback):
     def __init__(self, include_modality: List[bool], num_samples=64) -> None:
-        """Generates images and logs to wandb
+        """Generates images and logs them in the background (see `src.media`)
 
         Requirements:
             `pl_module.model` should have `sample` method implemented,
@@ -34,17 +33,13 @@ class MultimodalVAE_ImageSampler(Callback):
             # Get samples
             samples = model.sample(self.num_samples, mean=True)
 
-            # Create grid for each modality
+            # Log samples of each modality, as a grid
             for i, (s, include) in enumerate(zip(samples, self.include_modality)):
                 if not include:
                     continue
 
-                grid = torchvision.utils.make_grid(s, nrow=8)
-                grid = grid.permute(1, 2, 0).cpu().numpy()
-
-                # Log samples
-                trainer.logger.experiment.log(
-                    {f"samples_{i}": wandb.Image(grid)}, commit=False
+                media_logger(trainer).log_images(
+                    f"samples_{i}", s, trainer.global_step, nrow=8
                 )
 
             # Cross reconstruction
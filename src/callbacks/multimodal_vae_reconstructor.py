@@ -1,14 +1,14 @@
 import torch
-import torchvision
-import wandb
 from pytorch_lightning import Callback
+from src.media import media_logger
 from torch.utils.data import Dataset
 import numpy as np
 
 
 class MultimodalVAEReconstructor(Callback):
     def __init__(self, dataset: Dataset, num_samples=8) -> None:
-        """Generates cross-reconstructions and logs to wandb
+        """Generates cross-reconstructions and logs them in the background
+        (see `src.media`)
 
         Requirements:
             `pl_module` should have `data_dim` attribute
@@ -43,12 +43,10 @@ class MultimodalVAEReconstructor(Callback):
             for i, s in enumerate(samples):
                 # FIXME Do I need this?
                 # images = images.view(self.num_samples, *pl_module.data_dim)
-                grid = torchvision.utils.make_grid(s, nrow=8)
-                grid = grid.permute(1, 2, 0).cpu().numpy()
 
-                # Log samples
-                trainer.logger.experiment.log(
-                    {f"samples_{i}": wandb.Image(grid)}, commit=False
+                # Log samples, as a grid
+                media_logger(trainer).log_images(
+                    f"samples_{i}", s, trainer.global_step, nrow=8
                 )
 
             # Cross reconstruction
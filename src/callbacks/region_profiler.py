@@ -0,0 +1,103 @@
+from pathlib import Path
+
+import torch
+from pytorch_lightning import Callback
+from src import profiling
+from src.callbacks.hooks import wrap_callback_hooks
+
+
+class RegionProfiler(Callback):
+    def __init__(
+        self, n_steps=5, wait=1, warmup=1, output_dir="profiles", row_limit=50
+    ) -> None:
+        """Profiles `n_steps` training steps with `torch.profiler`, and writes a
+        per-region summary table (see `src.profiling`), the full operator
+        table, and a Chrome trace to `output_dir`
+
+        The hooks of all other callbacks are profiled as regions as well.
+
+        Parameters
+        ----------
+        n_steps : int, optional
+            Number of steps to record, by default 5
+        wait : int, optional
+            Steps to skip first, by default 1
+        warmup : int, optional
+            Steps to trace but discard, by default 1
+        output_dir : str, optional
+            , by default "profiles"
+        row_limit : int, optional
+            Rows of the operator table, by default 50
+        """
+        super().__init__()
+        self.n_steps = n_steps
+        self.wait = wait
+        self.warmup = warmup
+        self.output_dir = Path(output_dir)
+        self.row_limit = row_limit
+
+        self.profiler = None
+        self._step = 0
+
+    @staticmethod
+    def _profiled(callback, hook_name, hook):
+        return profiling.profiled(f"{type(callback).__name__}.{hook_name}")(hook)
+
+    def on_train_start(self, trainer, pl_module):
+        profiling.enable()
+        wrap_callback_hooks(trainer, self._profiled, skip=self)
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if pl_module.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=self.wait, warmup=self.warmup, active=self.n_steps, repeat=1
+            ),
+            on_trace_ready=self._on_trace_ready,
+            profile_memory=True,
+        )
+        self.profiler.start()
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        if self.profiler is None:
+            return
+
+        self.profiler.step()
+        self._step += 1
+        if self._step >= self.wait + self.warmup + self.n_steps:
+            self._stop()
+
+    def on_train_end(self, trainer, pl_module):
+        if self.profiler is not None:
+            self._stop()
+
+    def _stop(self):
+        self.profiler.stop()
+        self.profiler = None
+        # Regions cost nothing from here on
+        profiling.enable(False)
+
+    def _on_trace_ready(self, profiler):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        profiler.export_chrome_trace(str(self.output_dir / "trace.json"))
+
+        events = profiler.key_averages()
+        sort_by = (
+            "cuda_time_total"
+            if torch.profiler.ProfilerActivity.CUDA in profiler.activities
+            else "cpu_time_total"
+        )
+        summary = profiling.summary_table(events, sort_by=sort_by)
+        operators = events.table(sort_by=sort_by, row_limit=self.row_limit)
+
+        (self.output_dir / "regions.txt").write_text(summary)
+        (self.output_dir / "operators.txt").write_text(operators)
+
+        print(f"Profiled {self.n_steps} steps, saved to {self.output_dir}")
+        print(summary)
@@ -0,0 +1,281 @@
+import resource
+import time
+from collections import deque
+
+import torch
+from pytorch_lightning import Callback
+from src.callbacks.hooks import wrap_callback_hooks
+
+# Phases of a training step, see `ThroughputMonitor`
+PHASES = ["data_wait", "forward", "backward", "optimizer", "callbacks"]
+
+
+def _rss_mb():
+    """Current resident set size of the process, None where /proc isn't
+    available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * resource.getpagesize() / 2 ** 20
+
+
+def _batch_stats(batch):
+    """Number of data points, and bytes of tensor data in a batch"""
+    size = None
+    n_bytes = 0
+
+    stack = [batch]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, torch.Tensor):
+            n_bytes += item.element_size() * item.numel()
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+
+    data = batch.get("data", []) if isinstance(batch, dict) else batch
+    for x in data:
+        if isinstance(x, torch.Tensor):
+            size = len(x)
+            break
+
+    return size or 0, n_bytes
+
+
+class ThroughputMonitor(Callback):
+    def __init__(self, log_every_n_steps=50, window=100) -> None:
+        """Logs where the time of training steps goes, to tell input-, compute-
+        and callback-bound runs apart
+
+        Every step is split into
+            data_wait: between steps, waiting for (and transferring) the batch
+            forward: `training_step`
+            backward: loss.backward()
+            optimizer: optimizer step and zero_grad
+            callbacks: hooks of all other callbacks
+        and averaged over the last `window` steps, together with samples/sec,
+        host -> device MB per step and peak memory since the last log (peak RSS
+        is sampled at the end of every step, or where /proc isn't available,
+        logged as the lifetime peak).
+
+        On CUDA, forward / backward / optimizer are device times from CUDA events;
+        events are only read once they have completed, so no syncs are added.
+
+        Parameters
+        ----------
+        log_every_n_steps : int, optional
+            , by default 50
+        window : int, optional
+            Number of steps to average over, by default 100
+        """
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.window = window
+
+        # Resolved steps, dicts of phase -> seconds
+        self.steps = deque(maxlen=window)
+        # Steps with CUDA events still in flight
+        self._pending = deque()
+        self._current = None
+        self._last_end = None
+        self._callback_time = 0.0
+        self._use_cuda = False
+        # Largest RSS sampled since the last log
+        self._peak_rss = None
+
+    # TIMING ###################################################################
+
+    def _mark(self, name):
+        if self._current is None:
+            return
+
+        self._current["host"][name] = time.perf_counter()
+        if self._use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self._current["events"][name] = event
+
+    def _wrap_training_step(self, pl_module):
+        training_step = pl_module.training_step
+
+        def timed_training_step(*args, **kwargs):
+            output = training_step(*args, **kwargs)
+            self._mark("forward_end")
+
+            return output
+
+        pl_module.training_step = timed_training_step
+
+    def _wrap_callback_hooks(self, trainer):
+        def timed(callback, hook_name, hook):
+            def timed_hook(*args, **kwargs):
+                start_time = time.perf_counter()
+                # Optimizer step is over once other callbacks' batch end hooks run
+                if (
+                    self._current is not None
+                    and "backward_end" in self._current["host"]
+                    and "optimizer_end" not in self._current["host"]
+                ):
+                    self._mark("optimizer_end")
+
+                try:
+                    return hook(*args, **kwargs)
+                finally:
+                    self._callback_time += time.perf_counter() - start_time
+
+            return timed_hook
+
+        wrap_callback_hooks(trainer, timed, skip=self)
+
+    def _resolve(self, step):
+        host = step["host"]
+        end = host.get("optimizer_end", host["end"])
+        forward_end = host.get("forward_end", host["start"])
+        backward_end = host.get("backward_end", forward_end)
+
+        times = {
+            "data_wait": step["data_wait"],
+            "forward": forward_end - host["start"],
+            "backward": backward_end - forward_end,
+            "optimizer": end - backward_end,
+            "callbacks": step["callbacks"],
+            "total": step["total"],
+        }
+
+        events = step["events"]
+        if events:
+            start = events["start"]
+            forward_end = events.get("forward_end", start)
+            backward_end = events.get("backward_end", forward_end)
+            end = events.get("optimizer_end", events["end"])
+
+            # Device times, in seconds
+            times["forward"] = start.elapsed_time(forward_end) / 1e3
+            times["backward"] = forward_end.elapsed_time(backward_end) / 1e3
+            times["optimizer"] = backward_end.elapsed_time(end) / 1e3
+
+        return {**times, "samples": step["samples"], "bytes": step["bytes"]}
+
+    def _resolve_completed(self):
+        while self._pending:
+            step = self._pending[0]
+            if step["events"] and not step["events"]["end"].query():
+                break
+
+            self.steps.append(self._resolve(self._pending.popleft()))
+
+    # HOOKS ####################################################################
+
+    def on_train_start(self, trainer, pl_module):
+        self._use_cuda = pl_module.device.type == "cuda"
+        self._wrap_training_step(pl_module)
+        self._wrap_callback_hooks(trainer)
+
+    def _reset_data_wait(self):
+        # The next step has nothing to wait for after e.g. validation or
+        # checkpointing, which aren't data stalls
+        self._last_end = None
+        self._callback_time = 0.0
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._reset_data_wait()
+
+    def on_validation_start(self, trainer, pl_module):
+        self._reset_data_wait()
+
+    def on_train_batch_start(
+        self, trainer, pl_module, batch, batch_idx, dataloader_idx
+    ):
+        now = time.perf_counter()
+
+        data_wait = 0.0
+        if self._last_end is not None:
+            # Callbacks that ran in between don't count as waiting for data
+            data_wait = max(now - self._last_end - self._callback_time, 0.0)
+        samples, n_bytes = _batch_stats(batch)
+
+        self._current = {
+            "host": {},
+            "events": {},
+            "data_wait": data_wait,
+            "samples": samples,
+            "bytes": n_bytes,
+            "between_callbacks": self._callback_time,
+        }
+        self._callback_time = 0.0
+        self._mark("start")
+
+    def on_after_backward(self, trainer, pl_module):
+        self._mark("backward_end")
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        step = self._current
+        if step is None:
+            return
+
+        self._mark("end")
+        now = step["host"]["end"]
+
+        step["callbacks"] = self._callback_time + step.pop("between_callbacks")
+        step["total"] = now - self._last_end if self._last_end is not None else None
+        self._callback_time = 0.0
+        self._last_end = now
+        self._current = None
+
+        self._pending.append(step)
+        self._resolve_completed()
+
+        rss = _rss_mb()
+        if rss is not None:
+            self._peak_rss = max(rss, self._peak_rss or 0.0)
+
+        if (trainer.global_step + 1) % self.log_every_n_steps == 0:
+            self._log(trainer, pl_module)
+
+    def _log(self, trainer, pl_module):
+        steps = [step for step in self.steps if step["total"] is not None]
+        if not steps or trainer.logger is None:
+            return
+
+        total_time = sum(step["total"] for step in steps)
+        metrics = {
+            f"perf/{phase}_ms": 1e3 * sum(step[phase] for step in steps) / len(steps)
+            for phase in PHASES
+        }
+        metrics.update(
+            {
+                f"perf/{phase}_fraction": sum(step[phase] for step in steps)
+                / total_time
+                for phase in ["data_wait", "callbacks"]
+            }
+        )
+        metrics["perf/step_ms"] = 1e3 * total_time / len(steps)
+        metrics["perf/samples_per_sec"] = sum(s["samples"] for s in steps) / total_time
+        metrics["perf/h2d_mb_per_step"] = (
+            sum(step["bytes"] for step in steps) / len(steps) / 2 ** 20
+        )
+
+        # Peak since the last log
+        if self._use_cuda:
+            metrics["perf/peak_allocated_mb"] = (
+                torch.cuda.max_memory_allocated(pl_module.device) / 2 ** 20
+            )
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+        if self._peak_rss is not None:
+            # Sampled at the end of every step
+            metrics["perf/peak_rss_mb"] = self._peak_rss
+            self._peak_rss = None
+        else:
+            # KB on Linux, over the lifetime of the process
+            metrics["perf/lifetime_peak_rss_mb"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+            )
+
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
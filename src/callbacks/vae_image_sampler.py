@@ -1,12 +1,11 @@
 import torch
-import torchvision
-import wandb
 from pytorch_lightning import Callback
+from src.media import media_logger
 
 
 class VAEImageSampler(Callback):
     def __init__(self, num_samples=64) -> None:
-        """Generates images and logs to wandb
+        """Generates images and logs them in the background (see `src.media`)
 
         Requirements:
             `pl_module` should have `data_dim` attribute
@@ -30,16 +29,12 @@ class VAEImageSampler(Callback):
             # Get samples
             images = model.sample(self.num_samples, mean=True)
 
-            # Create grid
-
             # FIXME Do I need this?
             # images = images.view(self.num_samples, *pl_module.data_dim)
-            grid = torchvision.utils.make_grid(images, nrow=8)
-            grid = grid.permute(1, 2, 0).cpu().numpy()
 
-            # Log samples
-            trainer.logger.experiment.log(
-                {"samples": wandb.Image(grid)}, commit=False
+            # Log samples, as a grid
+            media_logger(trainer).log_images(
+                "samples", images, trainer.global_step, nrow=8
             )
 
         pl_module.train()
@@ -3,3 +3,5 @@ from .indexed_mnist import IndexedMNISTDataModule
 from .mnist_svhn import MNIST_SVHN_DataModule
 from .multimodal_mnist import MultimodalMNISTDataModule
 from .celeba import CelebaDataModule
+from .sharded import ShardedMultimodalDataModule
+from .synthetic import SyntheticMultimodalDataModule
@@ -0,0 +1,261 @@
+"""Per-host DataLoader settings, and the sweep that tunes them.
+
+Tuned settings are stored in a JSON profile per host (keyed by datamodule class),
+and read by the datamodules at construction. Explicit arguments, e.g.
+`num_workers` in a config, take precedence over the profile.
+
+Tune with:
+    python tune_dataloader.py -c configs/celeba/mvae.yaml
+"""
+import json
+import os
+import socket
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+PROFILE_DIR = Path(
+    os.environ.get(
+        "VI_LAB_PROFILE_DIR", Path.home() / ".cache" / "vi-lab" / "loader_profiles"
+    )
+)
+
+DEFAULT_SETTINGS = {
+    "num_workers": 16,
+    "pin_memory": True,
+    "prefetch_factor": 2,
+    "persistent_workers": False,
+    # Pin each worker to its own CPUs
+    "cpu_affinity": False,
+    "test_batch_size": 16,
+}
+
+
+def profile_path(hostname: str = None) -> Path:
+    return PROFILE_DIR / f"{hostname or socket.gethostname()}.json"
+
+
+def _read_profiles(path: Path) -> Dict[str, Dict[str, Any]]:
+    if not path.exists():
+        return {}
+
+    with open(path) as profile_file:
+        return json.load(profile_file)
+
+
+def load_profile(name: str, hostname: str = None) -> Dict[str, Any]:
+    """Tuned settings of datamodule `name` on this host, if any"""
+    profile = _read_profiles(profile_path(hostname)).get(name, {})
+
+    return {key: value for key, value in profile.items() if key in DEFAULT_SETTINGS}
+
+
+def save_profile(
+    name: str, settings: Dict[str, Any], stats: Dict[str, float] = None, hostname=None
+):
+    path = profile_path(hostname)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    profiles = _read_profiles(path)
+    profiles[name] = {
+        **settings,
+        **(stats or {}),
+        "tuned_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    # Write atomically, other runs may be reading the profile
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as profile_file:
+        json.dump(profiles, profile_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+class PinWorkerCPUs:
+    def __init__(self, num_workers: int):
+        """`worker_init_fn` giving every DataLoader worker a disjoint set of the
+        CPUs available to the main process
+        """
+        self.num_workers = num_workers
+        self.cpus = available_cpus()
+
+    def __call__(self, worker_id: int):
+        if not hasattr(os, "sched_setaffinity"):
+            return
+
+        n_cpus = max(len(self.cpus) // self.num_workers, 1)
+        start = (worker_id * n_cpus) % len(self.cpus)
+        os.sched_setaffinity(0, self.cpus[start : start + n_cpus])
+
+
+class TunedLoaderMixin:
+    """Resolves DataLoader settings from `DEFAULT_SETTINGS`, the host profile,
+    and explicit arguments (in increasing precedence).
+    """
+
+    loader_settings = DEFAULT_SETTINGS
+
+    def init_loader_settings(self, **overrides):
+        settings = {**DEFAULT_SETTINGS, **load_profile(type(self).__name__)}
+        settings.update(
+            {key: value for key, value in overrides.items() if value is not None}
+        )
+
+        self.loader_settings = settings
+        self.num_workers = settings["num_workers"]
+
+    @property
+    def test_batch_size(self) -> int:
+        return self.loader_settings["test_batch_size"]
+
+    def loader_kwargs(self) -> Dict[str, Any]:
+        """Keyword arguments for every `DataLoader` of the datamodule"""
+        settings = self.loader_settings
+        num_workers = settings["num_workers"]
+
+        kwargs = {"num_workers": num_workers, "pin_memory": settings["pin_memory"]}
+        if num_workers > 0:
+            kwargs["prefetch_factor"] = settings["prefetch_factor"]
+            kwargs["persistent_workers"] = settings["persistent_workers"]
+            if settings["cpu_affinity"]:
+                kwargs["worker_init_fn"] = PinWorkerCPUs(num_workers)
+
+        return kwargs
+
+
+def _batch_len(batch) -> int:
+    if isinstance(batch, dict):
+        return len(batch["data"][0])
+
+    return len(batch[0])
+
+
+def measure_loader(
+    loader, n_batches: int = 50, n_epochs: int = 2, step_time: float = 0.0
+) -> Dict[str, float]:
+    """Throughput of `loader` under a simulated training step
+
+    Every epoch restarts the iterator, so worker start-up (and hence
+    `persistent_workers`) counts towards the measurement.
+
+    Parameters
+    ----------
+    loader : Iterable
+    n_batches : int, optional
+        Batches per epoch, by default 50
+    n_epochs : int, optional
+        , by default 2
+    step_time : float, optional
+        Seconds spent per batch by the simulated step, by default 0.0
+
+    Returns
+    -------
+    Dict[str, float]
+        `samples_per_sec`, and `data_wait_fraction`: fraction of the time spent
+        waiting for batches
+    """
+    n_samples = 0
+    wait_time = 0.0
+    start_time = time.perf_counter()
+
+    for _ in range(n_epochs):
+        request_time = time.perf_counter()
+        for idx, batch in enumerate(loader):
+            wait_time += time.perf_counter() - request_time
+            n_samples += _batch_len(batch)
+
+            if step_time:
+                time.sleep(step_time)
+
+            if idx + 1 >= n_batches:
+                break
+            request_time = time.perf_counter()
+
+    total_time = time.perf_counter() - start_time
+
+    return {
+        "samples_per_sec": n_samples / total_time,
+        "data_wait_fraction": wait_time / total_time,
+    }
+
+
+def default_worker_counts() -> List[int]:
+    n_cpus = len(available_cpus())
+    counts = [0] + [2 ** i for i in range(n_cpus.bit_length()) if 2 ** i < n_cpus]
+
+    return counts + [n_cpus]
+
+
+def tune_datamodule(
+    datamodule,
+    worker_counts: Sequence[int] = None,
+    prefetch_factors: Sequence[int] = (2, 4, 8),
+    test_batch_sizes: Sequence[int] = (16, 64, 256),
+    n_batches: int = 50,
+    step_time: float = 0.0,
+    min_gain: float = 0.05,
+    verbose: bool = True,
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Sweeps the loader settings of a (set up) `TunedLoaderMixin` datamodule
+
+    Settings are tuned one at a time (workers, prefetch factor, persistent
+    workers, CPU affinity) on the train loader, keeping the best of each, then
+    the test batch size on the test loader. A setting only changes if it
+    improves throughput by more than `min_gain` (relative).
+
+    Returns
+    -------
+    Tuple[Dict[str, Any], Dict[str, float]]
+        Best settings, and the train loader stats with them
+    """
+    settings = dict(datamodule.loader_settings)
+
+    def run(candidate, test=False):
+        datamodule.loader_settings = candidate
+        loader = datamodule.test_dataloader() if test else datamodule.train_dataloader()
+        stats = measure_loader(loader, n_batches=n_batches, step_time=step_time)
+
+        if verbose:
+            swept = {key: candidate[key] for key in DEFAULT_SETTINGS}
+            print(
+                f"{swept} -> {stats['samples_per_sec']:.1f} samples/s, "
+                f"{stats['data_wait_fraction']:.1%} waiting"
+            )
+
+        return stats
+
+    def sweep(key, values, test=False):
+        nonlocal settings
+
+        # Values are in order of preference (cheaper first), later ones have to
+        # be clearly faster to be picked over measurement noise
+        best_stats, best_value, threshold = None, None, 0.0
+        for value in values:
+            stats = run({**settings, key: value}, test)
+            if stats["samples_per_sec"] > threshold:
+                best_stats, best_value = stats, value
+                threshold = stats["samples_per_sec"] * (1 + min_gain)
+
+        settings = {**settings, key: best_value}
+
+        return best_stats
+
+    try:
+        stats = sweep("num_workers", worker_counts or default_worker_counts())
+        if settings["num_workers"] > 0:
+            stats = sweep("prefetch_factor", prefetch_factors)
+            stats = sweep("persistent_workers", [False, True])
+            stats = sweep("cpu_affinity", [False, True])
+        if hasattr(datamodule, "test_set"):
+            sweep("test_batch_size", test_batch_sizes, test=True)
+    finally:
+        datamodule.loader_settings = settings
+
+    return settings, stats
@@ -1,11 +1,28 @@
+import hashlib
 import json
+import os
 from pathlib import Path
 
-import pandas as pd
+import numpy as np
 import PIL.Image as Image
 import torch
 from pytorch_lightning import LightningDataModule
-from src.datamodules.utils import one_hot_encode
+from src.datamodules import transforms as batch_transform_lib
+from src.datamodules.autotune import TunedLoaderMixin
+from src.datamodules.prefetch import DevicePrefetchMixin
+from src.datamodules.samplers import (
+    PairedBatchSampler,
+    PairedCollate,
+    RandomBatchSampler,
+)
+from src.datamodules.shared import (
+    is_complete,
+    load_arrays,
+    save_arrays,
+    shared_arrays,
+)
+from src.datamodules.transforms import BatchTransformMixin
+from src.datamodules.utils import encode_indices, one_hot_from_indices
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 
@@ -32,6 +49,113 @@ def get_transform_celeba(crop_size_img=148, img_size=64):
     return transform
 
 
+def get_batch_transform_celeba(crop_size_img=148, img_size=64):
+    # Same as `get_transform_celeba`, on uint8 [B, 3, 218, 178] batches
+    return batch_transform_lib.Compose(
+        [
+            batch_transform_lib.ToFloat(),
+            batch_transform_lib.Crop(
+                (218 - crop_size_img) // 2,
+                (178 - crop_size_img) // 2,
+                crop_size_img,
+                crop_size_img,
+            ),
+            batch_transform_lib.Resize(
+                (img_size, img_size), mode="bicubic", antialias=True
+            ),
+        ]
+    )
+
+
+_METADATA_FIELDS = ["image_ids", "partition", "labels", "text", "tokens", "alphabet"]
+# Per-process cache of loaded metadata, as `setup` builds several datasets
+_METADATA = {}
+
+
+def _celeba_cache_key(*paths):
+    # Cache is invalidated whenever any of the source files change
+    key = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        key.update(f"{Path(path).name}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+
+    return key.hexdigest()[:16]
+
+
+def _build_celeba_metadata(
+    filename_text, filename_partition, filename_attributes, alphabet_path, len_sequence
+):
+    """Joins the CelebA CSVs into flat numpy arrays (the only place pandas is used)"""
+    import pandas as pd
+
+    df_text = pd.read_csv(filename_text)
+    df_partition = pd.read_csv(filename_partition)
+    df_attributes = pd.read_csv(filename_attributes)
+
+    with open(alphabet_path) as alphabet_file:
+        alphabet = str("".join(json.load(alphabet_file)))
+
+    texts = df_text["text"].values
+
+    return {
+        "image_ids": df_text["image_id"].values.astype(np.bytes_),
+        "partition": df_partition["partition"].values.astype(np.int8),
+        # Binarised attributes, {-1, 1} -> {0, 1}
+        "labels": (df_attributes.values[:, 1:] > 0).astype(np.uint8),
+        "text": np.char.encode(texts.astype(np.str_), "utf-8"),
+        "tokens": np.stack(
+            [encode_indices(len_sequence, alphabet, text) for text in texts]
+        ),
+        "alphabet": np.array(alphabet),
+    }
+
+
+def load_celeba_metadata(
+    dir_dataset_base, filename_text, len_sequence, shared_memory=False
+):
+    """Loads the joined CelebA metadata from a memory-mapped cache,
+    building the cache first if it is missing or stale.
+
+    If `shared_memory`, the cache is copied once into shared memory, and mapped
+    from there by every run / worker on this host.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        image_ids: [N], partition: [N], labels: [N, 40], text: [N],
+        tokens: [N, len_sequence], alphabet: []
+    """
+    dir_dataset_base = Path(dir_dataset_base)
+    sources = [
+        filename_text,
+        dir_dataset_base / "list_eval_partition.csv",
+        dir_dataset_base / "list_attr_celeba.csv",
+        dir_dataset_base / "alphabet.json",
+    ]
+    cache_dir = (
+        dir_dataset_base
+        / "cache"
+        / f"{Path(filename_text).stem}_{_celeba_cache_key(*sources)}"
+    )
+
+    if (str(cache_dir), shared_memory) in _METADATA:
+        return _METADATA[(str(cache_dir), shared_memory)]
+
+    if not is_complete(cache_dir):
+        save_arrays(cache_dir, _build_celeba_metadata(*sources, len_sequence))
+
+    if shared_memory:
+        metadata = shared_arrays(
+            f"celeba-{cache_dir.name}",
+            lambda: {k: np.asarray(v) for k, v in load_arrays(cache_dir).items()},
+        )
+    else:
+        metadata = load_arrays(cache_dir, _METADATA_FIELDS)
+    _METADATA[(str(cache_dir), shared_memory)] = metadata
+
+    return metadata
+
+
 class CelebaDataset(Dataset):
     """Custom Dataset for loading CelebA face images
 
@@ -47,6 +171,9 @@ class CelebaDataset(Dataset):
         random_text_ordering=False,
         random_text_startindex=True,
         paired_prop=1.0,
+        transform=None,
+        seed=None,
+        shared_memory=False,
     ):
         self.len_sequence = len_sequence
 
@@ -64,41 +191,42 @@ class CelebaDataset(Dataset):
         filename_partition = dir_dataset_base / "list_eval_partition.csv"
         filename_attributes = dir_dataset_base / "list_attr_celeba.csv"
 
-        df_text = pd.read_csv(filename_text)
-        df_partition = pd.read_csv(filename_partition)
-        df_attributes = pd.read_csv(filename_attributes)
-
         self.img_dir = dir_dataset_base / "img_align_celeba"
         self.txt_path = filename_text
         self.attrributes_path = filename_attributes
         self.partition_path = filename_partition
 
-        alphabet_path = dir_dataset_base / "alphabet.json"
-        with open(alphabet_path) as alphabet_file:
-            self.alphabet = str("".join(json.load(alphabet_file)))
+        metadata = load_celeba_metadata(
+            dir_dataset_base, filename_text, len_sequence, shared_memory
+        )
+        self.alphabet = str(metadata["alphabet"])
+
+        # Rows belonging to this partition
+        rows = np.flatnonzero(metadata["partition"] == partition)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            # Partitions are contiguous in the official split; keep memmap views
+            rows = slice(rows[0], rows[-1] + 1)
 
-        self.img_names = df_text.loc[df_partition["partition"] == partition][
-            "image_id"
-        ].values
-        self.attributes = df_attributes.loc[df_partition["partition"] == partition]
-        self.labels = df_attributes.loc[df_partition["partition"] == partition].values
-        # atm, i am just using blond_hair as labels
-        self.y = df_text.loc[df_partition["partition"] == partition]["text"].values
+        self.img_names = metadata["image_ids"][rows]
+        self.labels = metadata["labels"][rows]
+        self.tokens = metadata["tokens"][rows]
+        self.y = metadata["text"][rows]
 
-        self.transform = get_transform_celeba()
+        self.transform = transform or get_transform_celeba()
 
         self.dataset_len = self.y.shape[0]
 
         # Create boolean tensor of data points that are to be paired
-        self.paired = torch.rand(self.dataset_len) <= paired_prop
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        self.paired = torch.rand(self.dataset_len, generator=generator) <= paired_prop
 
     def __getitem__(self, index):
-        img = Image.open(self.img_dir / self.img_names[index])
+        img = Image.open(self.img_dir / self.img_names[index].decode())
 
         if self.transform is not None:
             img = self.transform(img)
-        text_str = one_hot_encode(self.len_sequence, self.alphabet, self.y[index])
-        label = torch.from_numpy((self.labels[index, 1:] > 0).astype(int)).float()
+        text_str = one_hot_from_indices(self.tokens[index], len(self.alphabet))
+        label = torch.from_numpy(self.labels[index].astype(np.float32))
 
         # Whether this data point is to be paired
         paired = self.paired[index]
@@ -112,14 +240,28 @@ class CelebaDataset(Dataset):
         return self.dataset_len
 
     def get_text_str(self, index):
-        return self.y[index]
+        return self.y[index].decode()
 
 
-class CelebaDataModule(LightningDataModule):
+class CelebaDataModule(
+    BatchTransformMixin, DevicePrefetchMixin, TunedLoaderMixin, LightningDataModule
+):
     """Paired CelebA - Text multimodal dataset.
 
     Train size: 162_770
     Val size: 19_867
+
+    If `batch_transforms`, images are loaded as uint8 tensors and cropped /
+    resized per batch, on the device if `batch_transforms_on_device`.
+
+    If `n_paired_per_batch` is set, every training batch starts with exactly that
+    many paired data points, followed by unpaired ones.
+
+    If `shared_memory`, the metadata tables are mapped from shared memory, shared
+    by all runs and workers on the host.
+
+    If `prefetch_depth` > 0, the next batches are moved to the device in the
+    background, see `DevicePrefetcher`.
     """
 
     def __init__(
@@ -127,17 +269,25 @@ class CelebaDataModule(LightningDataModule):
         data_dir: str = "data",
         batch_size: int = 32,
         # val_split: int = 50_000,
-        num_workers: int = 16,
+        num_workers: int = None,
         seed: int = 42,
         paired_prop=1.0,
+        batch_transforms=False,
+        batch_transforms_on_device=True,
+        n_paired_per_batch=None,
+        shared_memory=False,
+        prefetch_depth=0,
     ):
         super().__init__()
         self.data_dir = data_dir
         self.batch_size = batch_size
         # self.val_split = val_split
-        self.num_workers = num_workers
+        self.init_loader_settings(num_workers=num_workers)
         self.seed = seed
         self.paired_prop = paired_prop
+        self.n_paired_per_batch = n_paired_per_batch
+        self.shared_memory = shared_memory
+        self.prefetch_depth = prefetch_depth
 
         # FIXME Hardcode
         self.dims = [(3, 64, 64), (256, 71)]
@@ -145,6 +295,14 @@ class CelebaDataModule(LightningDataModule):
         self.likelihood_weights = (1.0, 64 * 64 / 256)
         self.n_classes = 40
 
+        self.batch_transforms_on_device = batch_transforms_on_device
+        if batch_transforms:
+            # No transform for text
+            self.batch_transforms = [get_batch_transform_celeba(), None]
+            self.transform = transforms.PILToTensor()
+        else:
+            self.transform = None
+
     def prepare_data(self):
         pass
 
@@ -154,41 +312,65 @@ class CelebaDataModule(LightningDataModule):
                 self.data_dir,
                 partition=0,
                 paired_prop=self.paired_prop,
+                transform=self.transform,
+                seed=self.seed,
+                shared_memory=self.shared_memory,
             )
             self.val_set = CelebaDataset(
                 self.data_dir,
                 partition=1,
+                transform=self.transform,
+                shared_memory=self.shared_memory,
             )
 
+            # Resumable shuffling, see `MVAE_Experiment.on_save_checkpoint`
+            if self.n_paired_per_batch is None:
+                self.train_sampler = RandomBatchSampler(
+                    len(self.train_set), self.batch_size, drop_last=True, seed=self.seed
+                )
+            else:
+                self.train_sampler = PairedBatchSampler(
+                    self.train_set.paired,
+                    self.batch_size,
+                    self.n_paired_per_batch,
+                    seed=self.seed,
+                )
+
         if stage == "test" or stage is None:
             self.test_set = self.val_set
 
     def train_dataloader(self):
-        return DataLoader(
-            self.train_set,
-            batch_size=self.batch_size,
-            shuffle=True,
-            num_workers=self.num_workers,
-            drop_last=True,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.train_set,
+                batch_sampler=self.train_sampler,
+                collate_fn=(
+                    None
+                    if self.n_paired_per_batch is None
+                    else PairedCollate(self.n_paired_per_batch)
+                ),
+                **self.loader_kwargs(),
+            )
         )
 
     def val_dataloader(self):
-        return DataLoader(
-            self.val_set,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.val_set,
+                batch_size=self.batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
         )
 
     def test_dataloader(self):
-        return DataLoader(
-            self.test_set,
-            batch_size=16,
-            shuffle=False,
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.test_set,
+                batch_size=self.test_batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
         )
@@ -2,7 +2,19 @@ from pathlib import Path
 
 import numpy as np
 import torch
+from PIL import Image
 from pytorch_lightning import LightningDataModule
+from src.datamodules import transforms as batch_transform_lib
+from src.datamodules.autotune import TunedLoaderMixin
+from src.datamodules.prefetch import DevicePrefetchMixin
+from src.datamodules.samplers import (
+    PairedBatchSampler,
+    PairedCollate,
+    RandomBatchSampler,
+    get_paired_mask,
+)
+from src.datamodules.shared import files_key, path_key, shared_arrays
+from src.datamodules.transforms import BatchTransformMixin
 from torch.utils.data import DataLoader, Dataset, random_split
 from torchvision import transforms as transform_lib
 from torchvision.datasets import MNIST, SVHN
@@ -17,18 +29,38 @@ class MNIST_SVHN(Dataset):
         transform=None,
         paired_prop=1.0,
         resize=False,
+        seed=None,
+        shared_memory=False,
     ):
         super().__init__()
         self.resize = transform_lib.Resize(32) if resize else None
+        self.transform = transform
 
-        self.mnist = MNIST(
-            data_dir, train=train, download=download, transform=transform
-        )
         split = "train" if train else "test"
-        self.svhn = SVHN(data_dir, split=split, download=download, transform=transform)
 
-        self.indices_mnist = torch.load(Path(data_dir) / f"{split}-ms-mnist-idx.pt")
-        self.indices_svhn = torch.load(Path(data_dir) / f"{split}-ms-svhn-idx.pt")
+        if shared_memory:
+            # Decoded arrays are mapped from shared memory, which is shared by all
+            # runs and workers on this host
+            # Rebuilt whenever the source files change
+            key = files_key(self._source_files(data_dir, split))
+            self.arrays = shared_arrays(
+                f"mnist_svhn-{split}-{path_key(data_dir)}-{key}",
+                lambda: self._load_arrays(data_dir, split, download),
+            )
+            self.indices_mnist = self.arrays["indices_mnist"]
+            self.indices_svhn = self.arrays["indices_svhn"]
+
+        else:
+            self.arrays = None
+            self.mnist = MNIST(
+                data_dir, train=train, download=download, transform=transform
+            )
+            self.svhn = SVHN(
+                data_dir, split=split, download=download, transform=transform
+            )
+
+            self.indices_mnist = torch.load(Path(data_dir) / f"{split}-ms-mnist-idx.pt")
+            self.indices_svhn = torch.load(Path(data_dir) / f"{split}-ms-svhn-idx.pt")
 
         assert len(self.indices_mnist) == len(
             self.indices_svhn
@@ -39,33 +71,99 @@ class MNIST_SVHN(Dataset):
         self.dataset_len = len(self.indices_mnist)
 
         # Create boolean tensor of data points that are to be paired
-        self.paired = torch.rand(self.dataset_len) <= paired_prop
+        generator = None if seed is None else torch.Generator().manual_seed(seed)
+        self.paired = torch.rand(self.dataset_len, generator=generator) <= paired_prop
+
+    @staticmethod
+    def _source_files(data_dir, split):
+        """Files the arrays of `split` are decoded from"""
+        data_dir = Path(data_dir)
+        mnist_files = sorted(p for p in (data_dir / "MNIST").rglob("*") if p.is_file())
+
+        return [
+            *mnist_files,
+            data_dir / f"{split}_32x32.mat",
+            data_dir / f"{split}-ms-mnist-idx.pt",
+            data_dir / f"{split}-ms-svhn-idx.pt",
+        ]
+
+    @staticmethod
+    def _load_arrays(data_dir, split, download):
+        mnist = MNIST(data_dir, train=split == "train", download=download)
+        svhn = SVHN(data_dir, split=split, download=download)
+
+        return {
+            "mnist": mnist.data.numpy(),  # [N, 28, 28], uint8
+            "mnist_labels": mnist.targets.numpy(),
+            "svhn": svhn.data,  # [N, 3, 32, 32], uint8
+            "svhn_labels": svhn.labels,
+            "indices_mnist": np.asarray(
+                torch.load(Path(data_dir) / f"{split}-ms-mnist-idx.pt")
+            ),
+            "indices_svhn": np.asarray(
+                torch.load(Path(data_dir) / f"{split}-ms-svhn-idx.pt")
+            ),
+        }
+
+    def _get_mnist(self, idx):
+        if self.arrays is None:
+            return self.mnist[idx]
+
+        # Same as `MNIST.__getitem__`
+        img = Image.fromarray(np.asarray(self.arrays["mnist"][idx]), mode="L")
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, int(self.arrays["mnist_labels"][idx])
+
+    def _get_svhn(self, idx):
+        if self.arrays is None:
+            return self.svhn[idx]
+
+        # Same as `SVHN.__getitem__`
+        img = Image.fromarray(np.transpose(self.arrays["svhn"][idx], (1, 2, 0)))
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, int(self.arrays["svhn_labels"][idx])
 
     def __len__(self):
         return self.dataset_len
 
     def __getitem__(self, idx):
         idx1, idx2 = self.indices_mnist[idx], self.indices_svhn[idx]
-        assert self.mnist[idx1][1] == self.svhn[idx2][1], "Something evil has happened!"
+        mnist, mnist_label = self._get_mnist(idx1)
+        svhn, label = self._get_svhn(idx2)
+        assert mnist_label == label, "Something evil has happened!"
 
-        mnist = self.mnist[idx1][0]
         if self.resize:
             mnist = self.resize(mnist)
 
-        svhn = self.svhn[idx2][0]
-        label = self.svhn[idx2][1]
-
         # Whether this data point is to be paired
         paired = self.paired[idx]
 
         return {"data": [mnist, svhn], "label": label, "paired": paired}
 
 
-class MNIST_SVHN_DataModule(LightningDataModule):
+class MNIST_SVHN_DataModule(
+    BatchTransformMixin, DevicePrefetchMixin, TunedLoaderMixin, LightningDataModule
+):
     """Paired MNIST - SVHN multimodal dataset.
 
     Training set size: 1,682,040
     Test set size: 300,000
+
+    If `batch_transforms`, items are uint8 tensors that are scaled (and resized)
+    per batch, on the device if `batch_transforms_on_device`.
+
+    If `n_paired_per_batch` is set, every training batch starts with exactly that
+    many paired data points, followed by unpaired ones.
+
+    If `shared_memory`, the decoded datasets are mapped from shared memory, shared
+    by all runs and workers on the host.
+
+    If `prefetch_depth` > 0, the next batches are moved to the device in the
+    background, see `DevicePrefetcher`.
     """
 
     def __init__(
@@ -73,23 +171,40 @@ class MNIST_SVHN_DataModule(LightningDataModule):
         data_dir: str,
         batch_size: int = 32,
         val_split: int = 50_000,
-        num_workers: int = 16,
+        num_workers: int = None,
         seed: int = 42,
         paired_prop=1.0,
         resize=False,
+        batch_transforms=False,
+        batch_transforms_on_device=True,
+        n_paired_per_batch=None,
+        shared_memory=False,
+        prefetch_depth=0,
     ):
         super().__init__()
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.val_split = val_split
-        self.num_workers = num_workers
+        self.init_loader_settings(num_workers=num_workers)
         self.seed = seed
         self.paired_prop = paired_prop
         self.resize = resize
+        self.n_paired_per_batch = n_paired_per_batch
+        self.shared_memory = shared_memory
+        self.prefetch_depth = prefetch_depth
 
         # Number of class labels for each modality
         self.n_classes = 10
-        self.transform = transform_lib.ToTensor()
+
+        self.batch_transforms_on_device = batch_transforms_on_device
+        if batch_transforms:
+            self.batch_transforms = self._default_batch_transforms()
+            self.transform = transform_lib.PILToTensor()
+            # Resizing is done per batch
+            self.item_resize = False
+        else:
+            self.transform = transform_lib.ToTensor()
+            self.item_resize = resize
 
     def prepare_data(self):
         # Download
@@ -103,7 +218,9 @@ class MNIST_SVHN_DataModule(LightningDataModule):
                 train=True,
                 transform=self.transform,
                 paired_prop=self.paired_prop,
-                resize=self.resize,
+                resize=self.item_resize,
+                seed=self.seed,
+                shared_memory=self.shared_memory,
             )
             self.train_set, self.val_set = random_split(
                 dataset,
@@ -111,16 +228,33 @@ class MNIST_SVHN_DataModule(LightningDataModule):
                 generator=torch.Generator().manual_seed(self.seed),
             )
 
+            # Resumable shuffling, see `MVAE_Experiment.on_save_checkpoint`
+            if self.n_paired_per_batch is None:
+                self.train_sampler = RandomBatchSampler(
+                    len(self.train_set), self.batch_size, seed=self.seed
+                )
+            else:
+                self.train_sampler = PairedBatchSampler(
+                    get_paired_mask(self.train_set),
+                    self.batch_size,
+                    self.n_paired_per_batch,
+                    seed=self.seed,
+                )
+
             # Infer dimension of dataset
-            self.dims = [tuple(modality.shape) for modality in self.val_set[0]["data"]]
+            self.dims = self.transformed_dims(self.val_set[0])
 
         if stage == "test" or stage is None:
             self.test_set = MNIST_SVHN(
-                self.data_dir, train=False, transform=self.transform, resize=self.resize
+                self.data_dir,
+                train=False,
+                transform=self.transform,
+                resize=self.item_resize,
+                shared_memory=self.shared_memory,
             )
 
             # Infer dimension of dataset
-            self.dims = [tuple(modality.shape) for modality in self.test_set[0]["data"]]
+            self.dims = self.transformed_dims(self.test_set[0])
 
         self.likelihood_weights = (
             np.prod(self.dims[1]) / np.prod(self.dims[0]),
@@ -128,31 +262,47 @@ class MNIST_SVHN_DataModule(LightningDataModule):
         )
 
     def train_dataloader(self):
-        return DataLoader(
-            self.train_set,
-            batch_size=self.batch_size,
-            shuffle=True,
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.train_set,
+                batch_sampler=self.train_sampler,
+                collate_fn=(
+                    None
+                    if self.n_paired_per_batch is None
+                    else PairedCollate(self.n_paired_per_batch)
+                ),
+                **self.loader_kwargs(),
+            )
         )
 
     def val_dataloader(self):
-        return DataLoader(
-            self.val_set,
-            batch_size=self.batch_size,
-            shuffle=False,
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.val_set,
+                batch_size=self.batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
         )
 
     def test_dataloader(self):
-        return DataLoader(
-            self.test_set,
-            batch_size=16,
-            shuffle=False,
-            num_workers=self.num_workers,
-            drop_last=False,
-            pin_memory=True,
+        return self.prefetch(
+            DataLoader(
+                self.test_set,
+                batch_size=self.test_batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
         )
+
+    def _default_batch_transforms(self):
+        mnist_transforms = [batch_transform_lib.ToFloat()]
+        if self.resize:
+            mnist_transforms.append(batch_transform_lib.Resize(32))
+
+        return [
+            batch_transform_lib.Compose(mnist_transforms),
+            batch_transform_lib.ToFloat(),
+        ]
@@ -2,6 +2,9 @@
 """
 import torch
 from pytorch_lightning import LightningDataModule
+from src.datamodules import transforms as batch_transform_lib
+from src.datamodules.autotune import TunedLoaderMixin
+from src.datamodules.transforms import BatchTransformMixin
 from torch.utils.data import DataLoader, random_split
 from torchvision import transforms as transform_lib
 from torchvision.datasets import MNIST
@@ -14,7 +17,9 @@ class MultimodalMNIST(MNIST):
         return dict(data=[img, target])
 
 
-class MultimodalMNISTDataModule(LightningDataModule):
+class MultimodalMNISTDataModule(
+    BatchTransformMixin, TunedLoaderMixin, LightningDataModule
+):
 
     name = "mnist"
 
@@ -23,9 +28,11 @@ class MultimodalMNISTDataModule(LightningDataModule):
         data_dir: str,
         batch_size: int = 64,
         val_split: int = 10_000,
-        num_workers: int = 16,
+        num_workers: int = None,
         normalize: bool = False,
         seed: int = 42,
+        batch_transforms: bool = False,
+        batch_transforms_on_device: bool = True,
         *args,
         **kwargs,
     ):
@@ -49,17 +56,26 @@ class MultimodalMNISTDataModule(LightningDataModule):
         Args:
             data_dir: where to save/load the data
             val_split: how many of the training images to use for the validation split
-            num_workers: how many workers to use for loading data
+            num_workers: how many workers to use for loading data, by default
+                from the host loader profile, see `src.datamodules.autotune`
             normalize: If true applies image normalize
+            batch_transforms: If true only converts to uint8 tensors per item,
+                and scales / normalizes whole batches after collation
+            batch_transforms_on_device: If true applies batch transforms after
+                the batch is moved to the device
         """
         super().__init__(*args, **kwargs)
         self.dims = (1, 28, 28)
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.val_split = val_split
-        self.num_workers = num_workers
+        self.init_loader_settings(num_workers=num_workers)
         self.normalize = normalize
         self.seed = seed
+        self.batch_transforms_on_device = batch_transforms_on_device
+        self.batch_transforms = (
+            self._default_batch_transforms() if batch_transforms else None
+        )
 
     @property
     def num_classes(self):
@@ -124,9 +140,8 @@ class MultimodalMNISTDataModule(LightningDataModule):
             self.train_set,
             batch_size=self.batch_size,
             shuffle=True,
-            num_workers=self.num_workers,
             drop_last=True,
-            pin_memory=True,
+            **self.loader_kwargs(),
         )
 
     def val_dataloader(self, transforms=None):
@@ -139,9 +154,8 @@ class MultimodalMNISTDataModule(LightningDataModule):
             self.val_set,
             batch_size=self.batch_size,
             shuffle=False,
-            num_workers=self.num_workers,
             drop_last=True,
-            pin_memory=True,
+            **self.loader_kwargs(),
         )
 
     def test_dataloader(self, transforms=None):
@@ -152,15 +166,17 @@ class MultimodalMNISTDataModule(LightningDataModule):
         """
         return DataLoader(
             self.test_set,
-            batch_size=16,
+            batch_size=self.test_batch_size,
             shuffle=False,
-            num_workers=self.num_workers,
             drop_last=True,
-            pin_memory=True,
+            **self.loader_kwargs(),
         )
 
     def _default_transforms(self):
-        if self.normalize:
+        if self.batch_transforms is not None:
+            # Scaling and normalization are done per batch
+            mnist_transforms = transform_lib.PILToTensor()
+        elif self.normalize:
             mnist_transforms = transform_lib.Compose(
                 [
                     transform_lib.ToTensor(),
@@ -171,3 +187,13 @@ class MultimodalMNISTDataModule(LightningDataModule):
             mnist_transforms = transform_lib.ToTensor()
 
         return mnist_transforms
+
+    def _default_batch_transforms(self):
+        img_transforms = [batch_transform_lib.ToFloat()]
+        if self.normalize:
+            img_transforms.append(
+                batch_transform_lib.Normalize(mean=(0.5,), std=(0.5,))
+            )
+
+        # No transform for labels
+        return [batch_transform_lib.Compose(img_transforms), None]
@@ -0,0 +1,193 @@
+"""Loader wrapper that moves batches to the training device ahead of time.
+
+The next `depth` batches are copied in a background thread (on a side CUDA
+stream), overlapping the host-to-device copy with the current step. Batches
+arrive already resident, so the `.to(device)` calls in the training step and
+callbacks become no-ops.
+"""
+import queue
+import threading
+from typing import Any, Callable, Optional, Union
+
+import torch
+
+Device = Union[str, torch.device]
+
+
+def move_to_device(batch: Any, device: Device, non_blocking: bool = False) -> Any:
+    """Moves every tensor in a (nested) batch of dicts / lists / tuples"""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, dict):
+        return {
+            key: move_to_device(value, device, non_blocking)
+            for key, value in batch.items()
+        }
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(move_to_device(x, device, non_blocking) for x in batch)
+
+    return batch
+
+
+def _tensors(batch: Any):
+    if isinstance(batch, torch.Tensor):
+        yield batch
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            yield from _tensors(value)
+    elif isinstance(batch, (list, tuple)):
+        for x in batch:
+            yield from _tensors(x)
+
+
+class _Raised:
+    """Exception from the background thread, re-raised by the consumer"""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END = object()
+
+
+class DevicePrefetcher:
+    def __init__(
+        self,
+        loader,
+        device: Union[Device, Callable[[], Optional[Device]], None],
+        depth: int = 2,
+        transfer_fn: Callable[[Any, Device], Any] = None,
+    ):
+        """Iterates over `loader`, with the next `depth` batches already moved to
+        `device`
+
+        Parameters
+        ----------
+        loader : Iterable
+            Usually a `DataLoader` with `pin_memory=True`, so copies are async
+        device : Union[Device, Callable[[], Optional[Device]], None]
+            Target device, or a function returning it (resolved on every `iter`,
+            e.g. once the model has been moved). Batches are passed through as
+            is if None
+        depth : int, optional
+            Number of batches in flight, by default 2
+        transfer_fn : Callable[[Any, Device], Any], optional
+            Moves a batch to the device, by default a non-blocking
+            `move_to_device`. Can be replaced to simulate a device on CPU
+        """
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.transfer_fn = transfer_fn or (
+            lambda batch, device: move_to_device(batch, device, non_blocking=True)
+        )
+
+    def _resolve_device(self) -> Optional[torch.device]:
+        device = self.device() if callable(self.device) else self.device
+
+        return None if device is None else torch.device(device)
+
+    def _transfer(self, batch, device, stream):
+        if stream is None:
+            return self.transfer_fn(batch, device), None
+
+        with torch.cuda.stream(stream):
+            batch = self.transfer_fn(batch, device)
+            event = torch.cuda.Event()
+            event.record(stream)
+
+        return batch, event
+
+    def _produce(self, iterator, device, buffer: queue.Queue, stop):
+        stream = None
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+            stream = torch.cuda.Stream(device)
+
+        def put(item):
+            # Give up if the consumer has stopped iterating
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+
+            return False
+
+        try:
+            for batch in iterator:
+                if not put(self._transfer(batch, device, stream)):
+                    return
+        except Exception as e:
+            put(_Raised(e))
+            return
+
+        put(_END)
+
+    def __iter__(self):
+        device = self._resolve_device()
+        if device is None or self.depth < 1:
+            yield from self.loader
+            return
+
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce,
+            args=(iter(self.loader), device, buffer, stop),
+            daemon=True,
+        )
+        thread.start()
+
+        try:
+            while True:
+                item = buffer.get()
+                if item is _END:
+                    break
+                elif isinstance(item, _Raised):
+                    raise item.exception
+
+                batch, event = item
+                if event is not None:
+                    # Wait for the copy, and keep the memory from being reused
+                    # by the side stream while the main stream still needs it
+                    current_stream = torch.cuda.current_stream(device)
+                    current_stream.wait_event(event)
+                    for tensor in _tensors(batch):
+                        if tensor.is_cuda:
+                            tensor.record_stream(current_stream)
+
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Pass through e.g. `dataset`, `batch_size`, `sampler`
+        if name == "loader":
+            raise AttributeError(name)
+
+        return getattr(self.loader, name)
+
+
+class DevicePrefetchMixin:
+    """Wraps the dataloaders of a datamodule in `DevicePrefetcher`s.
+
+    `prefetch_device` is set by the experiment once the model is on its device;
+    until then (and if `prefetch_depth` is 0) loaders are returned as is.
+    """
+
+    prefetch_depth = 0
+    prefetch_device = None
+
+    def prefetch(self, loader):
+        if not self.prefetch_depth:
+            return loader
+
+        return DevicePrefetcher(
+            loader, lambda: self.prefetch_device, depth=self.prefetch_depth
+        )
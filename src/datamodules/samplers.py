@@ -0,0 +1,179 @@
+import math
+from typing import Sequence
+
+import torch
+from torch.utils.data import Dataset, Sampler, Subset
+from torch.utils.data.dataloader import default_collate
+
+
+def get_paired_mask(dataset: Dataset) -> torch.Tensor:
+    """Boolean mask of paired data points, indexed like `dataset`
+
+    Handles (nested) `Subset`s, e.g. from `random_split`.
+    """
+    if isinstance(dataset, Subset):
+        return get_paired_mask(dataset.dataset)[torch.as_tensor(dataset.indices)]
+
+    return dataset.paired
+
+
+class CheckpointableBatchSampler(Sampler):
+    """Base for batch samplers whose position can be saved and restored
+    mid-epoch.
+
+    Every epoch is a deterministic function of `seed` and `epoch`. The consumer
+    calls `advance` once a batch has been used (the DataLoader iterates ahead
+    of training), and a restored sampler continues at the next unused batch.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.epoch = 0
+        # Number of batches consumed in the current epoch
+        self.position = 0
+        self._started = False
+        self._resume = False
+
+    def _epoch_batches(self, generator) -> Sequence[torch.Tensor]:
+        """Index tensor of every batch in the current epoch"""
+        raise NotImplementedError
+
+    def advance(self, n_batches=1):
+        self.position += n_batches
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+
+        # Checkpoint was saved at the end of an epoch
+        if self.position >= len(self):
+            self.epoch += 1
+            self.position = 0
+
+        self._resume = True
+
+    def __iter__(self):
+        if self._resume:
+            self._resume = False
+        elif self._started:
+            self.epoch += 1
+            self.position = 0
+        self._started = True
+
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        batches = self._epoch_batches(generator)
+
+        return (batch.tolist() for batch in batches[self.position :])
+
+
+class RandomBatchSampler(CheckpointableBatchSampler):
+    def __init__(self, n_data: int, batch_size: int, drop_last=False, seed=0):
+        """Resumable equivalent of `shuffle=True` batching
+
+        Parameters
+        ----------
+        n_data : int
+            Size of the dataset (or `Subset`) being sampled
+        batch_size : int
+        drop_last : bool, optional
+            , by default False
+        seed : int, optional
+            , by default 0
+        """
+        super().__init__(seed)
+        self.n_data = n_data
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def _epoch_batches(self, generator) -> Sequence[torch.Tensor]:
+        # Last batch may be smaller
+        perm = torch.randperm(self.n_data, generator=generator)
+
+        return list(perm.split(self.batch_size))[: len(self)]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_data // self.batch_size
+
+        return math.ceil(self.n_data / self.batch_size)
+
+
+class PairedBatchSampler(CheckpointableBatchSampler):
+    def __init__(self, paired: torch.Tensor, batch_size: int, n_paired: int, seed=0):
+        """Yields batches with exactly `n_paired` paired data points, followed by
+        `batch_size - n_paired` unpaired ones.
+
+        Each pool is reshuffled whenever it runs out, so the (usually smaller)
+        paired pool is cycled through several times per epoch.
+
+        Parameters
+        ----------
+        paired : torch.Tensor
+            [N], boolean mask of paired data points
+        batch_size : int
+        n_paired : int
+            Number of paired data points per batch
+        seed : int, optional
+            , by default 0
+        """
+        n_unpaired = batch_size - n_paired
+
+        self.paired_indices = torch.nonzero(paired, as_tuple=True)[0]
+        self.unpaired_indices = torch.nonzero(~paired, as_tuple=True)[0]
+
+        assert 0 <= n_paired <= batch_size, "Expected 0 <= n_paired <= batch_size"
+        assert n_paired == 0 or len(self.paired_indices) > 0, "No paired data points"
+        assert (
+            n_unpaired == 0 or len(self.unpaired_indices) > 0
+        ), "No unpaired data points"
+
+        super().__init__(seed)
+        self.n_data = len(paired)
+        self.batch_size = batch_size
+        self.n_paired = n_paired
+        self.n_unpaired = n_unpaired
+
+    def _draw(self, pool: torch.Tensor, n_per_batch: int, generator) -> torch.Tensor:
+        # [n_batches, n_per_batch], from repeated permutations of `pool`
+        n_batches = len(self)
+        n_needed = n_batches * n_per_batch
+        if n_needed == 0:
+            return pool.new_empty(n_batches, 0)
+
+        n_perms = math.ceil(n_needed / len(pool))
+        perms = [
+            pool[torch.randperm(len(pool), generator=generator)]
+            for _ in range(n_perms)
+        ]
+
+        return torch.cat(perms)[:n_needed].view(n_batches, n_per_batch)
+
+    def _epoch_batches(self, generator) -> torch.Tensor:
+        return torch.cat(
+            [
+                self._draw(self.paired_indices, self.n_paired, generator),
+                self._draw(self.unpaired_indices, self.n_unpaired, generator),
+            ],
+            dim=1,
+        )
+
+    def __len__(self):
+        return self.n_data // self.batch_size
+
+
+class PairedCollate:
+    def __init__(self, n_paired: int):
+        """Collates batches from `PairedBatchSampler`,
+        adding the (static) number of leading paired data points to the batch
+        """
+        self.n_paired = n_paired
+
+    def __call__(self, items):
+        batch = default_collate(items)
+        batch["n_paired"] = self.n_paired
+
+        return batch
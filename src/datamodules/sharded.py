@@ -0,0 +1,323 @@
+"""Sharded on-disk format for multimodal datasets, with a streaming reader.
+
+Each split is a directory of `shard-XXXXX.npz` files plus an `index.json`.
+Shards are read sequentially, so datasets larger than RAM can be streamed from
+network filesystems without random reads.
+
+Convert an existing datamodule with:
+    python -m src.datamodules.sharded -c configs/celeba/mvae.yaml -o data/celeba_shards
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from pytorch_lightning import LightningDataModule
+from src.datamodules.autotune import TunedLoaderMixin
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+
+INDEX = "index.json"
+
+
+def write_shards(
+    dataset: Dataset,
+    out_dir: str,
+    shard_size: int = 10_000,
+    num_workers: int = 16,
+    metadata: Dict[str, Any] = None,
+):
+    """Writes a map-style multimodal dataset into shards of `shard_size` items
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Returns {"data": [...], (optionally) "label", "paired"} dicts
+    out_dir : str
+    shard_size : int, optional
+        , by default 10_000
+    num_workers : int, optional
+        , by default 16
+    metadata : Dict[str, Any], optional
+        Extra info stored in the index, e.g. dims and likelihood weights,
+        by default None
+
+    Raises
+    ------
+    ValueError
+        If `dataset` is empty
+    """
+    if len(dataset) == 0:
+        raise ValueError("Cannot write shards of an empty dataset")
+    n_modalities = len(dataset[0]["data"])
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    loader = DataLoader(
+        dataset, batch_size=shard_size, shuffle=False, num_workers=num_workers
+    )
+
+    shards = []
+    for shard_idx, batch in enumerate(loader):
+        arrays = {f"data_{i}": x.numpy() for i, x in enumerate(batch["data"])}
+        for key in ["label", "paired"]:
+            if key in batch:
+                arrays[key] = np.asarray(batch[key])
+
+        name = f"shard-{shard_idx:05d}.npz"
+        np.savez(out_dir / name, **arrays)
+        shards.append({"name": name, "size": len(batch["data"][0])})
+
+    index = {
+        "shards": shards,
+        "n_items": sum(shard["size"] for shard in shards),
+        "n_modalities": n_modalities,
+        "metadata": metadata or {},
+    }
+    with open(out_dir / INDEX, "w") as index_file:
+        json.dump(index, index_file, indent=2)
+
+
+def load_index(shard_dir: str) -> Dict[str, Any]:
+    with open(Path(shard_dir) / INDEX) as index_file:
+        return json.load(index_file)
+
+
+class ShardedMultimodalDataset(IterableDataset):
+    def __init__(self, shard_dir: str, shuffle=True, buffer_size=10_000, seed=0):
+        """Streams items from shards written by `write_shards`
+
+        Shards are split across distributed ranks and DataLoader workers.
+        If `shuffle`, the shard order is permuted every epoch, and items are
+        shuffled through an in-memory buffer of `buffer_size` items.
+
+        Parameters
+        ----------
+        shard_dir : str
+        shuffle : bool, optional
+            , by default True
+        buffer_size : int, optional
+            , by default 10_000
+        seed : int, optional
+            , by default 0
+        """
+        super().__init__()
+        self.shard_dir = Path(shard_dir)
+        self.index = load_index(shard_dir)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    @staticmethod
+    def _world():
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+
+        return 0, 1
+
+    def _assigned_shards(self, generator) -> List[str]:
+        shards = [shard["name"] for shard in self.index["shards"]]
+        if self.shuffle:
+            perm = torch.randperm(len(shards), generator=generator).tolist()
+            shards = [shards[i] for i in perm]
+
+        # Every rank gets the same number of shards, wrapping around if needed
+        rank, world_size = self._world()
+        shards = shards + shards[: -len(shards) % world_size]
+        shards = shards[rank::world_size]
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id :: worker_info.num_workers]
+
+        return shards
+
+    def _read_shard(self, name: str):
+        with np.load(self.shard_dir / name) as shard:
+            arrays = {key: shard[key] for key in shard.files}
+
+        n_modalities = self.index["n_modalities"]
+        data = [torch.from_numpy(arrays[f"data_{i}"]) for i in range(n_modalities)]
+        extras = {
+            key: torch.from_numpy(arrays[key])
+            for key in ["label", "paired"]
+            if key in arrays
+        }
+
+        for i in range(len(data[0])):
+            yield {
+                "data": [x[i] for x in data],
+                **{key: value[i] for key, value in extras.items()},
+            }
+
+    def __iter__(self):
+        # Same shard order on every rank / worker, so they partition the shards
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        # Different buffer shuffling on every rank / worker
+        rank, _ = self._world()
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        buffer_generator = torch.Generator().manual_seed(
+            (self.seed + self.epoch) * 1_000_003 + rank * 1_009 + worker_id
+        )
+
+        buffer = []
+        for name in self._assigned_shards(generator):
+            for item in self._read_shard(name):
+                if not self.shuffle:
+                    yield item
+                    continue
+
+                if len(buffer) < self.buffer_size:
+                    buffer.append(item)
+                    continue
+
+                # Yield a random buffered item, replacing it with the new one
+                idx = int(torch.randint(len(buffer), (1,), generator=buffer_generator))
+                yield buffer[idx]
+                buffer[idx] = item
+
+        for idx in torch.randperm(len(buffer), generator=buffer_generator).tolist():
+            yield buffer[idx]
+
+    def __len__(self):
+        _, world_size = self._world()
+
+        return self.index["n_items"] // world_size
+
+
+class ShardLoader(DataLoader):
+    """DataLoader that advances the epoch of a `ShardedMultimodalDataset`
+    before every pass (workers get a copy of the dataset on each `iter`)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._epoch = 0
+
+    def __iter__(self):
+        self.dataset.set_epoch(self._epoch)
+        self._epoch += 1
+
+        return super().__iter__()
+
+
+class ShardedMultimodalDataModule(TunedLoaderMixin, LightningDataModule):
+    """Streams a multimodal dataset from shards, see `write_shards`
+
+    `data_dir` should contain a shard directory for each split, i.e. `train`,
+    `val` and (optionally) `test`. Dataset info (`dims`, `likelihood_weights`,
+    `n_classes`) is read from the train index.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        batch_size: int = 32,
+        num_workers: int = None,
+        buffer_size: int = 10_000,
+        seed: int = 42,
+    ):
+        super().__init__()
+        self.data_dir = Path(data_dir)
+        self.batch_size = batch_size
+        self.init_loader_settings(num_workers=num_workers)
+        self.buffer_size = buffer_size
+        self.seed = seed
+
+        metadata = load_index(self.data_dir / "train")["metadata"]
+        self.dims = [tuple(dim) for dim in metadata["dims"]]
+        self.likelihood_weights = metadata.get("likelihood_weights")
+        self.n_classes = metadata.get("n_classes")
+
+    def prepare_data(self):
+        pass
+
+    def setup(self, stage=None):
+        if stage == "fit" or stage is None:
+            self.train_set = ShardedMultimodalDataset(
+                self.data_dir / "train",
+                shuffle=True,
+                buffer_size=self.buffer_size,
+                seed=self.seed,
+            )
+            self.val_set = ShardedMultimodalDataset(
+                self.data_dir / "val", shuffle=False
+            )
+
+        if stage == "test" or stage is None:
+            test_dir = self.data_dir / "test"
+            self.test_set = ShardedMultimodalDataset(
+                test_dir if test_dir.exists() else self.data_dir / "val",
+                shuffle=False,
+            )
+
+    def loader_kwargs(self):
+        # Workers hold a copy of the dataset, so they must be restarted to
+        # pick up the next epoch
+        return {**super().loader_kwargs(), "persistent_workers": False}
+
+    def train_dataloader(self):
+        return ShardLoader(
+            self.train_set,
+            batch_size=self.batch_size,
+            drop_last=True,
+            **self.loader_kwargs(),
+        )
+
+    def val_dataloader(self):
+        return ShardLoader(
+            self.val_set,
+            batch_size=self.batch_size,
+            drop_last=False,
+            **self.loader_kwargs(),
+        )
+
+    def test_dataloader(self):
+        return ShardLoader(
+            self.test_set,
+            batch_size=self.test_batch_size,
+            drop_last=False,
+            **self.loader_kwargs(),
+        )
+
+
+if __name__ == "__main__":
+    from src.utils import ConfigManager, load_yaml
+
+    parser = argparse.ArgumentParser(description="Convert a datamodule to shards")
+    parser.add_argument("--config", "-c", help="path to the config file")
+    parser.add_argument("--out_dir", "-o", help="output directory")
+    parser.add_argument("--shard_size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    datamodule = ConfigManager(load_yaml(args.config)).init_object("datamodule")
+    datamodule.prepare_data()
+    datamodule.setup()
+
+    metadata = {
+        "dims": [list(dim) for dim in datamodule.dims],
+        "likelihood_weights": [float(w) for w in datamodule.likelihood_weights],
+        "n_classes": getattr(datamodule, "n_classes", None),
+    }
+
+    for split, dataset in [
+        ("train", datamodule.train_set),
+        ("val", datamodule.val_set),
+        ("test", datamodule.test_set),
+    ]:
+        print(f"Writing {split} shards...")
+        write_shards(
+            dataset,
+            Path(args.out_dir) / split,
+            shard_size=args.shard_size,
+            num_workers=datamodule.num_workers,
+            metadata=metadata,
+        )
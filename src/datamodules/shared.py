@@ -0,0 +1,139 @@
+"""Named, read-only array segments shared across processes.
+
+Arrays are stored as .npy files under a tmpfs directory (`/dev/shm` where
+available) and memory-mapped, so every run and DataLoader worker on a host maps
+the same pages instead of loading its own copy.
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+def _default_root() -> Path:
+    shm = Path("/dev/shm")
+    base = shm if shm.is_dir() else Path(tempfile.gettempdir())
+
+    return base / "vi-lab"
+
+
+SHARED_ROOT = Path(os.environ.get("VI_LAB_SHARED_ROOT", _default_root()))
+
+# Written last, marks a segment as complete
+_MANIFEST = "_manifest.txt"
+
+
+def save_arrays(directory: Path, arrays: Dict[str, np.ndarray]):
+    """Atomically writes `arrays` as .npy files into `directory`"""
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary dir first, so concurrent readers never see partial data
+    tmp_dir = Path(tempfile.mkdtemp(dir=directory.parent))
+    for name, array in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", array)
+    (tmp_dir / _MANIFEST).write_text("\n".join(arrays))
+
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Another process got there first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_arrays(directory: Path, names: List[str] = None) -> Dict[str, np.ndarray]:
+    """Memory-maps (read-only) the arrays written by `save_arrays`"""
+    directory = Path(directory)
+    if names is None:
+        names = (directory / _MANIFEST).read_text().split("\n")
+
+    arrays = {}
+    for name in names:
+        path = directory / f"{name}.npy"
+        try:
+            array = np.load(path, mmap_mode="r")
+        except ValueError:
+            array = None
+
+        # Scalars (e.g. alphabets) are simply read into memory
+        arrays[name] = array if array is not None and array.ndim else np.load(path)
+
+    return arrays
+
+
+def path_key(path) -> str:
+    """Short stable key for a (data) directory, to name segments with"""
+    return hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()[:12]
+
+
+def files_key(paths: List[Path]) -> str:
+    """Short key of the names, sizes and modification times of files, to name
+    segments built from them, so that they are rebuilt when the files change
+    """
+    key = hashlib.sha1()
+    for path in paths:
+        path = Path(path)
+        try:
+            stat = path.stat()
+            key.update(f"{path.name}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+        except FileNotFoundError:
+            key.update(f"{path.name}:missing".encode())
+
+    return key.hexdigest()[:12]
+
+
+def is_complete(directory: Path) -> bool:
+    return (Path(directory) / _MANIFEST).exists()
+
+
+def shared_arrays(
+    key: str, build: Callable[[], Dict[str, np.ndarray]], root: Path = None
+) -> Dict[str, np.ndarray]:
+    """Attaches to the shared segment `key`, materialising it with `build` first
+    if no other process has.
+
+    Only one process builds a segment; concurrent callers wait on a file lock.
+
+    Parameters
+    ----------
+    key : str
+        Unique name of the segment
+    build : Callable[[], Dict[str, np.ndarray]]
+        Loads / decodes the arrays; only called if the segment doesn't exist
+    root : Path, optional
+        , by default `SHARED_ROOT`
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Read-only memory-mapped arrays
+    """
+    root = Path(root or SHARED_ROOT)
+    segment = root / key
+
+    if not is_complete(segment):
+        root.mkdir(parents=True, exist_ok=True)
+
+        with open(root / f"{key}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not is_complete(segment):
+                    save_arrays(segment, build())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return load_arrays(segment)
+
+
+def clear_shared_arrays(key: str = None, root: Path = None):
+    """Removes segment `key`, or all segments, freeing their memory"""
+    root = Path(root or SHARED_ROOT)
+    paths = [root / key] if key else [p for p in root.glob("*") if p.is_dir()]
+
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
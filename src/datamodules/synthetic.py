@@ -0,0 +1,322 @@
+"""Synthetic stand-ins for the multimodal datamodules, for throughput runs on
+machines without the datasets.
+
+Items have the shapes, dtypes and keys of the real datasets, and are generated
+on the fly from a seeded RNG (per index, so identical across workers and runs).
+To swap a config over, set e.g.
+
+    datamodule: datamodules.SyntheticMultimodalDataModule
+    datamodule_args:
+      preset: mnist_svhn
+      ...
+
+Arguments that only matter for real data (e.g. `data_dir`) are ignored.
+"""
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from pytorch_lightning import LightningDataModule
+from src.datamodules import transforms as batch_transform_lib
+from src.datamodules.autotune import TunedLoaderMixin
+from src.datamodules.prefetch import DevicePrefetchMixin
+from src.datamodules.samplers import (
+    PairedBatchSampler,
+    PairedCollate,
+    RandomBatchSampler,
+)
+from src.datamodules.transforms import BatchTransformMixin
+from torch.utils.data import DataLoader, Dataset
+
+# Modalities are ("image", shape), ("text", (len_sequence, alphabet_size)) or
+# ("class", n_classes), matching the items of the real datasets
+PRESETS = {
+    "mnist_svhn": {
+        "modalities": [("image", (1, 28, 28)), ("image", (3, 32, 32))],
+        "label": "class",
+        "n_classes": 10,
+        "paired": True,
+        "drop_last": False,
+        # Train (incl. val split), test
+        "sizes": (1_682_040, 300_000),
+        "val_split": 50_000,
+    },
+    "celeba": {
+        "modalities": [("image", (3, 64, 64)), ("text", (256, 71))],
+        "label": "multilabel",
+        "n_classes": 40,
+        "paired": True,
+        "drop_last": True,
+        # Train, val (also used as test)
+        "sizes": (162_770, 19_867),
+    },
+    "multimodal_mnist": {
+        "modalities": [("image", (1, 28, 28)), ("class", 10)],
+        "label": None,
+        "n_classes": 10,
+        "paired": False,
+        "drop_last": True,
+        "sizes": (60_000, 10_000),
+        "val_split": 10_000,
+    },
+}
+
+
+class SyntheticMultimodalDataset(Dataset):
+    def __init__(
+        self,
+        modalities: List[Tuple[str, Tuple]],
+        n_items: int,
+        label: str = None,
+        n_classes: int = 10,
+        paired: bool = True,
+        paired_prop=1.0,
+        uint8_images=False,
+        seed=0,
+    ):
+        """Random items of the form {"data": [...], "label", "paired"}
+
+        Parameters
+        ----------
+        modalities : List[Tuple[str, Tuple]]
+            See `PRESETS`
+        n_items : int
+        label : str, optional
+            "class" (int), "multilabel" (float {0, 1} vector) or None for no
+            label, by default None
+        n_classes : int, optional
+            , by default 10
+        paired : bool, optional
+            Whether items have a "paired" flag, by default True
+        paired_prop : float, optional
+            , by default 1.0
+        uint8_images : bool, optional
+            Images as uint8 [0, 255] (for batch transforms) instead of float
+            [0, 1], by default False
+        seed : int, optional
+            , by default 0
+        """
+        self.modalities = modalities
+        self.n_items = n_items
+        self.label = label
+        self.n_classes = n_classes
+        self.uint8_images = uint8_images
+        self.seed = seed
+
+        generator = torch.Generator().manual_seed(seed)
+        self.paired = (
+            torch.rand(n_items, generator=generator) <= paired_prop if paired else None
+        )
+
+    def _modality(self, kind, shape, generator):
+        if kind == "image":
+            if self.uint8_images:
+                return torch.randint(256, shape, generator=generator, dtype=torch.uint8)
+
+            return torch.rand(shape, generator=generator)
+        elif kind == "text":
+            # One-hot characters, [len_sequence, alphabet_size]
+            len_sequence, alphabet_size = shape
+            indices = torch.randint(alphabet_size, (len_sequence,), generator=generator)
+
+            return torch.eye(alphabet_size)[indices]
+        elif kind == "class":
+            return int(torch.randint(shape, (1,), generator=generator))
+
+        raise ValueError(f"Unknown modality kind {kind}")
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(self.seed * 1_000_003 + idx)
+
+        item = {
+            "data": [
+                self._modality(kind, shape, generator)
+                for kind, shape in self.modalities
+            ]
+        }
+
+        if self.label == "class":
+            label = torch.randint(self.n_classes, (1,), generator=generator)
+            item["label"] = int(label)
+        elif self.label == "multilabel":
+            label = torch.rand(self.n_classes, generator=generator) < 0.5
+            item["label"] = label.float()
+
+        if self.paired is not None:
+            item["paired"] = self.paired[idx]
+
+        return item
+
+    def __len__(self):
+        return self.n_items
+
+
+class SyntheticMultimodalDataModule(
+    BatchTransformMixin, DevicePrefetchMixin, TunedLoaderMixin, LightningDataModule
+):
+    """Drop-in replacement for `MNIST_SVHN_DataModule` ("mnist_svhn"),
+    `CelebaDataModule` ("celeba") and `MultimodalMNISTDataModule`
+    ("multimodal_mnist") with random data, see `PRESETS`.
+
+    Split sizes default to those of the real datasets; set `n_train`, `n_val` and
+    `n_test` for shorter epochs.
+    """
+
+    def __init__(
+        self,
+        preset: str = "mnist_svhn",
+        batch_size: int = 32,
+        val_split: int = None,
+        num_workers: int = None,
+        seed: int = 42,
+        paired_prop=1.0,
+        resize=False,
+        batch_transforms=False,
+        batch_transforms_on_device=True,
+        n_paired_per_batch=None,
+        prefetch_depth=0,
+        n_train: int = None,
+        n_val: int = None,
+        n_test: int = None,
+        **kwargs,
+    ):
+        super().__init__()
+        self.preset = preset
+        self.spec = PRESETS[preset]
+        self.batch_size = batch_size
+        self.init_loader_settings(num_workers=num_workers)
+        self.seed = seed
+        self.paired_prop = paired_prop
+        self.n_paired_per_batch = n_paired_per_batch
+        self.prefetch_depth = prefetch_depth
+
+        self.modalities = list(self.spec["modalities"])
+        if preset == "mnist_svhn" and resize:
+            self.modalities[0] = ("image", (1, 32, 32))
+
+        self.n_train, self.n_val, self.n_test = self._split_sizes(
+            val_split, n_train, n_val, n_test
+        )
+
+        self.n_classes = self.spec["n_classes"]
+
+        self.batch_transforms_on_device = batch_transforms_on_device
+        self.uint8_images = batch_transforms
+        if batch_transforms:
+            self.batch_transforms = [
+                batch_transform_lib.ToFloat() if kind == "image" else None
+                for kind, _ in self.modalities
+            ]
+
+        self.dims = [
+            shape if kind != "class" else (1,) for kind, shape in self.modalities
+        ]
+        self.likelihood_weights = self._likelihood_weights()
+
+    def _split_sizes(self, val_split, n_train, n_val, n_test):
+        size, test_size = self.spec["sizes"]
+
+        if self.preset == "celeba":
+            # Fixed train / val partitions, val is also the test set
+            default_train, default_val, default_test = size, test_size, test_size
+        else:
+            val_split = val_split if val_split is not None else self.spec["val_split"]
+            default_train, default_val, default_test = (
+                size - val_split,
+                val_split,
+                test_size,
+            )
+
+        return (
+            n_train or default_train,
+            n_val or default_val,
+            n_test or default_test,
+        )
+
+    def _likelihood_weights(self):
+        # Same as the real datamodules
+        if self.preset == "mnist_svhn":
+            return (np.prod(self.dims[1]) / np.prod(self.dims[0]), 1.0)
+        elif self.preset == "celeba":
+            return (1.0, 64 * 64 / 256)
+        else:
+            return [1.0, 50.0]
+
+    @property
+    def num_classes(self):
+        return self.n_classes
+
+    def _dataset(self, n_items, seed, paired_prop=1.0):
+        return SyntheticMultimodalDataset(
+            self.modalities,
+            n_items,
+            label=self.spec["label"],
+            n_classes=self.n_classes,
+            paired=self.spec["paired"],
+            paired_prop=paired_prop,
+            uint8_images=self.uint8_images,
+            seed=seed,
+        )
+
+    def prepare_data(self):
+        pass
+
+    def setup(self, stage=None):
+        if stage == "fit" or stage is None:
+            self.train_set = self._dataset(self.n_train, self.seed, self.paired_prop)
+            self.val_set = self._dataset(self.n_val, self.seed + 1)
+
+            # Same batching as the real datamodules
+            if self.n_paired_per_batch is None:
+                self.train_sampler = RandomBatchSampler(
+                    len(self.train_set),
+                    self.batch_size,
+                    drop_last=self.spec["drop_last"],
+                    seed=self.seed,
+                )
+            else:
+                self.train_sampler = PairedBatchSampler(
+                    self.train_set.paired,
+                    self.batch_size,
+                    self.n_paired_per_batch,
+                    seed=self.seed,
+                )
+
+        if stage == "test" or stage is None:
+            self.test_set = self._dataset(self.n_test, self.seed + 2)
+
+    def train_dataloader(self):
+        return self.prefetch(
+            DataLoader(
+                self.train_set,
+                batch_sampler=self.train_sampler,
+                collate_fn=(
+                    None
+                    if self.n_paired_per_batch is None
+                    else PairedCollate(self.n_paired_per_batch)
+                ),
+                **self.loader_kwargs(),
+            )
+        )
+
+    def val_dataloader(self):
+        return self.prefetch(
+            DataLoader(
+                self.val_set,
+                batch_size=self.batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
+        )
+
+    def test_dataloader(self):
+        return self.prefetch(
+            DataLoader(
+                self.test_set,
+                batch_size=self.test_batch_size,
+                shuffle=False,
+                drop_last=False,
+                **self.loader_kwargs(),
+            )
+        )
@@ -0,0 +1,175 @@
+"""Batch-level tensor transforms, applied after collation.
+
+Datasets only convert to (uint8) tensors per item; the rest of the pipeline
+(scaling, normalisation, cropping, resizing) runs here as a few vectorised ops
+over whole batches, optionally after the batch is moved to the training device.
+"""
+from typing import List, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+
+class ToFloat:
+    """uint8 [0, 255] -> float [0, 1]"""
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if x.is_floating_point():
+            return x
+
+        return x.float().div_(255.0)
+
+
+class Normalize:
+    def __init__(self, mean: Sequence[float], std: Sequence[float]):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        mean = self.mean.to(x.device, x.dtype)
+        std = self.std.to(x.device, x.dtype)
+
+        return (x - mean) / std
+
+
+class Crop:
+    def __init__(self, top: int, left: int, height: int, width: int):
+        self.top = top
+        self.left = left
+        self.height = height
+        self.width = width
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return x[
+            ...,
+            self.top : self.top + self.height,
+            self.left : self.left + self.width,
+        ]
+
+
+class Resize:
+    def __init__(
+        self,
+        size: Union[int, Tuple[int, int]],
+        mode: str = "bilinear",
+        antialias: bool = False,
+        clamp: bool = True,
+    ):
+        """
+        Parameters
+        ----------
+        size : Union[int, Tuple[int, int]]
+            Output (H, W); an int resizes the shorter side, as in torchvision
+        mode : str, optional
+            Interpolation mode for `F.interpolate`, by default "bilinear"
+        antialias : bool, optional
+            Match PIL when downsampling, by default False
+        clamp : bool, optional
+            Clamp to [0, 1] (bicubic overshoots), by default True
+        """
+        self.size = size
+        self.mode = mode
+        self.antialias = antialias
+        self.clamp = clamp
+
+    def _output_size(self, height, width):
+        if not isinstance(self.size, int):
+            return tuple(self.size)
+
+        if height <= width:
+            return self.size, int(self.size * width / height)
+        else:
+            return int(self.size * height / width), self.size
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        size = self._output_size(*x.shape[-2:])
+        if tuple(x.shape[-2:]) == size:
+            return x
+
+        kwargs = {"antialias": True} if self.antialias else {}
+        x = F.interpolate(
+            x,
+            size=size,
+            mode=self.mode,
+            align_corners=False if self.mode in ("bilinear", "bicubic") else None,
+            **kwargs,
+        )
+
+        return x.clamp_(0.0, 1.0) if self.clamp else x
+
+
+class Compose:
+    def __init__(self, transforms: List):
+        self.transforms = transforms
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        for transform in self.transforms:
+            x = transform(x)
+
+        return x
+
+
+class BatchTransformMixin:
+    """Applies `self.batch_transforms` to collated batches through the
+    `LightningDataModule` batch transfer hooks.
+
+    `batch_transforms` is a single transform for (x, y, ...) batches, or a list
+    with a (possibly None) transform per modality for {"data": [...]} batches.
+
+    Must come before `LightningDataModule` in the bases of a datamodule.
+    """
+
+    batch_transforms = None
+    # Whether to run the transforms after the batch is moved to the device
+    batch_transforms_on_device = True
+    # Host batch of the current transfer, see `on_after_batch_transfer`
+    _host_batch = None
+
+    def apply_batch_transforms(self, batch):
+        """Transforms the data in `batch` in place, and returns `batch`"""
+        if self.batch_transforms is None:
+            return batch
+
+        if isinstance(batch, dict):
+            batch["data"] = [
+                x if transform is None or x is None else transform(x)
+                for x, transform in zip(batch["data"], self.batch_transforms)
+            ]
+        else:
+            batch[0] = self.batch_transforms(batch[0])
+
+        return batch
+
+    def transformed_dims(self, item) -> Union[Tuple, List[Tuple]]:
+        """Shape(s) of a single dataset item after batch transforms"""
+        batch = self.apply_batch_transforms(default_collate([item]))
+
+        if isinstance(batch, dict):
+            return [tuple(x.shape[1:]) for x in batch["data"]]
+        else:
+            return tuple(batch[0].shape[1:])
+
+    def on_before_batch_transfer(self, batch, dataloader_idx: Optional[int] = None):
+        if not self.batch_transforms_on_device:
+            batch = self.apply_batch_transforms(batch)
+
+        self._host_batch = batch
+
+        return batch
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: Optional[int] = None):
+        if self.batch_transforms_on_device:
+            batch = self.apply_batch_transforms(batch)
+
+        # Callbacks receive the host batch, so hand them the transformed
+        # (device-resident) tensors as well, instead of copying them again
+        host_batch = self._host_batch
+        if isinstance(host_batch, dict) and isinstance(batch, dict):
+            host_batch.update(batch)
+        elif isinstance(host_batch, list) and isinstance(batch, (list, tuple)):
+            host_batch[:] = batch
+
+        self._host_batch = None
+
+        return batch
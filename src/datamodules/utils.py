@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 
 
@@ -13,3 +14,20 @@ def one_hot_encode(len_seq, alphabet, seq):
         if char2Index(alphabet, char) != -1:
             X[index_char, char2Index(alphabet, char)] = 1.0
     return X
+
+
+def encode_indices(len_seq, alphabet, seq):
+    """Character indices of `seq`, padded with -1 (same rules as `one_hot_encode`)"""
+    X = np.full(len_seq, -1, dtype=np.int16)
+    for index_char, char in enumerate(seq[:len_seq]):
+        X[index_char] = char2Index(alphabet, char)
+    return X
+
+
+def one_hot_from_indices(indices, n_chars):
+    """Inverse of `encode_indices`; -1 entries give all-zero rows"""
+    indices = torch.as_tensor(np.asarray(indices, dtype=np.int64))
+    X = torch.zeros(len(indices), n_chars)
+    positions = torch.nonzero(indices >= 0, as_tuple=True)[0]
+    X[positions, indices[positions]] = 1.0
+    return X
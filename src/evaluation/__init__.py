@@ -0,0 +1,10 @@
+from .cache import BIMODAL_SUBSETS, EvaluationCache, batch_cache, flatten_latents
+from .buffer import Reservoir, RingBuffer
+from .metrics import MultilabelAveragePrecision
+from .coherence import joint_coherence, wilson_interval
+from .adaptive import AdaptiveEvaluator, RunningEstimate
+from .schedule import EvalSchedule
+from .classifiers import ClassifierManager
+from .latent_store import LatentStore, checkpoint_hash, encode_to_store
+from .probes import make_probe, train_probes
+from .probe_trainer import OnlineProbeTrainer
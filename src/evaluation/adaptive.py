@@ -0,0 +1,226 @@
+import math
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import torch
+from src.evaluation.metrics import MultilabelAveragePrecision
+
+
+class RunningEstimate:
+    def __init__(self):
+        """Running mean and variance of a stream of per-item values (Welford),
+        merged batch-wise on device
+        """
+        self.n = 0
+        self.mean = None
+        self.m2 = None  # Sum of squared deviations from the mean
+
+    @torch.no_grad()
+    def update(self, values: torch.Tensor):
+        values = values.detach().double().flatten()
+        n_b = len(values)
+        if n_b == 0:
+            return
+
+        mean_b = values.mean()
+        m2_b = ((values - mean_b) ** 2).sum()
+
+        if self.mean is None:
+            self.n, self.mean, self.m2 = n_b, mean_b, m2_b
+            return
+
+        # Chan et al.'s parallel update
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+
+    def std_error(self) -> float:
+        if self.n < 2:
+            return math.inf
+
+        return math.sqrt(self.m2.item() / (self.n - 1) / self.n)
+
+    def value(self) -> float:
+        return math.nan if self.mean is None else self.mean.item()
+
+
+class AdaptiveEvaluator:
+    def __init__(
+        self,
+        tolerance: Union[None, float, Dict[str, float]],
+        relative_tolerance: Union[None, float, Dict[str, float]] = None,
+        z=1.96,
+        min_items=1_000,
+        max_items: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        check_every=10,
+    ):
+        """Streams batches through an evaluation step, keeping running estimates
+        of every metric, until the confidence intervals of all metrics are
+        narrower than their tolerance, or a budget runs out
+
+        A metric has converged once its CI is within the absolute `tolerance`,
+        or within `relative_tolerance` times its absolute value, whichever is
+        wider; relative tolerances suit metrics without a natural scale, like
+        log-likelihoods.
+
+        The stream should be shuffled, so that every prefix is a random sample.
+
+        Metrics are either means of per-item values (`add`, e.g. correctness or
+        log-likelihoods), with standard errors from their running variance, or
+        average precisions of multi-label predictions (`add_ap`), with standard
+        errors sqrt(AP (1 - AP) / n_positives) per class (Boyd et al., 2013).
+
+        Parameters
+        ----------
+        tolerance : Union[None, float, Dict[str, float]]
+            Largest CI half-width, for all metrics or per metric name (missing
+            metrics fall back to "default"), None for no absolute tolerance
+        relative_tolerance : Union[None, float, Dict[str, float]], optional
+            Largest CI half-width as a fraction of |value|, for all metrics or
+            per metric name, by default None (no relative tolerance)
+        z : float, optional
+            z-score of the CIs, by default 1.96 (95%)
+        min_items : int, optional
+            Items to evaluate before checking for convergence, by default 1_000
+        max_items : int, optional
+            , by default None (no limit)
+        max_seconds : float, optional
+            , by default None (no limit)
+        check_every : int, optional
+            Batches between convergence checks (which sync with the device),
+            by default 10
+        """
+        self.tolerance = tolerance
+        self.relative_tolerance = relative_tolerance
+        self.z = z
+        self.min_items = min_items
+        self.max_items = max_items
+        self.max_seconds = max_seconds
+        self.check_every = check_every
+
+        self.estimates: Dict[str, RunningEstimate] = {}
+        self.aps: Dict[str, MultilabelAveragePrecision] = {}
+        self.n_items = 0
+        self.stop_reason = None
+
+    def add(self, name: str, values: torch.Tensor):
+        """Per-item values of a metric, [B]"""
+        if name not in self.estimates:
+            self.estimates[name] = RunningEstimate()
+
+        self.estimates[name].update(values)
+
+    def add_ap(self, name: str, preds: torch.Tensor, targets: torch.Tensor, **kwargs):
+        """[B, C] predictions and binary targets of a multi-label AP metric,
+        see `MultilabelAveragePrecision` for `kwargs`
+        """
+        if name not in self.aps:
+            self.aps[name] = MultilabelAveragePrecision(preds.shape[1], **kwargs)
+
+        self.aps[name].update(preds, targets)
+
+    @staticmethod
+    def _lookup(
+        tolerance: Union[None, float, Dict[str, float]], name: str
+    ) -> Optional[float]:
+        if isinstance(tolerance, dict):
+            return tolerance.get(name, tolerance.get("default"))
+
+        return tolerance
+
+    def _within_tolerance(self, name: str, result: Dict[str, float]) -> bool:
+        half_width = result["ci_half_width"]
+        tolerance = self._lookup(self.tolerance, name)
+        relative_tolerance = self._lookup(self.relative_tolerance, name)
+
+        if tolerance is not None and half_width <= tolerance:
+            return True
+
+        return (
+            relative_tolerance is not None
+            and half_width <= relative_tolerance * abs(result["value"])
+        )
+
+    def results(self) -> Dict[str, Dict[str, float]]:
+        """{name: {"value", "std_error", "ci_half_width"}} of every metric"""
+        results = {}
+
+        for name, estimate in self.estimates.items():
+            std_error = estimate.std_error()
+            results[name] = {
+                "value": estimate.value(),
+                "std_error": std_error,
+                "ci_half_width": self.z * std_error,
+            }
+
+        for name, ap in self.aps.items():
+            class_aps, mean_ap = ap.compute()
+            n_pos = ap.n_positives()
+
+            # Mean AP's error from the per-class errors, assumed independent
+            valid = n_pos > 0
+            class_var = class_aps * (1 - class_aps) / n_pos.clamp(min=1)
+            std_error = class_var[valid].sum().sqrt() / valid.sum().clamp(min=1)
+
+            results[name] = {
+                "value": mean_ap.item(),
+                "std_error": std_error.item(),
+                "ci_half_width": self.z * std_error.item(),
+            }
+
+        return results
+
+    def not_converged(self, results: Optional[Dict] = None) -> List[str]:
+        """Names of the metrics whose CIs are still wider than their tolerance"""
+        results = self.results() if results is None else results
+
+        return [
+            name
+            for name, result in results.items()
+            if not self._within_tolerance(name, result)
+        ]
+
+    def converged(self) -> bool:
+        if self.n_items < self.min_items:
+            return False
+
+        return not self.not_converged()
+
+    def run(
+        self, batches: Iterable, step: Callable[[object, "AdaptiveEvaluator"], int]
+    ) -> Dict[str, Dict[str, float]]:
+        """Calls `step(batch, self)` on every batch until converged or out of
+        budget; `step` adds its metrics and returns the number of items
+
+        Returns `results()`, plus the number of items evaluated, why it stopped,
+        and the metrics that hadn't converged ("not_converged")
+        """
+        start_time = time.perf_counter()
+        self.stop_reason = "exhausted"
+
+        for i, batch in enumerate(batches):
+            self.n_items += step(batch, self)
+
+            if self.max_items is not None and self.n_items >= self.max_items:
+                self.stop_reason = "max_items"
+                break
+            if (
+                self.max_seconds is not None
+                and time.perf_counter() - start_time >= self.max_seconds
+            ):
+                self.stop_reason = "max_seconds"
+                break
+            if (i + 1) % self.check_every == 0 and self.converged():
+                self.stop_reason = "converged"
+                break
+
+        results = self.results()
+        not_converged = self.not_converged(results)
+        results["n_items"] = self.n_items
+        results["stop_reason"] = self.stop_reason
+        results["not_converged"] = not_converged
+
+        return results
@@ -0,0 +1,131 @@
+from typing import Optional, Tuple
+
+import torch
+
+
+class RingBuffer:
+    def __init__(self, capacity: int):
+        """Latest `capacity` rows of one or more tensors (e.g. detached latents and
+        their labels), preallocated on the device of the first push
+
+        Parameters
+        ----------
+        capacity : int
+            Number of rows (data points) kept
+        """
+        self.capacity = capacity
+
+        self.buffers: Optional[Tuple[torch.Tensor, ...]] = None
+        self.position = 0  # Next row to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, *tensors: torch.Tensor):
+        """Writes tensors of shape [B, ...], overwriting the oldest rows"""
+        if self.buffers is None:
+            self.buffers = tuple(
+                torch.empty(
+                    (self.capacity, *t.shape[1:]), dtype=t.dtype, device=t.device
+                )
+                for t in tensors
+            )
+
+        # Only the latest rows fit
+        n = min(len(tensors[0]), self.capacity)
+        index = torch.arange(
+            self.position, self.position + n, device=self.buffers[0].device
+        )
+        index = index % self.capacity
+
+        for buffer, t in zip(self.buffers, tensors):
+            buffer.index_copy_(0, index, t[-n:].detach())
+
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        """Filled rows of each tensor, in no particular order"""
+        return tuple(buffer[: self.size] for buffer in self.buffers)
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+
+
+class Reservoir:
+    def __init__(self, capacity: int, seed=0):
+        """Uniform random sample of `capacity` rows of one or more tensors (e.g.
+        latents and their labels) from a stream of batches, preallocated on the
+        device of the first push
+
+        Equivalent to sequential reservoir sampling (Algorithm R), vectorised
+        over each batch.
+
+        Parameters
+        ----------
+        capacity : int
+            Number of rows (data points) kept
+        seed : int, optional
+            , by default 0
+        """
+        self.capacity = capacity
+        self.seed = seed
+
+        self.buffers: Optional[Tuple[torch.Tensor, ...]] = None
+        self.generator = None
+        self.n_seen = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, *tensors: torch.Tensor):
+        """Offers tensors of shape [B, ...], replacing random rows"""
+        device = tensors[0].device
+
+        if self.buffers is None:
+            self.buffers = tuple(
+                torch.empty((self.capacity, *t.shape[1:]), dtype=t.dtype, device=device)
+                for t in tensors
+            )
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+
+        n = len(tensors[0])
+        # Position of each row in the stream
+        positions = torch.arange(self.n_seen, self.n_seen + n, device=device)
+
+        # Row i goes to slot j ~ U{0, ..., i}, and is kept if j < capacity
+        uniform = torch.rand(n, generator=self.generator, device=device)
+        slots = torch.where(
+            positions < self.capacity,
+            positions,
+            (uniform * (positions + 1)).long(),
+        )
+        rows = (slots < self.capacity).nonzero().squeeze(1)
+
+        # Of rows going to the same slot, the last one wins, as if sequential
+        order = (slots[rows] * n + rows).argsort()
+        rows = rows[order]
+        is_last = torch.ones_like(rows, dtype=torch.bool)
+        is_last[:-1] = slots[rows[1:]] != slots[rows[:-1]]
+        rows = rows[is_last]
+
+        for buffer, t in zip(self.buffers, tensors):
+            buffer.index_copy_(0, slots[rows], t[rows].detach())
+
+        self.n_seen += n
+        self.size = min(self.n_seen, self.capacity)
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        """Sampled rows of each tensor, in no particular order"""
+        return tuple(buffer[: self.size] for buffer in self.buffers)
+
+    def clear(self):
+        self.n_seen = 0
+        self.size = 0
+
+        if self.generator is not None:
+            self.generator.manual_seed(self.seed)
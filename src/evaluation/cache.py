@@ -0,0 +1,96 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+# Subsets of modalities, as modality indices, in the order of the linear probes
+BIMODAL_SUBSETS = [(0,), (1,), (0, 1)]
+
+
+def flatten_latents(latents: Any) -> torch.Tensor:
+    """Latents returned by `model.encode` as a single [..., Z] tensor,
+    concatenating the present modality-specific and the shared latents of
+    partitioned models
+    """
+    if isinstance(latents, dict):
+        m_latents = latents["m"]
+        s_latent = latents["s"]
+
+        return torch.cat([l for l in m_latents if l is not None] + [s_latent], dim=-1)
+
+    return latents
+
+
+class EvaluationCache:
+    def __init__(self, model: nn.Module, inputs: List[Optional[torch.Tensor]]):
+        """Lazily computed, memoised encodings / decodings of one batch, so that
+        callbacks evaluating the same batch encode it only once between them
+
+        Everything is computed without gradients.
+
+        Parameters
+        ----------
+        model : nn.Module
+            Multimodal VAE, with `encode` and `decode`
+        inputs : List[Optional[torch.Tensor]]
+            Batch of each modality
+        """
+        self.model = model
+        self.inputs = inputs
+
+        self._latents = {}
+        self._decodings = {}
+
+    def latents(self, subset: Tuple[int, ...]) -> Any:
+        """z ~ q(z|x_subset), as returned by `model.encode`"""
+        if subset not in self._latents:
+            xs = [x if i in subset else None for i, x in enumerate(self.inputs)]
+
+            with torch.no_grad():
+                self._latents[subset] = self.model.encode(xs)
+
+        return self._latents[subset]
+
+    def representation(self, subset: Tuple[int, ...]) -> torch.Tensor:
+        """Latents as a single [B, Z] tensor, concatenating the present
+        modality-specific and the shared latents of partitioned models
+        """
+        return flatten_latents(self.latents(subset))
+
+    def representations(self, subsets=BIMODAL_SUBSETS) -> List[torch.Tensor]:
+        return [self.representation(subset) for subset in subsets]
+
+    def decode(self, subset: Tuple[int, ...], mean=True) -> List[torch.Tensor]:
+        """x ~ p(x|z), z ~ q(z|x_subset), for every modality"""
+        key = (subset, mean)
+
+        if key not in self._decodings:
+            with torch.no_grad():
+                self._decodings[key] = self.model.decode(self.latents(subset), mean)
+
+        return self._decodings[key]
+
+    def cross_reconstructions(self, mean=True) -> List[torch.Tensor]:
+        """[x <- z_y, y <- z_x], as `model.cross_reconstruct`, but reusing the
+        unimodal latents
+        """
+        # FIXME Only assuming two modalities
+        return [self.decode((1,), mean)[0], self.decode((0,), mean)[1]]
+
+
+def batch_cache(pl_module, batch: Dict[Any, Any]) -> EvaluationCache:
+    """`EvaluationCache` of `batch`, shared by all callbacks seeing the same batch
+    object in their hooks
+    """
+    cache = getattr(pl_module, "_evaluation_cache", None)
+
+    if cache is None or cache.batch is not batch:
+        device = pl_module.device
+        inputs = [None if x is None else x.to(device) for x in batch["data"]]
+
+        cache = EvaluationCache(pl_module.model, inputs)
+        # Keeps the batch alive, so its identity can't be reused by the next one
+        cache.batch = batch
+        pl_module._evaluation_cache = cache
+
+    return cache
@@ -0,0 +1,115 @@
+import functools
+from pathlib import Path
+from typing import Callable, Dict
+
+import torch
+import torch.nn as nn
+from src.models.celeba import (
+    CelebaImgClassifier,
+    CelebaTextClassifier,
+    fuse_for_inference,
+)
+from src.models.classifiers import MNIST_Classifier, SVHN_Classifier
+
+# Pretrained evaluation classifiers, paths to their weights, and input shapes
+CLASSIFIERS = {
+    "mnist": (
+        MNIST_Classifier,
+        Path("saved") / "mnist_svhn" / "mnist_model.pt",
+        (1, 28, 28),
+    ),
+    "svhn": (
+        SVHN_Classifier,
+        Path("saved") / "mnist_svhn" / "svhn_model.pt",
+        (3, 32, 32),
+    ),
+    "celeba_img": (
+        CelebaImgClassifier,
+        Path("saved") / "celeba" / "clf_m1",
+        (3, 64, 64),
+    ),
+    "celeba_text": (
+        CelebaTextClassifier,
+        Path("saved") / "celeba" / "clf_m2",
+        (256, 71),
+    ),
+}
+
+
+class ClassifierManager:
+    _instance = None
+
+    def __init__(self, half=True, fuse=True):
+        """Loads every evaluation classifier once per process, lazily at first
+        use, and moves it to the device of the inputs it classifies
+
+        Use the shared instance, `ClassifierManager.get()`, so that callbacks
+        don't each load their own copies.
+
+        Parameters
+        ----------
+        half : bool, optional
+            Whether to run classifiers in half precision on CUDA, by default True
+        fuse : bool, optional
+            Whether to fold batch norms into convolutions and remove dropout
+            (see `src.models.celeba.fuse_for_inference`), checked against the
+            original classifier on a random batch, by default True
+        """
+        self.half = half
+        self.fuse = fuse
+        self.classifiers: Dict[str, nn.Module] = {}
+
+    @classmethod
+    def get(cls) -> "ClassifierManager":
+        """Shared instance"""
+        if cls._instance is None:
+            cls._instance = cls()
+
+        return cls._instance
+
+    def classifier(self, name: str, device: torch.device) -> nn.Module:
+        """Classifier `name`, in eval mode, on `device`"""
+        if name not in self.classifiers:
+            classifier_class, weights_path, input_shape = CLASSIFIERS[name]
+
+            classifier = classifier_class()
+            classifier.load_state_dict(torch.load(weights_path, map_location="cpu"))
+            classifier.eval()
+
+            if self.fuse:
+                example_input = torch.rand(8, *input_shape)
+                classifier = fuse_for_inference(classifier, example_input)
+            self.classifiers[name] = classifier
+
+        classifier = self.classifiers[name]
+        dtype = torch.float16 if self.half and device.type == "cuda" else torch.float32
+
+        parameter = next(classifier.parameters())
+        if parameter.device != device or parameter.dtype != dtype:
+            classifier.to(device=device, dtype=dtype)
+
+        return classifier
+
+    @torch.no_grad()
+    def predict(self, name: str, x: torch.Tensor) -> torch.Tensor:
+        """Outputs of classifier `name` for a batch `x`, in float32"""
+        classifier = self.classifier(name, x.device)
+        dtype = next(classifier.parameters()).dtype
+
+        return classifier(x.to(dtype)).float()
+
+    def predictor(self, name: str) -> Callable[[torch.Tensor], torch.Tensor]:
+        """`predict` of classifier `name`, as a function of the batch"""
+        return functools.partial(self.predict, name)
+
+    def offload(self):
+        """Moves all loaded classifiers to CPU (e.g. between evaluations), freeing
+        device memory for training
+
+        They keep their precision, so moving back is cheap and lossless.
+        """
+        for classifier in self.classifiers.values():
+            classifier.to(device="cpu")
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,83 @@
+import math
+from typing import Callable, Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+
+def wilson_interval(successes: int, n: int, z=1.96) -> Tuple[float, float]:
+    """Wilson score interval of a binomial proportion, 95% by default"""
+    if n == 0:
+        return 0.0, 1.0
+
+    p = successes / n
+    denom = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denom
+    half_width = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denom
+
+    return max(center - half_width, 0.0), min(center + half_width, 1.0)
+
+
+def joint_coherence(
+    model: nn.Module,
+    classifiers: List[Callable[[torch.Tensor], torch.Tensor]],
+    n_samples=10_000,
+    chunk_size=1_000,
+    seed=0,
+) -> Dict[str, float]:
+    """Fraction of joint samples z ~ p(z), x_i ~ p(x_i|z) whose predicted classes
+    agree across all modalities
+
+    Samples are generated and classified in chunks of `chunk_size`, with counts
+    kept on device, and with a fixed `seed` so that the same latents are drawn
+    every time (without touching the global RNG state).
+
+    Parameters
+    ----------
+    model : nn.Module
+        Multimodal VAE, with `sample`
+    classifiers : List[Callable[[torch.Tensor], torch.Tensor]]
+        Classifier of each modality (e.g. `ClassifierManager.predictor`)
+    n_samples : int, optional
+        , by default 10_000
+    chunk_size : int, optional
+        , by default 1_000
+    seed : int, optional
+        , by default 0
+
+    Returns
+    -------
+    Dict[str, float]
+        {"joint_coherence", "joint_coherence_ci_low", "joint_coherence_ci_high"},
+        with a 95% Wilson interval
+    """
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+
+    correct = torch.zeros((), dtype=torch.long, device=device)
+
+    devices = [device] if device.type == "cuda" else []
+    with torch.random.fork_rng(devices=devices), torch.no_grad():
+        torch.manual_seed(seed)
+
+        for start in range(0, n_samples, chunk_size):
+            samples = model.sample(min(chunk_size, n_samples - start), mean=True)
+
+            # Get predictions
+            preds = [clf(x).argmax(dim=1) for clf, x in zip(classifiers, samples)]
+
+            # Evaluate correct samples
+            agree = torch.stack([p == preds[0] for p in preds[1:]]).all(0)
+            correct += agree.sum()
+
+    model.train(was_training)
+
+    correct = correct.item()
+    ci_low, ci_high = wilson_interval(correct, n_samples)
+
+    return {
+        "joint_coherence": correct / n_samples,
+        "joint_coherence_ci_low": ci_low,
+        "joint_coherence_ci_high": ci_high,
+    }
@@ -0,0 +1,194 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .cache import BIMODAL_SUBSETS, flatten_latents
+
+
+def checkpoint_hash(checkpoint_path: str, length=16) -> str:
+    """SHA-256 of the contents of a checkpoint, so that stores follow the
+    weights rather than the path
+    """
+    digest = hashlib.sha256()
+    with open(checkpoint_path, "rb") as checkpoint_file:
+        for chunk in iter(lambda: checkpoint_file.read(2 ** 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:length]
+
+
+def subset_name(subset: Tuple[int, ...]) -> str:
+    return "_".join(str(i) for i in subset)
+
+
+class LatentStore:
+    def __init__(self, path: Path):
+        """Posterior means, samples and labels of one dataset split, encoded with
+        one checkpoint, as memory-mapped .npy files (see `encode_to_store`)
+
+        Layout:
+            {root}/{checkpoint hash}/{split}/
+                meta.json
+                label.npy                [N] or [N, C]
+                {subset}_mean.npy        [N, Z_subset]
+                {subset}_sample.npy      [N, Z_subset]
+            where subsets are named by their modality indices, e.g. "0_1"
+
+        Parameters
+        ----------
+        path : Path
+            Directory of the split
+        """
+        self.path = Path(path)
+
+        with open(self.path / "meta.json") as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.n_items = self.meta["n_items"]
+        self.subsets = [tuple(subset) for subset in self.meta["subsets"]]
+
+    @staticmethod
+    def path_for(root: Path, checkpoint_path: str, split: str) -> Path:
+        return Path(root) / checkpoint_hash(checkpoint_path) / split
+
+    @classmethod
+    def exists(cls, path: Path) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    def _load(self, name: str) -> np.ndarray:
+        # Arrays are preallocated for the whole dataset; only `n_items` are filled
+        return np.load(self.path / f"{name}.npy", mmap_mode="r")[: self.n_items]
+
+    def labels(self) -> np.ndarray:
+        return self._load("label")
+
+    def latents(self, subset: Tuple[int, ...], field="mean") -> np.ndarray:
+        """[N, Z] memory-mapped latents conditioned on `subset` of modalities
+
+        Parameters
+        ----------
+        subset : Tuple[int, ...]
+        field : str, optional
+            "mean" (posterior mean) or "sample" (one posterior sample),
+            by default "mean"
+        """
+        if field not in ["mean", "sample"]:
+            raise ValueError(f"Unknown field {field}")
+
+        return self._load(f"{subset_name(subset)}_{field}")
+
+
+class _StoreWriter:
+    """Writes rows of named arrays into .npy memmaps of `capacity` rows, created
+    at the first write
+    """
+
+    def __init__(self, path: Path, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.arrays: Dict[str, np.memmap] = {}
+        self.n_items = 0
+
+    def write(self, rows: Dict[str, torch.Tensor]):
+        n = None
+        for name, tensor in rows.items():
+            tensor = tensor.detach().cpu().numpy()
+            n = len(tensor)
+
+            if name not in self.arrays:
+                self.arrays[name] = np.lib.format.open_memmap(
+                    self.path / f"{name}.npy",
+                    mode="w+",
+                    dtype=tensor.dtype,
+                    shape=(self.capacity, *tensor.shape[1:]),
+                )
+
+            self.arrays[name][self.n_items : self.n_items + n] = tensor
+
+        self.n_items += n
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+
+
+@torch.no_grad()
+def encode_to_store(
+    model: nn.Module,
+    loader: Iterable,
+    path: Path,
+    prepare_batch: Callable[[Any], Any],
+    subsets: Sequence[Tuple[int, ...]] = BIMODAL_SUBSETS,
+    n_mean_samples=16,
+    meta: Optional[Dict] = None,
+) -> LatentStore:
+    """Encodes every batch of `loader` once, conditioned on each subset of
+    modalities, and writes a `LatentStore` to `path`
+
+    Posterior means are Monte Carlo means of `n_mean_samples` samples, as the
+    posteriors of flow-based and hierarchical models have no closed-form mean;
+    the first of these samples is stored as the posterior sample.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Multimodal VAE, with `encode(inputs, num_samples)`
+    loader : Iterable
+        Batches with "data" and "label", e.g. `datamodule.val_dataloader()`
+    path : Path
+    prepare_batch : Callable[[Any], Any]
+        Moves a batch to the device of the model, and transforms it
+    subsets : Sequence[Tuple[int, ...]], optional
+        , by default BIMODAL_SUBSETS
+    n_mean_samples : int, optional
+        , by default 16
+    meta : Dict, optional
+        Extra metadata, e.g. the checkpoint path, by default None
+
+    Returns
+    -------
+    LatentStore
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    was_training = model.training
+    model.eval()
+
+    writer = _StoreWriter(path, capacity=len(loader.dataset))
+    for batch in loader:
+        batch = prepare_batch(batch)
+        rows = {"label": batch["label"]}
+
+        for subset in subsets:
+            xs = [x if i in subset else None for i, x in enumerate(batch["data"])]
+            # [B, K, Z]
+            latents = flatten_latents(model.encode(xs, num_samples=n_mean_samples))
+
+            rows[f"{subset_name(subset)}_mean"] = latents.mean(1)
+            rows[f"{subset_name(subset)}_sample"] = latents[:, 0]
+
+        writer.write(rows)
+    writer.close()
+
+    model.train(was_training)
+
+    # Written last, so that incomplete stores don't exist
+    with open(path / "meta.json", "w") as meta_file:
+        json.dump(
+            {
+                **(meta or {}),
+                "n_items": writer.n_items,
+                "subsets": [list(subset) for subset in subsets],
+                "n_mean_samples": n_mean_samples,
+            },
+            meta_file,
+            indent=2,
+        )
+
+    return LatentStore(path)
@@ -0,0 +1,150 @@
+from typing import Tuple
+
+import torch
+
+
+class MultilabelAveragePrecision:
+    def __init__(self, n_classes: int, mode="histogram", n_bins=1000, logits=False):
+        """Streaming average precision of every class of multi-label predictions,
+        updated with whole [B, C] batches and computed in one vectorised pass
+
+        Modes:
+            "histogram": per-class histograms of positive / negative scores,
+                O(classes x bins) memory. Scores in the same bin count as tied,
+                so APs are exact up to the bin width.
+            "exact": keeps all scores, O(classes x data points) memory, and
+                computes APs like `sklearn.metrics.average_precision_score`.
+
+        Parameters
+        ----------
+        n_classes : int
+        mode : str, optional
+            "histogram" or "exact", by default "histogram"
+        n_bins : int, optional
+            Bins over [0, 1] in "histogram" mode, by default 1000
+        logits : bool, optional
+            Whether predictions are logits instead of probabilities; a sigmoid
+            is applied, which leaves APs unchanged, by default False
+        """
+        if mode not in ["histogram", "exact"]:
+            raise ValueError(f"Unknown mode {mode}")
+
+        self.n_classes = n_classes
+        self.mode = mode
+        self.n_bins = n_bins
+        self.logits = logits
+
+        self.reset()
+
+    def reset(self):
+        # Allocated on the device of the first update
+        self.pos_hist = None  # [C, n_bins]
+        self.neg_hist = None  # [C, n_bins]
+        self.preds = []
+        self.targets = []
+
+    @torch.no_grad()
+    def update(self, preds: torch.Tensor, targets: torch.Tensor):
+        """
+        Parameters
+        ----------
+        preds : torch.Tensor
+            [B, C] scores
+        targets : torch.Tensor
+            [B, C] binary labels
+        """
+        preds = preds.detach().float()
+        if self.logits:
+            preds = torch.sigmoid(preds)
+        targets = targets.detach().float()
+
+        if self.mode == "exact":
+            self.preds.append(preds)
+            self.targets.append(targets)
+            return
+
+        if self.pos_hist is None:
+            self.pos_hist = torch.zeros(
+                self.n_classes, self.n_bins, dtype=torch.float64, device=preds.device
+            )
+            self.neg_hist = torch.zeros_like(self.pos_hist)
+
+        bins = (preds * self.n_bins).long().clamp(0, self.n_bins - 1)  # [B, C]
+        # Index into flattened histograms
+        classes = torch.arange(self.n_classes, device=preds.device)
+        index = (classes * self.n_bins + bins).flatten()
+
+        # Scatter instead of masking, to avoid device syncs
+        self.pos_hist.view(-1).scatter_add_(0, index, targets.flatten().double())
+        self.neg_hist.view(-1).scatter_add_(
+            0, index, (1 - targets).flatten().double()
+        )
+
+    @torch.no_grad()
+    def compute(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """APs of every class [C], and their mean over classes with positives
+
+        APs of classes without positives are nan, so all are before any update.
+        """
+        if self._empty():
+            nan = torch.full((self.n_classes,), float("nan"))
+            return nan, nan.mean()
+
+        if self.mode == "exact":
+            tp, fp, pos = self._exact_counts()
+        else:
+            # Bins in order of decreasing score
+            pos = self.pos_hist.flip(1)
+            tp = pos.cumsum(1)
+            fp = self.neg_hist.flip(1).cumsum(1)
+
+        # AP = sum over thresholds of (R_k - R_k-1) * P_k
+        n_pos = pos.sum(1)
+        precision = tp / (tp + fp).clamp(min=1)
+        aps = (precision * pos).sum(1) / n_pos
+
+        valid = n_pos > 0
+        aps = torch.where(valid, aps, torch.full_like(aps, float("nan")))
+        mean_ap = aps[valid].mean()
+
+        return aps.float(), mean_ap.float()
+
+    def n_positives(self) -> torch.Tensor:
+        """Number of positives of every class so far, [C]"""
+        if self._empty():
+            return torch.zeros(self.n_classes)
+
+        if self.mode == "exact":
+            return torch.cat(self.targets).sum(0)
+
+        return self.pos_hist.sum(1).float()
+
+    def _empty(self) -> bool:
+        if self.mode == "exact":
+            return len(self.preds) == 0
+
+        return self.pos_hist is None
+
+    def _exact_counts(self):
+        """True / false positives [C, N] at the end of each group of tied scores,
+        for data points sorted by decreasing score, and their labels [C, N]
+        """
+        preds = torch.cat(self.preds).t()  # [C, N]
+        targets = torch.cat(self.targets).t().double()
+
+        preds, order = preds.sort(dim=1, descending=True)
+        targets = targets.gather(1, order)
+
+        n = preds.shape[1]
+        index = torch.arange(n, device=preds.device).expand_as(preds)
+
+        # Last index of the group of tied scores of each data point
+        is_last = torch.ones_like(preds, dtype=torch.bool)
+        is_last[:, :-1] = preds[:, 1:] != preds[:, :-1]
+        group_end = torch.where(is_last, index, torch.full_like(index, n))
+        group_end = group_end.flip(1).cummin(1).values.flip(1)
+
+        tp = targets.cumsum(1).gather(1, group_end)
+        fp = (group_end + 1).double() - tp
+
+        return tp, fp, targets
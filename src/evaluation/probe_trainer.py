@@ -0,0 +1,125 @@
+from typing import List, Optional
+
+import torch
+from src.models.classifiers import GroupedLinearProbe
+from torch import optim
+
+from .buffer import RingBuffer
+
+
+class OnlineProbeTrainer:
+    def __init__(
+        self,
+        n_classes: int,
+        multilabel=False,
+        partitioned=False,
+        update_every_n_steps=1,
+        buffer_size: Optional[int] = None,
+        lr=1e-3,
+    ):
+        """Linear probes on the latents of a MVAE (one per modality, and one on
+        the joint), trained online alongside it, as per the standard
+        self-supervised protocol (see `src.callbacks.OnlineLinearProbe`)
+
+        Parameters
+        ----------
+        n_classes : int
+            Number of classes, or of attributes if `multilabel`
+        multilabel : bool, optional
+            Independent binary attributes instead of one class, by default False
+        partitioned : bool, optional
+            If latent space is partitioned, by default False
+        update_every_n_steps : int, optional
+            If > 1, detached latents are kept in a ring buffer, and the probes
+            take one step on the whole buffer every `update_every_n_steps` steps,
+            by default 1
+        buffer_size : int, optional
+            Rows of the ring buffer,
+            by default `update_every_n_steps` training batches
+        lr : float, optional
+            , by default 1e-3
+        """
+        self.n_classes = n_classes
+        self.multilabel = multilabel
+        self.partitioned = partitioned
+        self.update_every_n_steps = update_every_n_steps
+        self.buffer_size = buffer_size
+        self.lr = lr
+
+        self.buffer = None
+        # To be set
+        self.probes = None
+        self.optimizer = None
+
+    def in_sizes(self, pl_module) -> List[int]:
+        """Input sizes of the probes, of each modality and of the joint"""
+        n_modalities = len(pl_module.datamodule.dims)
+
+        if not self.partitioned:
+            return [pl_module.hparams["latent_dim"]] * (n_modalities + 1)
+
+        m_latent_dim = pl_module.hparams["m_latent_dim"]
+        s_latent_dim = pl_module.hparams["s_latent_dim"]
+        # FIXME To include modality-specific latent?
+        return [
+            m_latent_dim + s_latent_dim,
+            m_latent_dim + s_latent_dim,
+            m_latent_dim * 2 + s_latent_dim,
+        ]
+
+    def setup(self, pl_module) -> GroupedLinearProbe:
+        """Creates the probes, as `pl_module.linear_probes`, and their optimizer"""
+        # All probes in one module, evaluated with one batched matmul
+        # FIXME Shouldn't attach to `pl_module`?
+        self.probes = GroupedLinearProbe(
+            self.in_sizes(pl_module), self.n_classes, multilabel=self.multilabel
+        ).to(pl_module.device)
+        pl_module.linear_probes = self.probes
+
+        self.optimizer = optim.Adam(self.probes.parameters(), lr=self.lr)
+        self.buffer = None
+
+        return self.probes
+
+    def _step(self, preds: torch.Tensor, labels: torch.Tensor):
+        # FIXME Is simply summing correct here?
+        loss = self.probes.loss(preds, labels)
+
+        loss.backward()
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+    def update(
+        self, global_step: int, representations: List[torch.Tensor], labels
+    ) -> torch.Tensor:
+        """Updates the probes on this batch, or on the ring buffer every
+        `update_every_n_steps` steps, and returns predictions for this batch
+
+        Returns
+        -------
+        torch.Tensor
+            [H, B, C]
+        """
+        # [H, B, Z_max]
+        inputs = self.probes.stack(representations)
+
+        if self.update_every_n_steps <= 1:
+            # Forward pass through all probes, with one fused loss
+            preds = self.probes(inputs)
+            self._step(preds, labels)
+
+            return preds
+
+        if self.buffer is None:
+            capacity = self.buffer_size or self.update_every_n_steps * len(labels)
+            self.buffer = RingBuffer(capacity)
+
+        # Batch-first, [B, H, Z_max]
+        self.buffer.push(inputs.transpose(0, 1), labels)
+
+        if (global_step + 1) % self.update_every_n_steps == 0:
+            buffered_inputs, buffered_labels = self.buffer.get()
+            self._step(self.probes(buffered_inputs.transpose(0, 1)), buffered_labels)
+
+        with torch.no_grad():
+            return self.probes(inputs)
@@ -0,0 +1,148 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .latent_store import LatentStore
+from .metrics import MultilabelAveragePrecision
+
+
+def make_probe(in_size: int, out_n: int, hidden=0) -> nn.Module:
+    """Linear probe, or an MLP with one hidden layer of `hidden` units"""
+    if hidden <= 0:
+        return nn.Linear(in_size, out_n)
+
+    return nn.Sequential(
+        nn.Linear(in_size, hidden), nn.ReLU(), nn.Linear(hidden, out_n)
+    )
+
+
+def _to_device(array: np.ndarray, device: torch.device) -> torch.Tensor:
+    # One sequential read of the memory-mapped array
+    return torch.from_numpy(np.ascontiguousarray(array)).to(device)
+
+
+def train_probes(
+    train_store: LatentStore,
+    val_store: LatentStore,
+    subset: Tuple[int, ...],
+    configs: List[Dict],
+    field="mean",
+    epochs=20,
+    batch_size=1024,
+    device="cpu",
+    seed=0,
+) -> List[Dict]:
+    """Trains a probe for every config on the stored latents of `subset`, and
+    evaluates it on `val_store`, without the VAE
+
+    Latents are loaded onto `device` once, and all probes take their steps on
+    the same minibatches, so each epoch reads the data once for every probe.
+
+    Parameters
+    ----------
+    train_store : LatentStore
+    val_store : LatentStore
+    subset : Tuple[int, ...]
+        Subset of modalities the latents are conditioned on
+    configs : List[Dict]
+        {"hidden": int, "lr": float, "weight_decay": float} of every probe,
+        hidden=0 for a linear probe
+    field : str, optional
+        "mean" or "sample" latents, by default "mean"
+    epochs : int, optional
+        , by default 20
+    batch_size : int, optional
+        , by default 1024
+    device : str, optional
+        , by default "cpu"
+    seed : int, optional
+        Seed of the initialisations and of the data order, by default 0
+
+    Returns
+    -------
+    List[Dict]
+        Every config, with its "train_loss" (of the last epoch) and
+        "val_accuracy", or "val_map" for multi-label data
+    """
+    device = torch.device(device)
+
+    x_train = _to_device(train_store.latents(subset, field), device).float()
+    y_train = _to_device(train_store.labels(), device)
+    x_val = _to_device(val_store.latents(subset, field), device).float()
+    y_val = _to_device(val_store.labels(), device)
+
+    multilabel = y_train.dim() > 1
+    if multilabel:
+        n_classes = y_train.shape[1]
+        y_train = y_train.float()
+        loss_fn = F.binary_cross_entropy_with_logits
+    else:
+        n_classes = int(max(y_train.max(), y_val.max())) + 1
+        y_train = y_train.long()
+        loss_fn = F.cross_entropy
+
+    generator = torch.Generator().manual_seed(seed)
+
+    devices = [device] if device.type == "cuda" else []
+    with torch.random.fork_rng(devices=devices):
+        torch.manual_seed(seed)
+        probes = [
+            make_probe(x_train.shape[1], n_classes, config.get("hidden", 0)).to(device)
+            for config in configs
+        ]
+    optimizers = [
+        torch.optim.Adam(
+            probe.parameters(),
+            lr=config.get("lr", 1e-3),
+            weight_decay=config.get("weight_decay", 0.0),
+        )
+        for probe, config in zip(probes, configs)
+    ]
+
+    n = len(x_train)
+    # Losses of the last epoch, summed on device and read once
+    epoch_losses = torch.zeros(len(probes), device=device)
+    for _ in range(epochs):
+        epoch_losses.zero_()
+        order = torch.randperm(n, generator=generator).to(device)
+
+        for start in range(0, n, batch_size):
+            index = order[start : start + batch_size]
+            inputs, targets = x_train[index], y_train[index]
+
+            for i, (probe, optimizer) in enumerate(zip(probes, optimizers)):
+                loss = loss_fn(probe(inputs), targets)
+
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad()
+
+                epoch_losses[i] += loss.detach() * len(index)
+
+    train_losses = (epoch_losses / n).tolist()
+
+    results = []
+    with torch.no_grad():
+        for probe, config, train_loss in zip(probes, configs, train_losses):
+            preds = torch.cat(
+                [
+                    probe(x_val[start : start + batch_size])
+                    for start in range(0, len(x_val), batch_size)
+                ]
+            )
+            result = {**config, "train_loss": train_loss}
+
+            if multilabel:
+                ap = MultilabelAveragePrecision(n_classes, mode="exact", logits=True)
+                ap.update(preds, y_val)
+                result["val_map"] = ap.compute()[1].item()
+            else:
+                accuracy = (preds.argmax(dim=1) == y_val).float().mean()
+                result["val_accuracy"] = accuracy.item()
+
+            results.append(result)
+
+    return results
@@ -0,0 +1,70 @@
+import math
+import random
+from typing import Optional
+
+
+class EvalSchedule:
+    def __init__(
+        self,
+        every_n_epochs=1,
+        every_n_steps=1,
+        data_fraction=1.0,
+        time_budget: Optional[float] = None,
+        overhead_fraction: Optional[float] = None,
+        seed=0,
+    ):
+        """When, and on how much data, an evaluation callback runs
+        (see `src.callbacks.EvaluationScheduler`)
+
+        Parameters
+        ----------
+        every_n_epochs : int, optional
+            Validation / epoch hooks run every `every_n_epochs` epochs,
+            by default 1
+        every_n_steps : int, optional
+            Training batch hooks run every `every_n_steps` steps, by default 1
+        data_fraction : float, optional
+            Fraction of validation batches to run on, a fixed random subset
+            which includes the first batch, by default 1.0
+        time_budget : float, optional
+            Seconds per validation epoch, after which batch hooks are skipped,
+            by default None (no limit)
+        overhead_fraction : float, optional
+            Caps the budget at this fraction of the time since the previous
+            validation epoch, by default None (no limit)
+        seed : int, optional
+            Seed of the subset of validation batches, by default 0
+        """
+        self.every_n_epochs = every_n_epochs
+        self.every_n_steps = every_n_steps
+        self.data_fraction = data_fraction
+        self.time_budget = time_budget
+        self.overhead_fraction = overhead_fraction
+        self.seed = seed
+
+    def epoch_active(self, epoch: int) -> bool:
+        return (epoch + 1) % self.every_n_epochs == 0
+
+    def step_active(self, step: int) -> bool:
+        return step % self.every_n_steps == 0
+
+    def batch_selected(self, batch_idx: int) -> bool:
+        """Whether a validation batch is in the fixed subset (the validation set
+        isn't shuffled, so neither is its data); the first batch always is, so
+        that every epoch has data
+        """
+        if self.data_fraction >= 1.0 or batch_idx == 0:
+            return True
+
+        return random.Random(self.seed * 1_000_003 + batch_idx).random() < (
+            self.data_fraction
+        )
+
+    def budget(self, time_since_last_window: float) -> float:
+        """Seconds available to the current validation epoch"""
+        budget = math.inf if self.time_budget is None else self.time_budget
+
+        if self.overhead_fraction is not None:
+            budget = min(budget, self.overhead_fraction * time_since_last_window)
+
+        return budget
@@ -5,11 +5,17 @@ from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.core.lightning import LightningModule
 from src.callbacks import (
     CoherenceEvaluator,
+    LatentDimInterpolator,
+    LatentSpaceViz,
     MultimodalVAE_ImageSampler,
     OnlineLinearProbe,
     CelebaEvaluator,
     CelebaLinearProbe,
+    EvaluationScheduler,
+    RegionProfiler,
+    ThroughputMonitor,
 )
+from src.evaluation import EvalSchedule
 from src.models import MultimodalEncoder, ProductOfExpertsEncoder
 from src.models.vaes import MultimodalVAE
 from src.objectives import stochastic_elbo
@@ -31,6 +37,40 @@ class MVAE_Experiment(LightningModule):
         self.data_dim = self.datamodule.size()
         # Initialize callbacks
         self._init_callbacks()
+        # Profile named regions (see `src.profiling`) for a few steps
+        if self.hparams.get("profile_steps"):
+            self.callbacks.append(
+                RegionProfiler(
+                    n_steps=self.hparams["profile_steps"],
+                    output_dir=self.hparams.get("profile_dir", "profiles"),
+                )
+            )
+        # 2D projections of a sample of validation latents
+        if self.hparams.get("latent_viz_points"):
+            self.callbacks.append(
+                LatentSpaceViz(
+                    n_points=self.hparams["latent_viz_points"],
+                    tsne=self.hparams.get("latent_viz_tsne", False),
+                )
+            )
+        # Frequency / data / time limits of evaluation callbacks, by class name
+        if self.hparams.get("eval_schedules"):
+            self.callbacks.append(
+                EvaluationScheduler(
+                    {
+                        name: EvalSchedule(**schedule)
+                        for name, schedule in self.hparams["eval_schedules"].items()
+                    }
+                )
+            )
+        # Step time breakdown, samples/sec and memory
+        if self.hparams.get("throughput_log_every_n_steps"):
+            self.callbacks.append(
+                ThroughputMonitor(
+                    log_every_n_steps=self.hparams["throughput_log_every_n_steps"],
+                    window=self.hparams.get("throughput_window", 100),
+                )
+            )
 
         # Set-up nn modules according to `hparams`
         self._init_system()
@@ -49,6 +89,11 @@ class MVAE_Experiment(LightningModule):
         # )
         self.likelihood_weights = self.datamodule.likelihood_weights
 
+        # Per-term ELBO breakdown, summed on device between logs
+        self.log_terms_every_n_steps = self.hparams.get("log_terms_every_n_steps")
+        self._term_sums = {}
+        self._term_counts = {}
+
     def on_pretrain_routine_start(self):
         # Get number of parameters in model
         n_parameters = sum(
@@ -57,6 +102,10 @@ class MVAE_Experiment(LightningModule):
         logger = self.logger.experiment
         logger.log({"n_parameters": n_parameters}, commit=False)
 
+        # Model is on its device by now, so batches can be prefetched onto it
+        if hasattr(self.datamodule, "prefetch_device"):
+            self.datamodule.prefetch_device = self.device
+
     def _init_datamodule(self):
         self.datamodule = self.config.init_object("datamodule")
         self.datamodule.prepare_data()
@@ -96,9 +145,12 @@ class MVAE_Experiment(LightningModule):
     def _init_callbacks(self):
         self.callbacks = [
             MultimodalVAE_ImageSampler(include_modality=[True, True]),
+            LatentDimInterpolator(include_modality=[True, True]),
             # MultimodalVAEReconstructor(self.datamodule.val_set),
             # LearningRateMonitor(logging_interval="step"),
-            OnlineLinearProbe(),
+            OnlineLinearProbe(
+                update_every_n_steps=self.hparams.get("probe_update_every_n_steps", 1)
+            ),
             CoherenceEvaluator(),
         ]
 
@@ -117,15 +169,46 @@ class MVAE_Experiment(LightningModule):
             + (kl_multiplier_max - kl_multiplier_initial) * multiplier
         )
 
-    def _run_step(self, batch):
-        elbo = self.obj(
+    def _run_step(self, batch, return_terms=False):
+        output = self.obj(
             self.model,
             batch,
             self.likelihood_weights,
             kl_multiplier=self._kl_multiplier(),
+            return_terms=return_terms,
         )
 
-        return elbo.mean()
+        if return_terms:
+            elbo, terms = output
+            return elbo.mean(), terms
+
+        return output.mean()
+
+    def _accumulate_terms(self, terms):
+        """Sums ELBO terms (see `objectives.compute_multimodal_elbo`) on device,
+        and logs their means every `log_terms_every_n_steps` steps with a single
+        device -> host copy
+        """
+        for key, term in terms.items():
+            self._term_sums[key] = self._term_sums.get(key, 0) + term
+            self._term_counts[key] = self._term_counts.get(key, 0) + 1
+
+        if (self.global_step + 1) % self.log_terms_every_n_steps != 0:
+            return
+
+        keys = list(self._term_sums)
+        means = torch.stack(
+            [self._term_sums[key] / self._term_counts[key] for key in keys]
+        ).tolist()
+
+        self.log_dict(
+            {f"train_terms/{key}": mean for key, mean in zip(keys, means)},
+            on_step=True,
+            on_epoch=False,
+        )
+
+        self._term_sums = {}
+        self._term_counts = {}
 
     # def training_step(self, batch, batch_idx):
     #     opt = self.optimizers()
@@ -158,7 +241,11 @@ class MVAE_Experiment(LightningModule):
     #     opt.zero_grad()
 
     def training_step(self, batch, batch_idx):
-        elbo = self._run_step(batch)
+        if self.log_terms_every_n_steps:
+            elbo, terms = self._run_step(batch, return_terms=True)
+            self._accumulate_terms(terms)
+        else:
+            elbo = self._run_step(batch)
         loss = -elbo
         # Check for nan loss
         self.nan_loss = torch.isnan(loss).item()
@@ -233,8 +320,29 @@ class MVAE_Experiment(LightningModule):
     #     # if not grad_norm >= self.hparams["gradient_skip_threshold"]:
     #     super().optimizer_step(*args, **kwargs)
 
+    def on_train_batch_end(self, outputs, batch, batch_idx, dataloader_idx):
+        # Track position of resumable samplers, to resume mid-epoch
+        sampler = getattr(self.datamodule, "train_sampler", None)
+        if sampler is not None:
+            sampler.advance()
+
+    def on_save_checkpoint(self, checkpoint):
+        sampler = getattr(self.datamodule, "train_sampler", None)
+        if sampler is not None:
+            checkpoint["train_sampler"] = sampler.state_dict()
+
+    def on_load_checkpoint(self, checkpoint):
+        sampler = getattr(self.datamodule, "train_sampler", None)
+        if sampler is not None and "train_sampler" in checkpoint:
+            sampler.load_state_dict(checkpoint["train_sampler"])
+
     def validation_step(self, batch, batch_idx):
-        elbo = self._run_step(batch)
+        if self.log_terms_every_n_steps:
+            elbo, terms = self._run_step(batch, return_terms=True)
+            # Averaged over the epoch by Lightning
+            self.log_dict({f"val_terms/{key}": term for key, term in terms.items()})
+        else:
+            elbo = self._run_step(batch)
 
         self.log_dict({"val_elbo": elbo})
 
@@ -289,6 +397,9 @@ class Celeba_MVAE_Experiment(Fusion_MVAE_Experiment):
     def _init_callbacks(self):
         self.callbacks = [
             MultimodalVAE_ImageSampler(include_modality=[True, False]),
+            LatentDimInterpolator(include_modality=[True, False]),
             CelebaEvaluator(),
-            CelebaLinearProbe(),
+            CelebaLinearProbe(
+                update_every_n_steps=self.hparams.get("probe_update_every_n_steps", 1)
+            ),
         ]
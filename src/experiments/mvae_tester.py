@@ -1,7 +1,10 @@
-from pathlib import Path
+import math
 
 import torch
-from src.models.classifiers import MNIST_Classifier, SVHN_Classifier
+from src import evaluation
+from src.datamodules.prefetch import move_to_device
+from src.objectives import stochastic_elbo
+from torch.utils.data import DataLoader
 
 
 # FIXME Change this into a callback?
@@ -18,24 +21,27 @@ class MVAE_Tester:
         self.test_loader = self.pl_module.datamodule.test_dataloader()
 
     def _init_classifiers(self):
-        # Load pretrained weights
-        mnist_weights_path = Path("saved") / "mnist_svhn" / "mnist_model.pt"
-        svhn_weights_path = Path("saved") / "mnist_svhn" / "svhn_model.pt"
+        # Pretrained classifiers, shared with the callbacks
+        classifiers = evaluation.ClassifierManager.get()
+        self.mnist_net = classifiers.predictor("mnist")
+        self.svhn_net = classifiers.predictor("svhn")
 
-        self.mnist_net = MNIST_Classifier().to(self.pl_module.device)
-        self.svhn_net = SVHN_Classifier().to(self.pl_module.device)
+    def _prepare_batch(self, batch):
+        """Moves `batch` to the device and applies the batch transforms of the
+        datamodule, as Lightning would
+        """
+        batch = move_to_device(batch, self.pl_module.device)
 
-        self.mnist_net.load_state_dict(torch.load(mnist_weights_path))
-        self.svhn_net.load_state_dict(torch.load(svhn_weights_path))
+        datamodule = self.pl_module.datamodule
+        if hasattr(datamodule, "apply_batch_transforms"):
+            batch = datamodule.apply_batch_transforms(batch)
 
-        self.mnist_net.eval()
-        self.svhn_net.eval()
+        return batch
 
     def cross_coherence(self):
         print("Evaluating Cross Coherence...")
 
         model = self.pl_module.model
-        device = self.pl_module.device
 
         dataset_size = len(self.test_loader.dataset)
 
@@ -44,13 +50,9 @@ class MVAE_Tester:
 
         with torch.no_grad():
             for batch in self.test_loader:
+                batch = self._prepare_batch(batch)
                 mnist, svhn = batch["data"]
                 targets = batch["label"]
-                mnist, svhn, targets = (
-                    mnist.to(device),
-                    svhn.to(device),
-                    targets.to(device),
-                )
 
                 # Get cross reconstructions
                 m_recons, s_recons = model.cross_reconstruct([mnist, svhn], mean=True)
@@ -68,30 +70,137 @@ class MVAE_Tester:
             "cross_coherence_m_s": corr_s / dataset_size,
         }
 
-    def joint_coherence(self, n_samples: int = 10_000):
+    def joint_coherence(self, n_samples: int = 10_000, chunk_size=1_000, seed=0):
         print("Evaluating Joint Coherence...")
 
-        model = self.pl_module.model
-        corr = 0
+        # Generated and classified in chunks, with a 95% confidence interval
+        return evaluation.joint_coherence(
+            self.pl_module.model,
+            [self.mnist_net, self.svhn_net],
+            n_samples=n_samples,
+            chunk_size=chunk_size,
+            seed=seed,
+        )
+
+    def adaptive_evaluate(
+        self,
+        coherence_tolerance=0.005,
+        log_prob_tolerance=None,
+        log_prob_relative_tolerance=0.01,
+        max_items=None,
+        max_seconds=None,
+        batch_size=256,
+        log_prob_samples=1000,
+        log_prob_items=16,
+        seed=0,
+    ):
+        """Cross coherence and test log-likelihood on a shuffled stream of the
+        test set, until their 95% CIs are narrower than the tolerances or a budget
+        runs out (see `evaluation.AdaptiveEvaluator`)
+
+        Parameters
+        ----------
+        coherence_tolerance : float, optional
+            CI half-width of cross coherence accuracies, by default 0.005
+        log_prob_tolerance : float, optional
+            CI half-width of log p(x1, x2) in nats, by default None (only the
+            relative tolerance)
+        log_prob_relative_tolerance : float, optional
+            CI half-width of log p(x1, x2) as a fraction of |log p(x1, x2)|,
+            which doesn't depend on the dimension of the data, by default 0.01
+        max_items : int, optional
+            , by default None (the whole test set)
+        max_seconds : float, optional
+            , by default None
+        batch_size : int, optional
+            , by default 256
+        log_prob_samples : int, optional
+            Importance samples of log p(x1, x2), by default 1000
+        log_prob_items : int, optional
+            Items of each batch to estimate log p(x1, x2) on, by default 16
+        seed : int, optional
+            Seed of the shuffling, by default 0
+
+        Returns
+        -------
+        Dict
+            See `evaluation.AdaptiveEvaluator.run`
+        """
+        print("Evaluating adaptively...")
 
-        with torch.no_grad():
-            # Generate samples
-            mnist, svhn = model.sample(n_samples, mean=True)
+        model = self.pl_module.model
 
-            # Get predictions
-            m_preds = self.mnist_net(mnist).argmax(dim=1)
-            s_preds = self.svhn_net(svhn).argmax(dim=1)
+        # Every prefix of a shuffled stream is a random sample of the test set
+        loader = DataLoader(
+            self.test_loader.dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            collate_fn=self.test_loader.collate_fn,
+            num_workers=self.test_loader.num_workers,
+            generator=torch.Generator().manual_seed(seed),
+        )
+
+        def step(batch, evaluator):
+            batch = self._prepare_batch(batch)
+            mnist, svhn = batch["data"]
+            targets = batch["label"]
+
+            with torch.no_grad():
+                # Get cross reconstructions
+                m_recons, s_recons = model.cross_reconstruct([mnist, svhn], mean=True)
 
-            # Evaluate correct samples
-            corr += (m_preds == s_preds).sum().item()
+                # Evaluate correct reconstructions
+                m_preds = self.mnist_net(m_recons).argmax(dim=1)
+                s_preds = self.svhn_net(s_recons).argmax(dim=1)
+                evaluator.add("cross_coherence_s_m", m_preds == targets)
+                evaluator.add("cross_coherence_m_s", s_preds == targets)
+
+                # Get joint log prob (using importance sampling), on a few items
+                elbo = stochastic_elbo(
+                    model,
+                    [x[:log_prob_items] for x in batch["data"]],
+                    num_samples=log_prob_samples,
+                    keepdim=True,
+                )
+                log_prob = torch.logsumexp(elbo, dim=1) - math.log(log_prob_samples)
+                evaluator.add("test_log_prob", log_prob)
+
+            return len(targets)
+
+        evaluator = evaluation.AdaptiveEvaluator(
+            tolerance={
+                "cross_coherence_s_m": coherence_tolerance,
+                "cross_coherence_m_s": coherence_tolerance,
+                "test_log_prob": log_prob_tolerance,
+            },
+            relative_tolerance={"test_log_prob": log_prob_relative_tolerance},
+            max_items=max_items,
+            max_seconds=max_seconds,
+        )
+
+        return evaluator.run(loader, step)
+
+    def evaluate(self, adaptive=False, **adaptive_kwargs):
+        """Evaluates and logs all metrics, on the whole test set, or adaptively
+        (see `adaptive_evaluate`) with their CI half-widths
+        """
+        logger = self.pl_module.logger.experiment
 
-        return {"joint_coherence": corr / n_samples}
+        if adaptive:
+            results = self.adaptive_evaluate(**adaptive_kwargs)
+            print(f"Stopped: {results.pop('stop_reason')}")
+            not_converged = results.pop("not_converged")
+            if not_converged:
+                print(f"Not converged: {', '.join(not_converged)}")
 
-    def evaluate(self):
-        logger = self.pl_module.logger.experiment
+            test_results = {"n_test_items": results.pop("n_items")}
+            for name, result in results.items():
+                test_results[name] = result["value"]
+                test_results[f"{name}_ci_half_width"] = result["ci_half_width"]
+        else:
+            test_results = self.cross_coherence()
 
-        cross_coherence_results = self.cross_coherence()
         joint_coherence_results = self.joint_coherence()
 
         # Log results
-        logger.log({**cross_coherence_results, **joint_coherence_results})
+        logger.log({**test_results, **joint_coherence_results})
@@ -1,6 +1,7 @@
 from pytorch_lightning.callbacks import LearningRateMonitor
 from src.callbacks import (
     CoherenceEvaluator,
+    LatentDimInterpolator,
     MultimodalVAE_ImageSampler,
     OnlineLinearProbe,
 )
@@ -48,9 +49,13 @@ class PMVAE_Experiment(MVAE_Experiment):
     def _init_callbacks(self):
         self.callbacks = [
             MultimodalVAE_ImageSampler(include_modality=[True, True]),
+            LatentDimInterpolator(include_modality=[True, True]),
             # MultimodalVAEReconstructor(self.datamodule.val_set),
             LearningRateMonitor(logging_interval="step"),
-            OnlineLinearProbe(partitioned=True),
+            OnlineLinearProbe(
+                partitioned=True,
+                update_every_n_steps=self.hparams.get("probe_update_every_n_steps", 1),
+            ),
             CoherenceEvaluator(),
         ]
 
@@ -0,0 +1,170 @@
+"""Background logging of images from callbacks.
+
+Callbacks enqueue detached CPU tensors with `MediaLogger.log_images`; a worker
+thread assembles image grids, encodes them and submits them to the sinks, so
+that training doesn't stall at epoch end while images are encoded / uploaded.
+
+Sinks:
+    `WandbSink`: logs `wandb.Image`s to the run of the trainer's `WandbLogger`
+    `DirectorySink`: saves PNGs locally, for runs without network
+
+Use the logger of a trainer, `media_logger(trainer)`, which picks its sinks
+from the trainer's logger and `WANDB_MODE`.
+"""
+import atexit
+import os
+import queue
+import threading
+import warnings
+from pathlib import Path
+from typing import List
+
+import torch
+import torchvision
+import wandb
+from pytorch_lightning.loggers import WandbLogger
+
+_END = object()
+# Step axis of the images logged to wandb
+STEP_METRIC = "trainer/global_step"
+
+
+class WandbSink:
+    def __init__(self, experiment, step_metric=STEP_METRIC):
+        """Logs images against `step_metric`, the step they were made at, as
+        they reach the run in the background, after later metrics
+
+        Parameters
+        ----------
+        experiment : wandb.sdk.wandb_run.Run
+            e.g. `trainer.logger.experiment`
+        step_metric : str, optional
+            , by default STEP_METRIC (the step axis of `WandbLogger`)
+        """
+        self.experiment = experiment
+        self.step_metric = step_metric
+
+        # Older versions of wandb have no custom step axes
+        self._define_metric = getattr(experiment, "define_metric", None)
+        self._defined = set()
+        if self._define_metric is not None:
+            self._define_metric(step_metric)
+
+    def log_image(self, key: str, grid: torch.Tensor, step: int):
+        if self._define_metric is not None and key not in self._defined:
+            self._define_metric(key, step_metric=self.step_metric)
+            self._defined.add(key)
+
+        image = wandb.Image(grid.permute(1, 2, 0).numpy())
+        self.experiment.log({key: image, self.step_metric: step})
+
+
+class DirectorySink:
+    def __init__(self, root: Path):
+        """Saves images to `root/{key}/{step}.png`"""
+        self.root = Path(root)
+
+    def log_image(self, key: str, grid: torch.Tensor, step: int):
+        path = self.root / key / f"{step:08d}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        torchvision.utils.save_image(grid, path)
+
+
+class MediaLogger:
+    def __init__(self, sinks: List, max_queue=8):
+        """Logs images to `sinks` from a background thread
+
+        Parameters
+        ----------
+        sinks : List
+            Objects with `log_image(key, grid, step)`, e.g. `WandbSink`
+        max_queue : int, optional
+            Pending requests, after which `log_images` blocks, by default 8
+        """
+        self.sinks = sinks
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # Don't lose pending images at exit (runs before `wandb`'s own hook,
+        # which was registered earlier)
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _END:
+                    return
+
+                key, images, step, nrow = item
+                grid = torchvision.utils.make_grid(images, nrow=nrow)
+
+                for sink in self.sinks:
+                    sink.log_image(key, grid, step)
+            except Exception as e:
+                # Failed uploads shouldn't stop training
+                warnings.warn(f"Failed to log {item[0]}: {type(e).__name__}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def log_images(self, key: str, images: torch.Tensor, step: int, nrow=8):
+        """Enqueues a grid of `images` to be logged
+
+        Parameters
+        ----------
+        key : str
+        images : torch.Tensor
+            [B, C, H, W], in [0, 1]; copied to CPU here, so the caller can
+            reuse device memory
+        step : int
+            e.g. `trainer.global_step`
+        nrow : int, optional
+            Images per row of the grid, by default 8
+        """
+        if self._thread is None:
+            self._start()
+
+        self.queue.put((key, images.detach().cpu(), step, nrow))
+
+    def flush(self):
+        """Waits until all enqueued images have been logged"""
+        if self._thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self._thread is None:
+            return
+
+        self.queue.put(_END)
+        self._thread.join()
+        self._thread = None
+
+        atexit.unregister(self.close)
+
+
+def default_sinks(trainer) -> List:
+    """`WandbSink` if the trainer logs to wandb, and `DirectorySink` (in
+    `trainer.default_root_dir / "media"`) if it doesn't, or if wandb is offline
+    """
+    sinks = []
+    mode = os.environ.get("WANDB_MODE", "online")
+    wandb_logger = isinstance(trainer.logger, WandbLogger)
+
+    if wandb_logger and mode != "disabled":
+        sinks.append(WandbSink(trainer.logger.experiment))
+    if not wandb_logger or mode in ["offline", "dryrun", "disabled"]:
+        sinks.append(DirectorySink(Path(trainer.default_root_dir) / "media"))
+
+    return sinks
+
+
+def media_logger(trainer) -> MediaLogger:
+    """`MediaLogger` of `trainer`, created at first use"""
+    if getattr(trainer, "_media_logger", None) is None:
+        trainer._media_logger = MediaLogger(default_sinks(trainer))
+
+    return trainer._media_logger
@@ -1,2 +1,3 @@
 from .img_modules import CelebaImgDecoder, CelebaImgEncoder, CelebaImgClassifier
 from .text_modules import CelebaTextDecoder, CelebaTextEncoder, CelebaTextClassifier
+from .fusion import FusedResidualBlock, fuse_conv_bn, fuse_for_inference
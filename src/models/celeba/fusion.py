@@ -0,0 +1,173 @@
+import copy
+from typing import Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+
+from .img_modules import ResidualBlock2dConv, ResidualBlock2dTransposeConv
+from .text_modules import ResidualBlock1dConv, ResidualBlock1dTransposeConv
+
+RESIDUAL_BLOCKS = (
+    ResidualBlock1dConv,
+    ResidualBlock1dTransposeConv,
+    ResidualBlock2dConv,
+    ResidualBlock2dTransposeConv,
+)
+DROPOUTS = (nn.Dropout, nn.Dropout2d, nn.Dropout3d)
+
+_Conv = Union[nn.Conv1d, nn.Conv2d, nn.ConvTranspose1d, nn.ConvTranspose2d]
+
+
+@torch.no_grad()
+def fuse_conv_bn(
+    conv: _Conv, bn: Optional[nn.modules.batchnorm._BatchNorm] = None, scale=1.0
+) -> _Conv:
+    """Copy of `conv` that computes `scale * bn(conv(x))`, with `bn` in eval mode
+
+    Parameters
+    ----------
+    conv : _Conv
+        (Transposed) convolution, without groups
+    bn : nn.modules.batchnorm._BatchNorm, optional
+        Batch norm applied to the outputs of `conv`, by default None
+    scale : float, optional
+        , by default 1.0
+    """
+    fused = copy.deepcopy(conv)
+    weight = conv.weight.detach()
+
+    bias = (
+        conv.bias.detach()
+        if conv.bias is not None
+        else weight.new_zeros(conv.out_channels)
+    )
+    factor = weight.new_full((conv.out_channels,), float(scale))
+
+    if bn is not None:
+        std = torch.sqrt(bn.running_var + bn.eps)
+        gamma = bn.weight.detach() if bn.affine else torch.ones_like(std)
+        beta = bn.bias.detach() if bn.affine else torch.zeros_like(std)
+
+        bias = (bias - bn.running_mean) * gamma / std + beta
+        factor = factor * gamma / std
+
+    # Weights of transposed convolutions are [C_in, C_out, ...]
+    shape = [1] * weight.dim()
+    shape[1 if isinstance(conv, nn.modules.conv._ConvTransposeNd) else 0] = -1
+
+    fused.weight = nn.Parameter(weight * factor.view(shape))
+    fused.bias = nn.Parameter(bias * scale)
+
+    return fused
+
+
+class FusedResidualBlock(nn.Module):
+    def __init__(self, block: nn.Module):
+        """Inference-only equivalent of a CelebA residual block (in eval mode),
+        with `bn2` folded into `conv1`, the output scale `b` into `conv2`, the
+        residual scale `a` into the shortcut (conv + batch norm), and without
+        dropout
+
+        `bn1` is kept, as it normalises the block input before a ReLU.
+
+        Parameters
+        ----------
+        block : nn.Module
+            One of `RESIDUAL_BLOCKS`
+        """
+        super().__init__()
+        shortcut = getattr(block, "downsample", None) or getattr(
+            block, "upsample", None
+        )
+
+        self.bn1 = copy.deepcopy(block.bn1).eval()
+        self.conv1 = fuse_conv_bn(block.conv1, block.bn2)
+        self.conv2 = fuse_conv_bn(block.conv2, scale=block.b)
+
+        if shortcut:
+            self.shortcut = fuse_conv_bn(shortcut[0], shortcut[1], scale=block.a)
+        else:
+            self.shortcut = None
+        self.a = block.a
+
+    def forward(self, x):
+        out = torch.relu(self.bn1(x))
+        out = torch.relu(self.conv1(out))
+        out = self.conv2(out)
+
+        if self.shortcut is not None:
+            return self.shortcut(x) + out
+        return self.a * x + out
+
+
+def _fuse_children(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, RESIDUAL_BLOCKS):
+            setattr(module, name, FusedResidualBlock(child))
+        elif isinstance(child, DROPOUTS):
+            setattr(module, name, nn.Identity())
+        else:
+            _fuse_children(child)
+
+
+@torch.no_grad()
+def parity_error(
+    module: nn.Module, fused: nn.Module, example_input: torch.Tensor
+) -> Tuple[float, float]:
+    """Max absolute error of `fused` w.r.t. `module` in eval mode, and the max
+    absolute output of `module`
+    """
+    was_training = module.training
+    module.eval()
+    expected = module(example_input)
+    module.train(was_training)
+
+    error = (fused(example_input) - expected).abs().max().item()
+
+    return error, expected.abs().max().item()
+
+
+def fuse_for_inference(
+    module: nn.Module,
+    example_input: Optional[torch.Tensor] = None,
+    rtol=1e-4,
+    atol=1e-5,
+) -> nn.Module:
+    """Frozen copy of `module` for evaluation, with the residual blocks of the
+    CelebA encoders / classifiers (and decoders) replaced by `FusedResidualBlock`
+    and dropout removed
+
+    Parameters
+    ----------
+    module : nn.Module
+    example_input : torch.Tensor, optional
+        If given, the outputs of both modules on it are checked to match,
+        by default None
+    rtol : float, optional
+        Tolerance relative to the largest output, by default 1e-4
+    atol : float, optional
+        , by default 1e-5
+
+    Returns
+    -------
+    nn.Module
+        In eval mode, without gradients
+
+    Raises
+    ------
+    ValueError
+        If outputs on `example_input` don't match
+    """
+    fused = copy.deepcopy(module).eval()
+    _fuse_children(fused)
+    fused.requires_grad_(False)
+
+    if example_input is not None:
+        error, max_output = parity_error(module, fused, example_input)
+        if error > atol + rtol * max_output:
+            raise ValueError(
+                f"Fused {type(module).__name__} differs from the original by "
+                f"{error:.3g} (largest output {max_output:.3g})"
+            )
+
+    return fused
@@ -1,5 +1,9 @@
 """Taken from: https://github.com/iffsid/mmvae/blob/public/src/report/helper.py
 """
+import math
+from typing import List
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -51,3 +55,90 @@ class MNIST_Classifier(nn.Module):
         x = self.fc2(x)
         # return F.log_softmax(x, dim=-1)
         return x
+
+
+class GroupedLinearProbe(nn.Module):
+    def __init__(self, in_sizes: List[int], out_n: int, multilabel=False):
+        """Linear probes with different input sizes, evaluated together with one
+        batched matmul
+
+        Inputs of each probe are zero-padded to the largest input size, so the
+        padded weights get no gradient and stay zero.
+
+        Parameters
+        ----------
+        in_sizes : List[int]
+            Input size of each probe
+        out_n : int
+            Number of classes
+        multilabel : bool, optional
+            Whether targets are binary labels for every class (see `loss`),
+            by default False
+        """
+        super().__init__()
+        self.in_sizes = list(in_sizes)
+        self.out_n = out_n
+        self.multilabel = multilabel
+
+        n_heads = len(self.in_sizes)
+        max_in = max(self.in_sizes)
+
+        # Initialized like `nn.Linear`, per probe
+        weight = torch.zeros(n_heads, max_in, out_n)
+        bias = torch.zeros(n_heads, 1, out_n)
+        for h, in_n in enumerate(self.in_sizes):
+            bound = 1 / math.sqrt(in_n)
+            nn.init.uniform_(weight[h, :in_n], -bound, bound)
+            nn.init.uniform_(bias[h], -bound, bound)
+
+        self.weight = nn.Parameter(weight)  # [H, Z_max, C]
+        self.bias = nn.Parameter(bias)  # [H, 1, C]
+
+    def stack(self, inputs: List[torch.Tensor]) -> torch.Tensor:
+        """List[B, Z_h] -> [H, B, Z_max], zero-padded"""
+        max_in = self.weight.shape[1]
+
+        return torch.stack([F.pad(x, [0, max_in - x.shape[-1]]) for x in inputs])
+
+    def forward(self, inputs) -> torch.Tensor:
+        """List[B, Z_h] or [H, B, Z_max] -> logits [H, B, C]"""
+        if isinstance(inputs, (list, tuple)):
+            inputs = self.stack(inputs)
+
+        return torch.baddbmm(self.bias, inputs, self.weight)
+
+    def loss(self, logits: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        """Sum over probes of their mean loss, in one call
+
+        Parameters
+        ----------
+        logits : torch.Tensor
+            [H, B, C]
+        targets : torch.Tensor
+            [B] class indices, or [B, C] binary labels if `multilabel`
+        """
+        n_heads = logits.shape[0]
+
+        if self.multilabel:
+            targets = targets.float().expand_as(logits)
+
+            return n_heads * F.binary_cross_entropy_with_logits(logits, targets)
+
+        return n_heads * F.cross_entropy(
+            logits.reshape(-1, self.out_n), targets.repeat(n_heads)
+        )
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints with separate linear `MLP` probes in an `nn.ModuleList`
+        if f"{prefix}0.0.weight" in state_dict:
+            weight = torch.zeros_like(self.weight)
+            bias = torch.zeros_like(self.bias)
+
+            for h, in_n in enumerate(self.in_sizes):
+                weight[h, :in_n] = state_dict.pop(f"{prefix}{h}.0.weight").t()
+                bias[h, 0] = state_dict.pop(f"{prefix}{h}.0.bias")
+
+            state_dict[f"{prefix}weight"] = weight
+            state_dict[f"{prefix}bias"] = bias
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
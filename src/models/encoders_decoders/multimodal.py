@@ -6,6 +6,7 @@ from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
+from src import profiling
 from src.models.base import MLP
 from src.models.dists import ConditionalDiagonalNormal
 from .helpers import SAB, PMA
@@ -59,14 +60,15 @@ class ProductOfExpertsEncoder(nn.Module):
         ), "Number of encoders and inputs must be the same!"
 
         # Compute params for each unimodal dist
-        for dist, x in zip(self.dists, xs):
-            # Ignore for missing modalities
-            if x is None:
-                continue
+        with profiling.region("unimodal_encoders"):
+            for dist, x in zip(self.dists, xs):
+                # Ignore for missing modalities
+                if x is None:
+                    continue
 
-            m, s = dist._compute_params(x)
-            means.append(m)
-            log_stds.append(s)
+                m, s = dist._compute_params(x)
+                means.append(m)
+                log_stds.append(s)
 
         # Add params of prior expert; assume prior is standard normal
         # FIXME What if specify different prior?
@@ -74,9 +76,10 @@ class ProductOfExpertsEncoder(nn.Module):
         log_stds.append(torch.zeros_like(log_stds[0]))
 
         # Combine params using Product of Experts
-        pd_means, pd_log_stds = self._product_of_experts(
-            torch.stack(means), torch.stack(log_stds)
-        )
+        with profiling.region("fusion"):
+            pd_means, pd_log_stds = self._product_of_experts(
+                torch.stack(means), torch.stack(log_stds)
+            )
 
         return torch.cat([pd_means, pd_log_stds], dim=-1)
 
@@ -145,16 +148,18 @@ class MultimodalEncoder(nn.Module):
         outputs = []
 
         # Get output from each encoder
-        for x, encoder in zip(xs, self.encoders):
-            # Ignore for missing modalities
-            if x is None:
-                outputs.append(None)
+        with profiling.region("unimodal_encoders"):
+            for x, encoder in zip(xs, self.encoders):
+                # Ignore for missing modalities
+                if x is None:
+                    outputs.append(None)
 
-            else:
-                outputs.append(encoder(x))
+                else:
+                    outputs.append(encoder(x))
 
         # Perform multimodal fusion
-        return self.fusion_module(outputs)
+        with profiling.region("fusion"):
+            return self.fusion_module(outputs)
 
 
 class PartitionedMultimodalEncoder(nn.Module):
@@ -191,18 +196,22 @@ class PartitionedMultimodalEncoder(nn.Module):
         s_latents = []
 
         # Get output from each encoder
-        for x, encoder in zip(xs, self.encoders):
-            # Ignore modality-specific latents for missing modalities
-            if x is None:
-                m_latents.append(None)
-                s_latents.append(None)
-            else:
-                latents = encoder(x)
-                m_latents.append(latents["m"])
-                s_latents.append(latents["s"])
+        with profiling.region("unimodal_encoders"):
+            for x, encoder in zip(xs, self.encoders):
+                # Ignore modality-specific latents for missing modalities
+                if x is None:
+                    m_latents.append(None)
+                    s_latents.append(None)
+                else:
+                    latents = encoder(x)
+                    m_latents.append(latents["m"])
+                    s_latents.append(latents["s"])
 
         # Perform multimodal fusion for shared latents
-        return {"m": m_latents, "s": self.fusion_module(s_latents)}
+        with profiling.region("fusion"):
+            s_latent = self.fusion_module(s_latents)
+
+        return {"m": m_latents, "s": s_latent}
 
 
 class SetEncoder(MLP):
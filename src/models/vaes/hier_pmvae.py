@@ -1,10 +1,12 @@
 import torch
 from typing import List, Dict, Any, Optional
 from nflows.utils import torchutils
+from src import profiling
 from .pmvae import PartitionedMultimodalVAE
 
 
 class HierPMVAE_v1(PartitionedMultimodalVAE):
+    @profiling.profiled()
     def log_q_z_x(
         self,
         inputs: List[Optional[torch.Tensor]] = None,
@@ -22,9 +24,10 @@ class HierPMVAE_v1(PartitionedMultimodalVAE):
         s_context = q_context["s"]  # [B, Z_s]
 
         # Compute s_posterior
-        s_latent, log_q_z_s = self.s_posterior.sample_and_log_prob(
-            num_samples, s_context
-        )
+        with profiling.region("posterior_sample"):
+            s_latent, log_q_z_s = self.s_posterior.sample_and_log_prob(
+                num_samples, s_context
+            )
         s_latent = torchutils.merge_leading_dims(s_latent, num_dims=2)  # [B*K, Z]
         log_q_z_s = torchutils.merge_leading_dims(log_q_z_s, num_dims=2)  # [B*K]
 
@@ -48,9 +51,10 @@ class HierPMVAE_v1(PartitionedMultimodalVAE):
                     [torchutils.repeat_rows(context, num_samples), s_latent], dim=-1
                 )
 
-                m_latent, log_q_z_m = posterior.sample_and_log_prob(
-                    1, context=cat_context
-                )
+                with profiling.region("posterior_sample"):
+                    m_latent, log_q_z_m = posterior.sample_and_log_prob(
+                        1, context=cat_context
+                    )
                 m_latent = torchutils.merge_leading_dims(
                     m_latent, num_dims=2
                 )  # [B*K, Z]
@@ -71,6 +75,7 @@ class HierPMVAE_v1(PartitionedMultimodalVAE):
             {"m": cat_m_contexts, "s": s_context},
         )
 
+    @profiling.profiled()
     def log_p_z(self, latents):
         m_latents = latents["m"]
         s_latent = latents["s"]
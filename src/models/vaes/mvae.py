@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from nflows.distributions import Distribution
 from nflows.utils import torchutils
+from src import profiling
 
 
 class MultimodalVAE(nn.Module):
@@ -21,6 +22,7 @@ class MultimodalVAE(nn.Module):
         self.likelihoods = nn.ModuleList(likelihoods)
         self.inputs_encoder = inputs_encoder
 
+    @profiling.profiled()
     def log_q_z_x(
         self,
         inputs: List[Optional[torch.Tensor]] = None,
@@ -36,9 +38,10 @@ class MultimodalVAE(nn.Module):
         q_context = self.inputs_encoder(inputs)
 
         # Compute posterior
-        latent, log_prob = self.approximate_posterior.sample_and_log_prob(
-            num_samples, context=q_context
-        )
+        with profiling.region("posterior_sample"):
+            latent, log_prob = self.approximate_posterior.sample_and_log_prob(
+                num_samples, context=q_context
+            )
         latent = torchutils.merge_leading_dims(latent, num_dims=2)
         log_prob = torchutils.merge_leading_dims(log_prob, num_dims=2)
 
@@ -52,24 +55,34 @@ class MultimodalVAE(nn.Module):
 
         return log_prob
 
+    @profiling.profiled()
     def log_p_z(self, latents):
         log_prob = self.prior.log_prob(latents)
 
         return log_prob
 
-    def log_p_x_z(self, inputs, latents, weights, num_samples=1):
+    @profiling.profiled()
+    def log_p_x_z(self, inputs, latents, weights, num_samples=1, per_modality=False):
+        """Weighted sum of log p(x_i|z) over the present modalities, or if
+        `per_modality`, a list of unweighted log p(x_i|z) (None if missing)
+        """
         log_prob_list = []
 
         # Compute likelihood for each modality
         for x, likelihood, weight in zip(inputs, self.likelihoods, weights):
             # Account for missing modalities
             if x is None:
+                log_prob_list.append(None)
                 continue
 
             x = torchutils.repeat_rows(x, num_reps=num_samples)
-            log_prob_list.append(weight * likelihood.log_prob(x, context=latents))
+            log_prob = likelihood.log_prob(x, context=latents)
+            log_prob_list.append(log_prob if per_modality else weight * log_prob)
+
+        if per_modality:
+            return log_prob_list
 
-        return torch.stack(log_prob_list).sum(0)
+        return torch.stack([p for p in log_prob_list if p is not None]).sum(0)
 
     def encode(
         self, inputs: torch.Tensor, num_samples: int = None
@@ -3,6 +3,7 @@ import torch.nn as nn
 from nflows.distributions import Distribution
 from typing import List, Dict, Any, Optional
 from nflows.utils import torchutils
+from src import profiling
 
 
 class PartitionedMultimodalVAE(nn.Module):
@@ -25,6 +26,7 @@ class PartitionedMultimodalVAE(nn.Module):
         self.likelihoods = nn.ModuleList(likelihoods)
         self.inputs_encoder = inputs_encoder
 
+    @profiling.profiled()
     def log_q_z_x(
         self,
         inputs: List[Optional[torch.Tensor]] = None,
@@ -42,9 +44,10 @@ class PartitionedMultimodalVAE(nn.Module):
         s_context = q_context["s"]  # [B, Z_s]
 
         # Compute s_posterior
-        s_latent, log_q_z_s = self.s_posterior.sample_and_log_prob(
-            num_samples, s_context
-        )
+        with profiling.region("posterior_sample"):
+            s_latent, log_q_z_s = self.s_posterior.sample_and_log_prob(
+                num_samples, s_context
+            )
         s_latent = torchutils.merge_leading_dims(s_latent, num_dims=2)  # [B*K, Z]
         log_q_z_s = torchutils.merge_leading_dims(log_q_z_s, num_dims=2)  # [B*K]
 
@@ -58,9 +61,10 @@ class PartitionedMultimodalVAE(nn.Module):
                 m_latents.append(None)
 
             else:
-                m_latent, log_q_z_m = posterior.sample_and_log_prob(
-                    num_samples, context=context
-                )
+                with profiling.region("posterior_sample"):
+                    m_latent, log_q_z_m = posterior.sample_and_log_prob(
+                        num_samples, context=context
+                    )
                 m_latent = torchutils.merge_leading_dims(m_latent, num_dims=2)
                 log_q_z_m = torchutils.merge_leading_dims(log_q_z_m, num_dims=2)
 
@@ -100,6 +104,7 @@ class PartitionedMultimodalVAE(nn.Module):
 
         return log_q_z_s + log_q_z_ms
 
+    @profiling.profiled()
     def log_p_z(self, latents):
         m_latents = latents["m"]
         s_latent = latents["s"]
@@ -118,7 +123,11 @@ class PartitionedMultimodalVAE(nn.Module):
 
         return log_p_z_ms + log_p_z_s
 
-    def log_p_x_z(self, inputs, latents, weights, num_samples=1):
+    @profiling.profiled()
+    def log_p_x_z(self, inputs, latents, weights, num_samples=1, per_modality=False):
+        """Weighted sum of log p(x_i|z) over the present modalities, or if
+        `per_modality`, a list of unweighted log p(x_i|z) (None if missing)
+        """
         m_latents = latents["m"]
         s_latent = latents["s"]
 
@@ -130,14 +139,19 @@ class PartitionedMultimodalVAE(nn.Module):
         ):
             # Account for missing modalities
             if m_latent is None:
+                log_prob_list.append(None)
                 continue
 
             x = torchutils.repeat_rows(x, num_reps=num_samples)
             # Each modality is conditioned on m_latent + s_latent
             concat_latent = torch.cat([m_latent, s_latent], dim=-1)
-            log_prob_list.append(weight * likelihood.log_prob(x, context=concat_latent))
+            log_prob = likelihood.log_prob(x, context=concat_latent)
+            log_prob_list.append(log_prob if per_modality else weight * log_prob)
+
+        if per_modality:
+            return log_prob_list
 
-        return torch.stack(log_prob_list).sum(0)
+        return torch.stack([p for p in log_prob_list if p is not None]).sum(0)
 
     def decode(self, latents: Dict[Any, Any], mean: bool) -> List[torch.Tensor]:
         """x ~ p(x|z) for each modality
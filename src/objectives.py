@@ -2,6 +2,7 @@ from typing import List, Optional, Any, Dict
 import torch
 import torch.nn as nn
 from nflows.utils import torchutils
+from src import profiling
 
 # HELPERS ######################################################################
 
@@ -43,6 +44,7 @@ from nflows.utils import torchutils
 #     return elbo
 
 
+@profiling.profiled()
 def compute_multimodal_elbo(
     model: nn.Module,
     inputs: List[Optional[torch.Tensor]],
@@ -52,11 +54,19 @@ def compute_multimodal_elbo(
     num_samples=1,
     kl_multiplier=1.0,
     keepdim=False,
+    return_terms=False,
 ):
     """Computes unimodal or multimodal ELBO.
 
-    Also returns posterior context / parameters
+    Also returns posterior context / parameters, and if `return_terms`, the
+    (unweighted) terms of the ELBO, taken from the same computation:
+        "log_p_x_z/{i}": log p(x_i|z) for each present modality i
+        "kl": log q(z|x) - log p(z), if `keep_kl`
+        "reg/{i}": log q(z|x) - log q(z|x_i) for each unimodal posterior i
+    detached, and of the same shape as the ELBO. Otherwise terms are None.
     """
+    terms = {}
+
     # Compute log prob of latents under the posterior
     log_q_z_x, latents, q_context = model.log_q_z_x(inputs, num_samples=num_samples)
 
@@ -64,13 +74,14 @@ def compute_multimodal_elbo(
 
     # Compute unimodal <-> multimodal posterior regularization terms
     if unimodal_q_contexts:
-        for context in unimodal_q_contexts:
+        for i, context in enumerate(unimodal_q_contexts):
             # Compute log prob of latents under unimodal posteriors
             log_q_z_uni = model.log_q_z_x(latent=latents, context=context)
             # Compute multimodal <-> unimodal posterior regularization term
             kl = log_q_z_x - log_q_z_uni
 
             elbo -= kl_multiplier * kl
+            terms[f"reg/{i}"] = kl
 
     # Keep kl term
     if keep_kl:
@@ -78,18 +89,80 @@ def compute_multimodal_elbo(
         log_p_z = model.log_p_z(latents)
 
         elbo += kl_multiplier * (log_p_z - log_q_z_x)
+        terms["kl"] = log_q_z_x - log_p_z
 
     # Compute log prob of inputs under the decoder
     # Weight for each likelihood term
     weights = likelihood_weights if likelihood_weights else [1.0] * len(inputs)
-    log_p_x_z = model.log_p_x_z(inputs, latents, weights, num_samples=num_samples)
-    elbo += log_p_x_z
+    if return_terms:
+        log_p_x_zs = model.log_p_x_z(
+            inputs, latents, weights, num_samples=num_samples, per_modality=True
+        )
+        for i, (log_p_x_z, weight) in enumerate(zip(log_p_x_zs, weights)):
+            # Account for missing modalities
+            if log_p_x_z is None:
+                continue
+
+            elbo += weight * log_p_x_z
+            terms[f"log_p_x_z/{i}"] = log_p_x_z
+    else:
+        log_p_x_z = model.log_p_x_z(inputs, latents, weights, num_samples=num_samples)
+        elbo += log_p_x_z
+
+    elbo = _reduce_samples(elbo, num_samples, keepdim)
+
+    if not return_terms:
+        return elbo, q_context, None
 
-    elbo = torchutils.split_leading_dim(elbo, [-1, num_samples])
+    terms = {
+        key: _reduce_samples(term.detach(), num_samples, keepdim)
+        for key, term in terms.items()
+    }
+
+    return elbo, q_context, terms
+
+
+def _reduce_samples(x: torch.Tensor, num_samples: int, keepdim: bool):
+    """[B*K] -> [B, K], averaged across samples unless `keepdim`"""
+    x = torchutils.split_leading_dim(x, [-1, num_samples])
     if not keepdim:
-        elbo = elbo.mean(1)  # Average ELBO across samples
+        x = x.mean(1)  # Average across samples
 
-    return elbo, q_context
+    return x
+
+
+def _add_terms(
+    terms: Dict[str, torch.Tensor],
+    subset_terms: Optional[Dict[str, torch.Tensor]],
+    subset: str,
+    mask: Optional[torch.Tensor] = None,
+):
+    """Adds the batch means of `subset_terms` (see `compute_multimodal_elbo`) to
+    `terms`, as "{subset}/{term}", only over the rows in `mask` if given
+    """
+    if subset_terms is None:
+        return
+
+    for key, term in subset_terms.items():
+        if mask is None:
+            mean = term.mean()
+        else:
+            # Avoids a device sync to check for an empty mask
+            mean = (term * mask).sum() / mask.sum().clamp(min=1)
+
+        terms[f"{subset}/{key}"] = mean
+
+
+def _slice_context(context, n: int):
+    """First `n` rows of a (possibly nested) posterior context"""
+    if context is None:
+        return None
+    elif isinstance(context, dict):
+        return {k: _slice_context(v, n) for k, v in context.items()}
+    elif isinstance(context, (list, tuple)):
+        return [_slice_context(c, n) for c in context]
+    else:
+        return context[:n]
 
 
 # def compute_elbo(
@@ -135,7 +208,7 @@ def stochastic_elbo(
 ):
     """Vanilla ELBO (no weights)."""
     # elbo, _ = compute_elbo(model, inputs, num_samples=num_samples, keepdim=keepdim)
-    elbo, _ = compute_multimodal_elbo(
+    elbo, _, _ = compute_multimodal_elbo(
         model, inputs, num_samples=num_samples, keepdim=keepdim
     )
 
@@ -147,12 +220,18 @@ def mvae_elbo(
     batch: Dict[Any, Any],
     likelihood_weights=List[float],
     kl_multiplier=1.0,
+    return_terms=False,
 ) -> torch.Tensor:
-    """ELBO(x1, x2) + ELBO(x1) + ELBO(x2)"""
+    """ELBO(x1, x2) + ELBO(x1) + ELBO(x2)
+
+    If `return_terms`, also returns the batch means of the ELBO terms of each
+    subset (see `compute_multimodal_elbo`), e.g. "x0/kl", "joint/log_p_x_z/1"
+    """
     inputs = batch["data"]
 
     # To collate all elbo terms
     elbo_list = []
+    terms = {}
 
     # Compute unimodal / marginal elbos
     for i, x in enumerate(inputs):
@@ -160,26 +239,32 @@ def mvae_elbo(
         xs = [None] * len(inputs)
         xs[i] = x
 
-        elbo, _ = compute_multimodal_elbo(
+        elbo, _, subset_terms = compute_multimodal_elbo(
             model,
             xs,
             likelihood_weights=likelihood_weights,
             kl_multiplier=kl_multiplier,
+            return_terms=return_terms,
         )
 
         elbo_list.append(elbo)
+        _add_terms(terms, subset_terms, f"x{i}")
 
     # Compute multimodal / joint elbo
-    joint_elbo, _ = compute_multimodal_elbo(
+    joint_elbo, _, subset_terms = compute_multimodal_elbo(
         model,
         inputs,
         likelihood_weights=likelihood_weights,
         kl_multiplier=kl_multiplier,
+        return_terms=return_terms,
     )
     elbo_list.append(joint_elbo)
+    _add_terms(terms, subset_terms, "joint")
 
     # Sum up all elbo terms
-    return torch.stack(elbo_list).sum(0)
+    elbo = torch.stack(elbo_list).sum(0)
+
+    return (elbo, terms) if return_terms else elbo
 
 
 def vaevae_elbo(
@@ -187,13 +272,20 @@ def vaevae_elbo(
     batch: Dict[Any, Any],
     likelihood_weights=List[float],
     kl_multiplier=1.0,
+    return_terms=False,
 ) -> torch.Tensor:
-    """ELBO(x1) + ELBO(x2) + multimodal_recons + multimodal_reg"""
+    """ELBO(x1) + ELBO(x2) + multimodal_recons + multimodal_reg
+
+    If `return_terms`, also returns the batch means of the ELBO terms of each
+    subset (see `compute_multimodal_elbo`), the multimodal ones over paired data
+    points only
+    """
     inputs = batch["data"]
     paired = batch["paired"]
 
     # To collate all elbo terms
     elbo_list = []
+    terms = {}
     # To cache unimodal posterior parameters (for computing multimodal terms)
     unimodal_q_contexts = []
 
@@ -203,34 +295,63 @@ def vaevae_elbo(
         xs = [None] * len(inputs)
         xs[i] = x
 
-        elbo, q_context = compute_multimodal_elbo(
+        elbo, q_context, subset_terms = compute_multimodal_elbo(
             model,
             xs,
             likelihood_weights=likelihood_weights,
             kl_multiplier=kl_multiplier,
+            return_terms=return_terms,
         )
 
         elbo_list.append(elbo)
         unimodal_q_contexts.append(q_context)
+        _add_terms(terms, subset_terms, f"x{i}")
 
     # Compute multimodal elbo terms
     # Multimodal reconstruction term
     # + multimodal <-> unimodal posterior regularization terms
-    multimodal_elbo, _ = compute_multimodal_elbo(
-        model,
-        inputs,
-        unimodal_q_contexts=unimodal_q_contexts,
-        keep_kl=False,
-        likelihood_weights=likelihood_weights,
-        kl_multiplier=kl_multiplier,
-    )
-    # If not paired, set multimodal elbo terms to zero
-    multimodal_elbo[~paired] = 0
+    n_paired = batch.get("n_paired")
+
+    if n_paired is None:
+        multimodal_elbo, _, subset_terms = compute_multimodal_elbo(
+            model,
+            inputs,
+            unimodal_q_contexts=unimodal_q_contexts,
+            keep_kl=False,
+            likelihood_weights=likelihood_weights,
+            kl_multiplier=kl_multiplier,
+            return_terms=return_terms,
+        )
+        # If not paired, set multimodal elbo terms to zero
+        multimodal_elbo[~paired] = 0
+        _add_terms(terms, subset_terms, "joint", mask=paired)
+
+    else:
+        # Stratified batch (see `PairedBatchSampler`); paired data points are the
+        # leading `n_paired` rows, so only compute multimodal terms for those
+        multimodal_elbo = torch.zeros_like(elbo_list[0][n_paired:])
+
+        if n_paired > 0:
+            paired_elbo, _, subset_terms = compute_multimodal_elbo(
+                model,
+                [x[:n_paired] for x in inputs],
+                unimodal_q_contexts=[
+                    _slice_context(c, n_paired) for c in unimodal_q_contexts
+                ],
+                keep_kl=False,
+                likelihood_weights=likelihood_weights,
+                kl_multiplier=kl_multiplier,
+                return_terms=return_terms,
+            )
+            multimodal_elbo = torch.cat([paired_elbo, multimodal_elbo])
+            _add_terms(terms, subset_terms, "joint")
 
     elbo_list.append(multimodal_elbo)
 
     # Sum up all elbo terms
-    return torch.stack(elbo_list).sum(0)
+    elbo = torch.stack(elbo_list).sum(0)
+
+    return (elbo, terms) if return_terms else elbo
 
 
 def all_elbo(
@@ -238,12 +359,14 @@ def all_elbo(
     batch: Dict[Any, Any],
     likelihood_weights=List[float],
     kl_multiplier=1.0,
+    return_terms=False,
 ) -> torch.Tensor:
     inputs = batch["data"]
 
     """ELBO(x1, x2) + ELBO(x1) + ELBO(x1) + multimodal_reg"""
     # To collate all elbo terms
     elbo_list = []
+    terms = {}
     # To cache unimodal posterior parameters (for computing multimodal terms)
     unimodal_q_contexts = []
 
@@ -253,30 +376,36 @@ def all_elbo(
         xs = [None] * len(inputs)
         xs[i] = x
 
-        elbo, q_context = compute_multimodal_elbo(
+        elbo, q_context, subset_terms = compute_multimodal_elbo(
             model,
             xs,
             likelihood_weights=likelihood_weights,
             kl_multiplier=kl_multiplier,
+            return_terms=return_terms,
         )
 
         elbo_list.append(elbo)
         unimodal_q_contexts.append(q_context)
+        _add_terms(terms, subset_terms, f"x{i}")
 
     # Compute multimodal elbo terms
     # Multimodal reconstruction term
     # + multimodal <-> unimodal posterior regularization terms
-    multimodal_elbo, _ = compute_multimodal_elbo(
+    multimodal_elbo, _, subset_terms = compute_multimodal_elbo(
         model,
         inputs,
         unimodal_q_contexts=unimodal_q_contexts,
         likelihood_weights=likelihood_weights,
         kl_multiplier=kl_multiplier,
+        return_terms=return_terms,
     )
     elbo_list.append(multimodal_elbo)
+    _add_terms(terms, subset_terms, "joint")
 
     # Sum up all elbo terms
-    return torch.stack(elbo_list).sum(0)
+    elbo = torch.stack(elbo_list).sum(0)
+
+    return (elbo, terms) if return_terms else elbo
 
 
 def jmvae_elbo(
@@ -284,6 +413,7 @@ def jmvae_elbo(
     batch: Dict[Any, Any],
     likelihood_weights=List[float],
     kl_multiplier=1.0,
+    return_terms=False,
 ) -> torch.Tensor:
     inputs = batch["data"]
 
@@ -305,12 +435,19 @@ def jmvae_elbo(
     # Compute multimodal elbo terms
     # Multimodal reconstruction term
     # + multimodal <-> unimodal posterior regularization terms
-    elbo, _ = compute_multimodal_elbo(
+    elbo, _, subset_terms = compute_multimodal_elbo(
         model,
         inputs,
         unimodal_q_contexts=unimodal_q_contexts,
         likelihood_weights=likelihood_weights,
         kl_multiplier=kl_multiplier,
+        return_terms=return_terms,
     )
 
-    return elbo
+    if not return_terms:
+        return elbo
+
+    terms = {}
+    _add_terms(terms, subset_terms, "joint")
+
+    return elbo, terms
@@ -0,0 +1,85 @@
+"""Named profiling regions for the hot paths of the models and objectives.
+
+Regions show up as labelled ranges in `torch.profiler` traces and summaries,
+see `src.callbacks.RegionProfiler`. They are only recorded while profiling is
+enabled; otherwise `region` returns a shared no-op context manager and
+`profiled` functions call straight through.
+"""
+import contextlib
+import functools
+from typing import Callable, List
+
+import torch
+
+_enabled = False
+_null_context = contextlib.nullcontext()
+
+# Names of all regions seen so far, to pick them out of profiler results
+REGIONS = set()
+
+
+def enable(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def region(name: str):
+    """Context manager marking a named region, e.g.
+
+    with region("fusion"):
+        ...
+    """
+    if not _enabled:
+        return _null_context
+
+    REGIONS.add(name)
+
+    return torch.autograd.profiler.record_function(name)
+
+
+def profiled(name: str = None) -> Callable:
+    """Decorator marking every call of a function as a region, named after the
+    function (`Class.method`) by default
+    """
+
+    def decorator(fn):
+        region_name = name or fn.__qualname__
+        REGIONS.add(region_name)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+
+            with torch.autograd.profiler.record_function(region_name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def summary_table(events, sort_by: str = "cpu_time_total") -> str:
+    """Per-region time / memory table from `profiler.key_averages()`"""
+    rows: List = [event for event in events if event.key in REGIONS]
+    rows.sort(key=lambda event: getattr(event, sort_by, 0), reverse=True)
+
+    header = (
+        f"{'Region':<50s} {'Calls':>7s} {'CPU total':>12s} {'CUDA total':>12s} "
+        f"{'CPU mem':>10s} {'CUDA mem':>10s}"
+    )
+    lines = [header, "-" * len(header)]
+    for event in rows:
+        lines.append(
+            f"{event.key:<50s} {event.count:>7d} "
+            f"{event.cpu_time_total / 1e3:>10.2f}ms "
+            f"{getattr(event, 'cuda_time_total', 0) / 1e3:>10.2f}ms "
+            f"{getattr(event, 'cpu_memory_usage', 0) / 2 ** 20:>8.1f}MB "
+            f"{getattr(event, 'cuda_memory_usage', 0) / 2 ** 20:>8.1f}MB"
+        )
+
+    return "\n".join(lines)
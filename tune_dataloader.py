@@ -0,0 +1,71 @@
+import argparse
+
+from src.datamodules.autotune import profile_path, save_profile, tune_datamodule
+from src.utils import ConfigManager, load_yaml
+
+
+def main(hparams, args):
+    # Tune from the defaults / current profile, not the values in the config
+    datamodule_args = dict(hparams.get("datamodule_args") or {})
+    datamodule_args.pop("num_workers", None)
+    hparams = {**hparams, "datamodule_args": datamodule_args}
+
+    datamodule = ConfigManager(hparams).init_object("datamodule")
+    datamodule.prepare_data()
+    datamodule.setup()
+
+    settings, stats = tune_datamodule(
+        datamodule,
+        worker_counts=args.workers,
+        test_batch_sizes=args.test_batch_sizes,
+        n_batches=args.n_batches,
+        step_time=args.step_ms / 1000,
+    )
+
+    name = type(datamodule).__name__
+    print(f"Best settings for {name}: {settings}")
+    print(
+        f"{stats['samples_per_sec']:.1f} samples/s, "
+        f"{stats['data_wait_fraction']:.1%} waiting"
+    )
+
+    if not args.dry_run:
+        save_profile(name, settings, stats)
+        print(f"Saved to {profile_path()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune DataLoader settings")
+    parser.add_argument(
+        "--config", "-c", help="path to the config file", default="configs/config.yaml"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        help="worker counts to try, by default powers of 2 up to the number of CPUs",
+    )
+    parser.add_argument(
+        "--test_batch_sizes", type=int, nargs="+", default=[16, 64, 256]
+    )
+    parser.add_argument(
+        "--n_batches", type=int, default=50, help="batches per measurement epoch"
+    )
+    parser.add_argument(
+        "--step_ms",
+        type=float,
+        default=0.0,
+        help="simulated training step time per batch, in ms",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="whether to only print the best settings",
+    )
+
+    args = parser.parse_args()
+
+    # Load config file
+    hparams = load_yaml(args.config)
+
+    main(hparams, args)